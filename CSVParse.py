@@ -1,57 +1,241 @@
 import csv
+import os
+import mmap
 import datetime as dt
 from pytz import timezone
 import re
+import numpy as np
+
+# bump whenever the parsed output changes. Used to key cached parse results (see DataCache)
+PARSER_VERSION = 2
+
+# %c is the locale datetime format
+# the rest are permutations on date order and the placement and lengh of year and seconds
+# by no means comprehensive, but hopefully decent coverage of time stamps from different sources
+DATE_FMTS = ('%c',
+             '%Y-%m-%d %H:%M',
+             '%m-%d-%Y %H:%M',
+             '%m-%d-%y %H:%M',
+             '%m/%d/%Y %H:%M',
+             '%m/%d/%y %H:%M',
+             '%m/%d/%y %I:%M%p',
+             '%Y-%m-%d %H:%M:%S',
+             '%m-%d-%Y %H:%M:%S',
+             '%m-%d-%y %H:%M:%S',
+             '%m/%d/%Y %H:%M:%S',
+             '%m/%d/%y %H:%M:%S',
+             )
+ISO_MINUTE = '%Y-%m-%d %H:%M' # by far the most common format, so it gets a vectorized parser
+SNIFF_ROWS = 100              # number of rows used to detect the date format
+CHUNK_ROWS = 2**16            # rows per chunk when reading files. See CSVChunks
 
 def getInstance(csvFile):
   '''For compatability with code that doesn't know what parser it is getting'''
   return CSVData(csvFile)
 
-class CSVData:
+def sniffDateFormat(dateStrs):
+  '''Returns the format from DATE_FMTS that parses the most of the sample dateStrs
+     (the first one that parses all of them, if any do) or None if none parse any.'''
+  best = (0,None)
+  for fmt in DATE_FMTS:
+    hits = 0
+    for dateStr in dateStrs:
+      try:
+        dt.datetime.strptime(dateStr,fmt)
+        hits += 1
+      except ValueError: pass
+    if hits == len(dateStrs): return fmt
+    if hits > best[0]: best = (hits,fmt)
+  return best[1]
+
+def parseDate(dateStr,fmt=None):
+  '''Parses a single date string, trying fmt first and then all of DATE_FMTS.
+     Returns int local seconds since 1970 or raises ValueError.'''
+  fmts = DATE_FMTS if fmt is None else (fmt,) + DATE_FMTS
+  for fmt in fmts:
+    try:
+      d = dt.datetime.strptime(dateStr,fmt)
+      return int((d - dt.datetime(1970,1,1)).total_seconds())
+    except ValueError: pass
+  raise ValueError("Can't find a suitable date format to parse '%s'" % dateStr)
+
+def parseISOMinutes(dateStrs):
+  '''Vectorized parser for 'YYYY-MM-DD hh:mm' strings. Returns (seconds,valid), where
+     seconds is an int64 array of local seconds since 1970 that is only meaningful
+     where the boolean array valid is True.'''
+  n = len(dateStrs)
+  strs = np.array(dateStrs,dtype='S')
+  valid = np.char.str_len(strs) == 16
+  chars = np.zeros((n,16),dtype=np.uint8)
+  chars[valid] = strs[valid].astype('S16').view(np.uint8).reshape(-1,16)
+  digits = chars[:,[0,1,2,3,5,6,8,9,11,12,14,15]].astype(np.int64) - ord('0')
+  valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+  for (pos,sep) in ((4,'-'),(7,'-'),(10,' '),(13,':')): valid &= chars[:,pos] == ord(sep)
+  year   = digits[:,0] * 1000 + digits[:,1] * 100 + digits[:,2] * 10 + digits[:,3]
+  month  = digits[:,4]  * 10 + digits[:,5]
+  day    = digits[:,6]  * 10 + digits[:,7]
+  hour   = digits[:,8]  * 10 + digits[:,9]
+  minute = digits[:,10] * 10 + digits[:,11]
+  valid &= (month >= 1) & (month <= 12) & (hour < 24) & (minute < 60)
+  months = (year - 1970) * 12 + np.clip(month,1,12) - 1 # months since 1970-01
+  monthStart  = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+  monthLength = (months + 1).astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) - monthStart
+  valid &= (day >= 1) & (day <= monthLength)
+  seconds = (monthStart + day - 1) * 86400 + hour * 3600 + minute * 60
+  return (seconds,valid)
+
+def parseDates(dateStrs,fmt,lineNums=None):
+  '''Parses a column of date strings, in bulk where possible, using the (sniffed) format fmt.
+     Rows that don't match fmt are tried against all of DATE_FMTS. Returns (seconds,errors)
+     where seconds is int64 local seconds since 1970 and errors is a list of
+     (line number,message) for rows that could not be parsed. Those rows have seconds of 0.'''
+  if lineNums is None: lineNums = range(len(dateStrs))
+  seconds = np.zeros(len(dateStrs),dtype=np.int64)
+  todo = range(len(dateStrs))
+  if fmt == ISO_MINUTE:
+    (seconds,valid) = parseISOMinutes(dateStrs)
+    todo = np.where(~valid)[0].tolist() # just the anomalies
+  errors = []
+  for i in todo:
+    try: seconds[i] = parseDate(dateStrs[i],fmt)
+    except ValueError as ve:
+      seconds[i] = 0
+      errors.append((lineNums[i],str(ve)))
+  return (seconds,errors)
+
+def parseReadings(readingStrs,lineNums=None):
+  '''Parses a column of integer readings. Returns (values,errors) like parseDates'''
+  if lineNums is None: lineNums = range(len(readingStrs))
+  strs = np.array(readingStrs,dtype='S')
+  # fast path, for when all is well. Note that numpy's string to int cast can't be
+  # relied on to reject bad strings in large arrays, so they are validated first
+  unsigned = np.char.lstrip(strs,'-')
+  oneSign  = np.char.str_len(strs) - np.char.str_len(unsigned) <= 1 # i.e. not '--5'
+  if (np.char.isdigit(unsigned) & oneSign).all(): return (strs.astype(np.int64),[])
+  values = np.zeros(len(readingStrs),dtype=np.int64)
+  errors = []
+  for (i,readingStr) in enumerate(readingStrs):
+    try: values[i] = int(readingStr)
+    except ValueError: errors.append((lineNums[i],"Invalid reading '%s'" % readingStr))
+  return (values,errors)
+
+class CSVChunks(object):
+  '''Iterator over the readings of a csv file in chunks of chunkRows rows (the last
+     chunk can be shorter), each an int64 (times,values) tuple of numpy arrays as
+     returned by CSVData.getReadingsArray. The file is memory mapped and read a block
+     at a time, so memory use depends on chunkRows rather than the file size and
+     consumers can start on the first chunk while the rest is still being read.
+     headers, dateFormat and errors are filled in as the file is read.
+     Note: quoted fields with embedded newlines are not supported.'''
+  def __init__(self,CSVFile,chunkRows=CHUNK_ROWS,dateIdx=0,readingIdx=1):
+    self.CSVFile    = CSVFile
+    self.chunkRows  = chunkRows
+    self.dateIdx    = dateIdx
+    self.readingIdx = readingIdx
+    self.headers    = None
+    self.dateFormat = None
+    self.errors     = [] # (line number,message) for each skipped row
+
+  # generator of (first line number,list of lines) with chunkRows lines each (except the last)
+  def lineBlocks(self,mm,pos=0,lineNum=1):
+    blockBytes = max(self.chunkRows * 32,2**16) # bytes read from the map at a time
+    pending = [] # complete lines not yet yielded
+    tail = ''    # partial line at the end of the last block read
+    while pos < len(mm):
+      lines = (tail + mm[pos:pos + blockBytes]).split('\n')
+      pos += blockBytes
+      tail = lines.pop() # '' if the block ended on a line break
+      pending.extend(lines)
+      while len(pending) >= self.chunkRows:
+        yield (lineNum,pending[0:self.chunkRows])
+        lineNum += self.chunkRows
+        pending = pending[self.chunkRows:]
+    if tail != '': pending.append(tail) # last line had no line break
+    if len(pending) > 0: yield (lineNum,pending)
+
+  def parseChunk(self,firstLine,lines):
+    nCols = max(self.dateIdx,self.readingIdx) + 1
+    lineNums    = []
+    dateStrs    = []
+    readingStrs = []
+    for (i,row) in enumerate(csv.reader(lines)):
+      if len(row) == 0: continue # blank line
+      if len(row) < nCols:
+        self.errors.append((firstLine + i,'Expected at least %d columns' % nCols))
+        continue
+      lineNums.append(firstLine + i)
+      dateStrs.append(row[self.dateIdx].strip())
+      readingStrs.append(row[self.readingIdx].strip())
+    if self.dateFormat is None and len(dateStrs) > 0:
+      self.dateFormat = sniffDateFormat(dateStrs[0:SNIFF_ROWS])
+    (times,dateErrors)     = parseDates(dateStrs,self.dateFormat,lineNums)
+    (values,readingErrors) = parseReadings(readingStrs,lineNums)
+    errors = dateErrors + readingErrors
+    if len(errors) == 0: return (times,values)
+    self.errors.extend(errors)
+    keep = ~np.in1d(lineNums,[err[0] for err in errors])
+    return (times[keep],values[keep])
+
+  def __iter__(self):
+    with open(self.CSVFile,'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0: return # can't mmap an empty file
+      mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+      try:
+        headerEnd = mm.find('\n')
+        if headerEnd == -1: headerEnd = len(mm)
+        self.headers = csv.reader([mm[0:headerEnd]]).next()
+        for (firstLine,lines) in self.lineBlocks(mm,headerEnd + 1,2):
+          yield self.parseChunk(firstLine,lines)
+      finally: mm.close()
+
+def iterChunks(CSVFile,chunkRows=CHUNK_ROWS):
+  '''Iterator API for processing files too large to hold comfortably. See CSVChunks'''
+  return CSVChunks(CSVFile,chunkRows)
+
+class CSVData(object):
   '''This program parses CSV formatted interval meter data with columns
-     'date' as YYYY-MM-DD hh:mm and 'reading' in Watts like this: 
+     'date' as YYYY-MM-DD hh:mm and 'reading' in Watts like this:
       date,reading
       2011-10-29 00:00,327
-      2011-10-29 01:00,267 '''
-  def __init__(self,CSVFile):
-    with(open(CSVFile,'rb')) as f:
-      fReader = csv.reader(f)
-      self.headers = fReader.next()
-      dateIdx    = 0
-      readingIdx = 1
-      rows = [(self.parseDate(row[dateIdx]),int(row[readingIdx])) for row in fReader]
-      (self.dates,self.rates) = zip(*rows)
-      self.data = [self.dates,self.rates]
+      2011-10-29 01:00,267
+     The date format is detected once from a sample of rows (see DATE_FMTS) and the
+     whole date column is then parsed in bulk. Malformed rows are skipped and
+     reported in self.errors as (line number,message) tuples.
+     The file is read in chunks by CSVChunks, which can also be used directly.'''
+  def __init__(self,CSVFile,chunkRows=CHUNK_ROWS):
+    reader = CSVChunks(CSVFile,chunkRows)
+    chunks = list(reader)
+    self.headers    = reader.headers
+    self.dateFormat = reader.dateFormat
+    self.errors     = sorted(reader.errors)
+    self.times  = np.concatenate([chunk[0] for chunk in chunks] or [np.zeros(0,dtype=np.int64)]) # int64 local seconds since 1970
+    self.values = np.concatenate([chunk[1] for chunk in chunks] or [np.zeros(0,dtype=np.int64)]) # int64 readings
+    if len(self.errors) > 0:
+      skipped = len(set([err[0] for err in self.errors]))
+      print 'Warning: skipped %d malformed rows in %s. First: line %d: %s' % (skipped,CSVFile,self.errors[0][0],self.errors[0][1])
+    if len(self.times) == 0:
+      raise ValueError("Can't find a suitable date format to parse CSV data")
+
+  # the readings as lists of datetime objects and ints
+  @property
+  def dates(self): return self.times.astype('datetime64[s]').astype(object).tolist()
+  @property
+  def rates(self): return self.values.tolist()
+  @property
+  def data(self): return [self.dates,self.rates]
 
   def parseDate(self,dateStr):
-    # %c is the locale datetime format
-    # the rest are permutations on date order and the placement and lengh of year and seconds
-    # by no means comprehensive, but hopefully decent coverage of time stamps from different sources
-    fmts = ('%c',
-            '%Y-%m-%d %H:%M',
-            '%m-%d-%Y %H:%M',
-            '%m-%d-%y %H:%M',
-            '%m/%d/%Y %H:%M',
-            '%m/%d/%y %H:%M',
-            '%m/%d/%y %I:%M%p',
-            '%Y-%m-%d %H:%M:%S',
-            '%m-%d-%Y %H:%M:%S',
-            '%m-%d-%y %H:%M:%S',
-            '%m/%d/%Y %H:%M:%S',
-            '%m/%d/%y %H:%M:%S',
-            )
-    for fmt in fmts:
-      try: 
-        return dt.datetime.strptime(dateStr,fmt)
-      except: pass
-    raise ValueError("Can't find a suitable date format to parse CSV data")
+    return dt.datetime(1970,1,1) + dt.timedelta(seconds=parseDate(dateStr,self.dateFormat))
 
   def getReadings(self):
     return self.data
 
+  # same layout as GBParse.GBData.getReadingsArray: int64 local seconds since 1970 and int64 readings
+  def getReadingsArray(self):
+    return [self.times,self.values]
+
 if __name__ == '__main__':
   # TODO: more tests!
   import CSVParse
   a = CSVParse.getInstance('data/sam.csv')
   print a.data
-    
\ No newline at end of file
@@ -0,0 +1,117 @@
+# Change point models of daily energy use against outside temperature, for weather normalization.
+# See ASHRAE Guideline 14 and the ASHRAE Inverse Modeling Toolkit for background. Models fit are:
+#  3PH: kWh = b0 + bh * max(Th - tout,0)                         (heating only)
+#  3PC: kWh = b0 + bc * max(tout - Tc,0)                         (cooling only)
+#  5P:  kWh = b0 + bh * max(Th - tout,0) + bc * max(tout - Tc,0) (heating and cooling, Th <= Tc)
+# where Th and Tc are the heating and cooling balance point temperatures. For a given set of
+# balance points these are ordinary linear regressions, so rather than refitting in a loop,
+# every candidate balance point (or pair) is fit at once with ols.olsBatch, one design per
+# candidate. The best candidate of each model is refit with ols.ols for its statistics
+# and the model with the lowest CV(RMSE) wins.
+import numpy as np
+
+import ols
+
+MODELS       = ('3PH','3PC','5P')
+MIN_DAYS     = 14  # fewer matched days than this and no model is fit
+CANDIDATE_PCTS = (10,90) # balance points are searched between these percentiles of tout, in
+CANDIDATE_STEP = 1.0     # steps of this many degrees F
+
+def candidateTemps(tout):
+  '''balance point temperatures to search for tout'''
+  (lo,hi) = np.percentile(tout,CANDIDATE_PCTS)
+  return np.arange(np.floor(lo),np.ceil(hi) + CANDIDATE_STEP,CANDIDATE_STEP)
+
+def hinge(tout,temps,heating):
+  '''(candidate,day) array of the heating (or cooling) degrees of each day for each candidate balance point'''
+  if heating: return np.maximum(temps[:,np.newaxis] - tout[np.newaxis,:],0)
+  return np.maximum(tout[np.newaxis,:] - temps[:,np.newaxis],0)
+
+def bestFit(y,x):
+  '''Fits y against each of the (candidate,day,regressor) designs x at once with ols.olsBatch.
+     Returns the index of the candidate with the lowest residual sum of squares among those with
+     all slopes positive, or None if no candidate has a physically sensible fit.'''
+  fits = ols.olsBatch(np.tile(y,(len(x),1)),x)
+  ok   = (fits.b[:,1:] > 0).all(axis=1) & np.isfinite(fits.ssr) # nan slopes (i.e. all zero degrees) fail too
+  if not ok.any(): return None
+  return np.argmin(np.where(ok,fits.ssr,np.inf))
+
+class ChangePointModel(object):
+  '''A fitted change point model. kind is one of MODELS, b0 is the base load (kWh/day), heatSlope and
+     coolSlope are kWh/day per degree F below heatBalance or above coolBalance (None when not part
+     of the model). cvrmse is the coefficient of variation of the RMSE (using n - p degrees of freedom,
+     as in ASHRAE Guideline 14), r2 the R squared and lm the underlying ols.ols instance.'''
+  def __init__(self,kind,tout,y,heatBalance=None,coolBalance=None):
+    self.kind        = kind
+    self.heatBalance = heatBalance
+    self.coolBalance = coolBalance
+    self.nParams     = 3 if kind in ('3PH','3PC') else 5 # balance points count as parameters
+    self.lm = ols.ols(y,self.regressors(tout),'kWh',self.names())
+    self.b0 = self.lm.b[0]
+    coefs = dict(zip(self.names(),self.lm.b[1:]))
+    self.heatSlope = coefs.get('hdd',None)
+    self.coolSlope = coefs.get('cdd',None)
+    self.nobs   = self.lm.nobs
+    self.r2     = self.lm.R2
+    self.rmse   = np.sqrt(np.dot(self.lm.e,self.lm.e) / max(self.nobs - self.nParams,1))
+    self.cvrmse = self.rmse / np.mean(y)
+
+  def names(self):
+    return [name for (name,bal) in (('hdd',self.heatBalance),('cdd',self.coolBalance)) if bal is not None]
+
+  def regressors(self,tout):
+    '''(day,regressor) array of the heating and cooling degrees of tout'''
+    tout = np.asarray(tout,dtype=float)
+    cols = []
+    if self.heatBalance is not None: cols.append(np.maximum(self.heatBalance - tout,0))
+    if self.coolBalance is not None: cols.append(np.maximum(tout - self.coolBalance,0))
+    return np.column_stack(cols)
+
+  def predict(self,tout):
+    '''modeled kWh/day for the temperatures tout'''
+    return self.b0 + np.dot(self.regressors(tout),self.lm.b[1:])
+
+  def weatherShare(self,tout):
+    '''fraction of the modeled energy use over the days of tout that depends on the weather'''
+    total = self.predict(tout).sum()
+    if not total > 0: return 0.0
+    return float(min(max(1 - self.b0 * len(tout) / total,0.0),1.0))
+
+  def __repr__(self):
+    return '<%s model Th=%s bh=%s Tc=%s bc=%s b0=%0.2f CV(RMSE)=%0.3f R2=%0.3f>' % (self.kind,
+      self.heatBalance,self.heatSlope,self.coolBalance,self.coolSlope,self.b0,self.cvrmse,self.r2)
+
+def fitModels(tout,kWh):
+  '''Fits all the MODELS to daily kWh against mean daily tout (F), ignoring days where either is nan.
+     Returns a dict of kind: ChangePointModel for each model with a physically sensible fit.'''
+  tout = np.asarray(tout,dtype=float)
+  kWh  = np.ma.filled(np.ma.asarray(kWh,dtype=float),np.nan)
+  ok   = np.isfinite(tout) & np.isfinite(kWh)
+  (tout,kWh) = (tout[ok],kWh[ok])
+  if len(tout) < MIN_DAYS: return {}
+  temps = candidateTemps(tout)
+  h = hinge(tout,temps,heating=True)
+  c = hinge(tout,temps,heating=False)
+  models = {}
+  i = bestFit(kWh,h[:,:,np.newaxis])
+  if i is not None: models['3PH'] = ChangePointModel('3PH',tout,kWh,heatBalance=temps[i])
+  i = bestFit(kWh,c[:,:,np.newaxis])
+  if i is not None: models['3PC'] = ChangePointModel('3PC',tout,kWh,coolBalance=temps[i])
+  (hi,ci) = np.triu_indices(len(temps)) # every pair with Th <= Tc
+  i = bestFit(kWh,np.dstack([h[hi],c[ci]]))
+  if i is not None: models['5P'] = ChangePointModel('5P',tout,kWh,heatBalance=temps[hi[i]],coolBalance=temps[ci[i]])
+  return models
+
+def bestModel(tout,kWh):
+  '''The fitted model with the lowest CV(RMSE), or None if no model could be fit. See fitModels'''
+  models = fitModels(tout,kWh)
+  if len(models) == 0: return None
+  return min(models.values(),key=lambda model: model.cvrmse)
+
+if __name__ == '__main__':
+  # simulated heating and cooling building
+  np.random.seed(1)
+  tout = np.random.uniform(20,100,365)
+  kWh  = 20 + 0.8 * np.maximum(55 - tout,0) + 1.5 * np.maximum(tout - 70,0) + np.random.normal(0,2,365)
+  for (kind,model) in sorted(fitModels(tout,kWh).items()): print model
+  print 'best:', bestModel(tout,kWh)
@@ -0,0 +1,176 @@
+# Caching of parsed interval data. Parsing Green Button xml (or csv) is by far the most
+# expensive part of loading a data file, so the parsed readings are kept in two places:
+# 1) a compact binary sidecar file written next to the data file (i.e. GB_data.xml.<key>.npy)
+#    that is memory mapped on later loads, so it is effectively free to re-open
+# 2) a bounded, least recently used, in memory cache shared by all request threads
+# Both are keyed by a hash of the file contents plus the parser name and version, so an
+# upload that replaces GB_data.xml or a change to a parser's output invalidates old entries.
+# Rendered plots and reports are cached on disk in the same spirit by RenderCache.
+import os
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+class ParsedReadings(object):
+  '''Stand in for a parser instance (i.e. GBParse.GBData) built from cached arrays.
+     Only the readings accessors are supported.'''
+  def __init__(self,times,values):
+    self.times  = times  # int64 local seconds since 1970
+    self.values = values
+    self.nbytes = times.nbytes + values.nbytes
+
+  def getReadingsArray(self):
+    return [self.times,self.values]
+
+  def getReadings(self):
+    return [self.times.astype('datetime64[s]').astype(object).tolist(),self.values.tolist()]
+
+class LRUCache(object):
+  '''Thread safe least recently used cache that evicts entries once the total
+     size of the stored values exceeds maxBytes'''
+  def __init__(self,maxBytes):
+    self.maxBytes = maxBytes
+    self.bytes    = 0
+    self.entries  = OrderedDict() # key -> (value,nbytes), oldest first
+    self.lock     = threading.Lock()
+
+  def get(self,key,default=None):
+    with self.lock:
+      entry = self.entries.pop(key,None)
+      if entry is None: return default
+      self.entries[key] = entry # re-insert as the most recently used
+      return entry[0]
+
+  def put(self,key,value,nbytes):
+    with self.lock:
+      old = self.entries.pop(key,None)
+      if old is not None: self.bytes -= old[1]
+      if nbytes > self.maxBytes: return # would evict everything else and still not fit
+      self.entries[key] = (value,nbytes)
+      self.bytes += nbytes
+      while self.bytes > self.maxBytes:
+        (oldKey,(oldValue,oldBytes)) = self.entries.popitem(last=False)
+        self.bytes -= oldBytes
+
+  def __len__(self): return len(self.entries)
+
+# hash of the file contents and the version string of the parser used to read it
+def contentKey(source,version,blockSize=2**20):
+  h = hashlib.sha1(version)
+  with open(source,'rb') as f:
+    while True:
+      block = f.read(blockSize)
+      if not block: break
+      h.update(block)
+  return h.hexdigest()
+
+def sidecarPath(source,key): return '%s.%s.npy' % (source,key)
+
+def loadSidecar(source,key):
+  '''returns ParsedReadings backed by a read only memory map of the sidecar, or None if there isn't one'''
+  path = sidecarPath(source,key)
+  if not os.path.isfile(path): return None
+  try: arr = np.load(path,mmap_mode='r')
+  except Exception as e:
+    print 'Warning: unreadable parse cache %s: %s' % (path,e)
+    return None
+  return ParsedReadings(arr['time'],arr['value'])
+
+def writeSidecar(source,key,parsedData):
+  '''writes the readings of parsedData to the sidecar for source and removes sidecars for old keys'''
+  (times,values) = parsedData.getReadingsArray()
+  arr = np.empty(len(times),dtype=[('time',np.int64),('value',values.dtype)])
+  arr['time']  = times
+  arr['value'] = values
+  path = sidecarPath(source,key)
+  tmpPath = '%s.%d.tmp' % (path,threading.current_thread().ident)
+  try:
+    with open(tmpPath,'wb') as f: np.save(f,arr)
+    # a sidecar that already exists has the same key, and therefore the same contents
+    if os.path.isfile(path): os.remove(tmpPath)
+    else: os.rename(tmpPath,path)
+    (dirName,fileName) = os.path.split(source)
+    for other in os.listdir(dirName or '.'):
+      if other.startswith(fileName + '.') and other.endswith('.npy') and other != os.path.basename(path):
+        os.remove(os.path.join(dirName,other))
+  except (IOError,OSError) as e: # caching is an optimization. Don't fail the parse over it
+    print 'Warning: could not write parse cache %s: %s' % (path,e)
+
+STALE_TMP_AGE = 3600 # seconds after which a RenderCache temp file is taken to be abandoned
+
+class RenderCache(object):
+  '''Disk cache of rendered files (plot images, reports), keyed by a hash of everything that goes
+     into them, so identical data renders once per deployment rather than once per session.
+     Hits are hard linked (or copied, where links aren't supported) into the requesting directory.
+     Files are evicted least recently used first once their total size exceeds maxBytes. Use from
+     a single process: the index is in memory, rebuilt from the files (by mtime) on start up.
+     Note that a hard linked file shares its contents with the cache, so files that may have
+     come from the cache must be removed and replaced rather than rewritten in place.'''
+  def __init__(self,cacheDir,maxBytes):
+    self.cacheDir = cacheDir
+    self.maxBytes = maxBytes
+    self.bytes    = 0
+    self.entries  = OrderedDict() # key -> nbytes, oldest first
+    self.lock     = threading.Lock()
+    if not os.path.isdir(cacheDir): os.makedirs(cacheDir)
+    found = []
+    for name in os.listdir(cacheDir):
+      path = os.path.join(cacheDir,name)
+      try:
+        mtime = os.path.getmtime(path)
+        # temp files are left over from an interrupted store once they are old. Newer ones may be
+        # in flight in another instance (i.e. another process) that shares the directory
+        if name.endswith('.tmp'):
+          if mtime < time.time() - STALE_TMP_AGE: os.remove(path)
+        else: found.append((mtime,name,os.path.getsize(path)))
+      except OSError: pass # removed by another instance in the meantime
+    for (mtime,key,nbytes) in sorted(found): self.add(key,nbytes)
+
+  def path(self,key): return os.path.join(self.cacheDir,key)
+
+  def add(self,key,nbytes):
+    old = self.entries.pop(key,None)
+    if old is not None: self.bytes -= old
+    self.entries[key] = nbytes
+    self.bytes += nbytes
+    while self.bytes > self.maxBytes and len(self.entries) > 0:
+      (oldKey,oldBytes) = self.entries.popitem(last=False)
+      self.bytes -= oldBytes
+      try: os.remove(self.path(oldKey))
+      except OSError: pass
+
+  def fetch(self,key,dest):
+    '''links the cached file for key to dest, replacing any file there. Returns False on a miss'''
+    with self.lock:
+      if key not in self.entries: return False
+      try:
+        linkOrCopy(self.path(key),dest)
+        os.utime(self.path(key),None) # so the order survives a restart
+      except (IOError,OSError) as e:
+        print 'Warning: could not use cached render %s: %s' % (key,e)
+        return False
+      self.entries[key] = self.entries.pop(key) # re-insert as the most recently used
+      return True
+
+  def store(self,key,src):
+    '''adds the file src to the cache as key, evicting old files as needed'''
+    with self.lock:
+      try:
+        nbytes = os.path.getsize(src)
+        if nbytes > self.maxBytes: return
+        linkOrCopy(src,self.path(key))
+        self.add(key,nbytes)
+      except (IOError,OSError) as e: # caching is an optimization. Don't fail the render over it
+        print 'Warning: could not cache render %s: %s' % (src,e)
+
+def linkOrCopy(src,dest):
+  '''hard links src to dest (copying if linking fails) via a temp file, so dest is replaced atomically'''
+  tmpPath = '%s.%d.%d.tmp' % (dest,os.getpid(),threading.current_thread().ident)
+  try: os.link(src,tmpPath)
+  except (AttributeError,OSError): shutil.copyfile(src,tmpPath) # no os.link on windows with python 2
+  if os.name == 'nt' and os.path.isfile(dest): os.remove(dest) # no atomic replace on windows
+  os.rename(tmpPath,dest)
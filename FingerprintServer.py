@@ -2,6 +2,7 @@
 
 """CherryPy server that loads and visualizes GB XML data"""
 import os
+import json
 import datetime, threading, random
 import zipfile, shutil, re, time
 import pickle
@@ -24,9 +25,14 @@ from analysis      import Building, PlotMaker
 from WeatherData   import WeatherData
 import GBParse
 import CSVParse
+from Jobs import JobRegistry, JobQueue
 
 code_dir = os.path.dirname(os.path.abspath(__file__))
 fileLock = threading.Lock()
+renderJobs = JobRegistry() # session id -> Jobs.Artifacts of its latest report, for dynamic and status
+# builds whole reports one at a time in the background, behind files requested on demand, which
+# dynamic makes in the request thread
+reportQueue = JobQueue('report builder')
 
 mimetypes.types_map[".xml"]="application/xml"
 
@@ -140,7 +146,9 @@ class Root: # the root serves (mostly) static site content
       return template.render(**response_dict)
     else: 
       b = cherrypy.session.get("building",None)
-      pm = PlotMaker(b,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"))
+      pm = PlotMaker(b,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"),processes=cherrypy.config.get("plot.processes",1),
+                     timeout=cherrypy.config.get("report.wait.timeout",300))
+      pm.artifacts = renderJobs.start(cherrypy.session._id,pm.artifactNames())
       pm.generateFiles()
       return self.dynamic("custom_report.pdf")
 
@@ -156,15 +164,37 @@ class Root: # the root serves (mostly) static site content
     count = cherrypy.session.get("count", 0) + 1
     cherrypy.session["count"] = count
     b = cherrypy.session.get("building",None)
-    pm = PlotMaker(b,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"))
-    pm.waitForImages() # generate images if necessary
-    pme = pm.getError() # this is how we learn if there were errors in the image generation thread
+    job = renderJobs.get(cherrypy.session._id)
+    if job is not None: # make (or wait for) just this file, which is served as soon as it is made
+      if b is not None:
+        pm = PlotMaker(b,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"),cherrypy.session._id,artifacts=job,
+                       timeout=cherrypy.config.get("report.wait.timeout",300))
+        if fileName in pm.artifactNames(): pm.makeArtifact(fileName)
+      if not job.expected(fileName): raise Exception("File generation failed: %s is not being made" % fileName)
+      if not job.wait(fileName,cherrypy.config.get("report.wait.timeout",300)):
+        raise Exception("File generation failed: timed out waiting for %s" % fileName)
+      pme = job.errorFor(fileName)
+    else: # i.e. the files of a session from before a restart
+      pm = PlotMaker(b,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"))
+      pm.waitForImages() # generate images if necessary
+      pme = pm.getError() # this is how we learn if there were errors in the image generation thread
     if pme is not None: raise Exception("File generation failed: " + pme) # the file generation failed, so we need to handle this error somehow
     baseDir = os.path.join(cherrypy.config.get("app.root"),getUserDir())
     print(os.path.join(baseDir,fileName))
     if download: return serve_download(os.path.join(baseDir,fileName))
     return serve_file(os.path.join(baseDir,fileName), content_type=mimetypes.types_map.get(ext,"text/plain"))
 
+  # json summary of the session's report generation (files ready, failed and pending) and weather
+  # lookup, for pages to poll. Never blocks
+  @cherrypy.expose
+  def status(self):
+    cherrypy.response.headers["Content-Type"] = "application/json"
+    job  = renderJobs.get(cherrypy.session._id)
+    bldg = cherrypy.session.get("building",None)
+    out = {"report" : None if job is None else job.status(),
+           "weather": None if bldg is None or bldg.weatherJob is None else bldg.weatherJob.status()}
+    return json.dumps(out)
+
 # this class handles the feedback functions of the tool.
 # it serves the web form and writes the comments to a txt 
 # file named with the session id
@@ -253,7 +283,7 @@ class UploadService(object):
     if len(params.get("bldg_zip")) != 5: errs["bldg_zip"] = "Zip code must be 5 digits"
     
     if "bldg_zip" not in errs.keys():
-      weather = WeatherData("weather") # dataDir
+      weather = WeatherData("weather",cherrypy.config.get("weather.base.url")) # dataDir
       zipLatLon = weather.zipMap().get(int(params["bldg_zip"]),None)
       if zipLatLon is None: errs["bldg_zip"] = "Invalid zip code not found in national list. Try another nearby?"
     return errs
@@ -321,12 +351,12 @@ class UploadService(object):
         os.rename(rawFilePath,parseTargetFile)
       #else: raise Exception("Unrecognized file type %s" % ext)
 
-      parsedData = analysis.parseDataFile(parseTargetFile)
+      parsedData = analysis.parseDataFile(parseTargetFile,useCache=True)
 
-      dates = parsedData.getReadings()[0]
-      dateDiff = [j-i for i, j in zip(dates[:-1], dates[1:])]
+      times = parsedData.getReadingsArray()[0] # int64 seconds
+      dateDiff = np.diff(times)
       #print dateDiff
-      if(min(dateDiff) > datetime.timedelta(hours=1)): raise Exception("Time difference must be at most 1 hour between readings")
+      if(dateDiff.min() > 3600): raise Exception("Time difference must be at most 1 hour between readings")
     
     #except xml.parsers.expat.ExpatError as ee:
     #  print ee
@@ -351,19 +381,20 @@ class UploadService(object):
       pickle.dump(params,paramFile)
     #with open(os.path.join(userDir,'params.pkl'),'rb') as paramFile:
     #  print pickle.load(paramFile)
-    bldg = Building(parsedData.getReadings(),params['bldg_zip'],params)
+    bldg = Building(parsedData.getReadingsArray(),params['bldg_zip'],params)
     cherrypy.session["building"] = bldg
-    weather = WeatherData("weather")
-    first = bldg.days[0]
-    last = bldg.days[-1]
-    # warning. This can trigger a long download that is not in a separate thread
-    bestWBAN = weather.closestWBAN(int(params["bldg_zip"]),first.year,first.month)
-    sess["bestWBAN"]      = bestWBAN
-    bldg.attr["bestWBAN"] = bestWBAN
-
-    pm = PlotMaker(bldg,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"),sId)
-    threading.Thread(target=pm.generateFiles).start()
-    time.sleep(0.25) # let the lock file get written
+    # the weather station and daily tout can involve long downloads, so they are resolved in the
+    # background. Plots that need the weather wait for the job. See Building.startWeather
+    bldg.startWeather(cherrypy.config.get("weather.base.url"))
+
+    pm = PlotMaker(bldg,getUserDir(),cherrypy.config.get("wkhtmltopdf.bin"),sId,cherrypy.config.get("plot.processes",1),
+                   timeout=cherrypy.config.get("report.wait.timeout",300))
+    # registered before the build is queued, so dynamic can make or wait on files. The report itself
+    # (i.e. the pdf) is only made when it is requested, as most visitors never download it
+    pm.artifacts = renderJobs.start(sId,pm.artifactNames(),onDemand=pm.REPORT_FILES)
+    if cherrypy.config.get("report.prebuild",True): # otherwise the plots are only made when requested too
+      pm.artifacts.scheduled = True
+      reportQueue.put(pm.generateFiles,report=False)
     sess["filename"] = upFile.filename
     sess["filesize"] = size
     sess["filetype"] = upFile.content_type
@@ -387,6 +418,7 @@ class ImageService(object):
   def index(self,**params):
     b = cherrypy.session["building"]
     [dates,watts] = b.data
+    dates = dates.astype(object) # datetime64 to datetime
     rows = ["%s,%i" % (dates[i].strftime("%Y-%m-%d %H:%M"),watts[i]) for i in range(len(watts))]
     return '%s"s %s (%i kWh total):<br>' % (params.get("user","uploaded data"),params.get("fuel","electricity"),sum(watts)/1000) + "<br>".join(rows)
   index.exposed = True
@@ -398,6 +430,9 @@ if __name__ == "__main__":
   root.img      = ImageService()
   root.upload   = UploadService()
   root.feedback = FeedbackService()
+  cherrypy.config.update(bft_conf)
+  # the render pool forks its workers, which must happen before any request or report thread runs
+  if cherrypy.config.get("plot.processes",1) > 1: analysis.renderPool(cherrypy.config.get("plot.processes"))
   cherrypy.quickstart(root,config=bft_conf)
 
   # Disable the encode tool because it
@@ -10,22 +10,59 @@ from defusedxml import ElementTree # import security patched xml.etree.ElementTr
 import datetime as dt
 from pytz import timezone
 import re
+import time
+import calendar
+import numpy as np
 
 ESPI_NS = 'http://naesb.org/espi'
 ATOM_NS = "http://www.w3.org/2005/Atom"
 
-def getInstance(gbXMLFile):
+# columns stored for each ReadingBlock. See parseReadings
+READING_COLS = ('times','values','durations','costs')
+
+# bump whenever the parsed output changes. Used to key cached parse results (see DataCache)
+PARSER_VERSION = 2
+
+def getInstance(gbXMLFile,stream=True):
   '''For compatability with code that doesn't know what parser it is getting'''
-  return GBData(gbXMLFile)
+  return GBData(gbXMLFile,stream)
+
+def nanArray(n):
+  out = np.empty(n)
+  out.fill(np.nan)
+  return out
+
+def localSeconds(epochs):
+  '''Converts an array of unix times into naive local wall clock seconds, i.e. the times
+     that datetime.fromtimestamp() would return, expressed as seconds since 1970-01-01 00:00.
+     localtime() is called once per distinct hour, plus once per reading in the rare hours
+     that contain a utc offset change (i.e. half hour DST shifts).'''
+  if len(epochs) == 0: return epochs
+  utcOffset = lambda t: calendar.timegm(time.localtime(t)) - t
+  (hours,inverse) = np.unique(epochs // 3600,return_inverse=True)
+  first = np.array([utcOffset(h * 3600)        for h in hours.tolist()],dtype=np.int64)
+  last  = np.array([utcOffset(h * 3600 + 3599) for h in hours.tolist()],dtype=np.int64)
+  out = epochs + first[inverse]
+  for i in np.where((first != last)[inverse])[0]: out[i] = epochs[i] + utcOffset(int(epochs[i]))
+  return out
 
 class GBData:
   '''This program parses the Green Button XML format of interval meter data
      While the format is carefully structured with different sections
-     and careful namespace use in each'''
-  def __init__(self,gbXMLFile):
-    self.tree = ElementTree.parse(gbXMLFile)
-    self.root = self.tree.getroot()
-    self.parsed = self.dataStructure()
+     and careful namespace use in each.
+     With stream=True the feed is read with iterparse, one entry at a time, and
+     each entry is discarded once its readings have been extracted, so peak memory
+     depends on the largest IntervalBlock rather than the size of the file.
+     No tree is kept in that mode, so tree based methods like summarize() are unavailable.'''
+  def __init__(self,gbXMLFile,stream=False):
+    if stream:
+      self.tree = None
+      self.root = None # set to the (pruned) feed element by streamEntries
+      self.parsed = self.dataStructure(self.streamEntries(gbXMLFile))
+    else:
+      self.tree = ElementTree.parse(gbXMLFile)
+      self.root = self.tree.getroot()
+      self.parsed = self.dataStructure()
 
   # the structure of a feed is to have a single feed
   # with N usage points, with M ReadingBlocks
@@ -40,17 +77,15 @@ class GBData:
   #    ReadingType
   #    IntervalBlock
   #    ElectricPowerUsageSummary
-  def dataStructure(self):
+  def dataStructure(self,entries=None):
     out = {
       'feedType' : None,
       'UsagePoints' : []
     } 
-    out['feedType']  = self.text(self.root,'./{%s}title'     % (ATOM_NS))
-    out['updated']   = self.text(self.root,'./{%s}updated'   % (ATOM_NS))
-    out['published'] = self.text(self.root,'./{%s}published' % (ATOM_NS))
+    if entries is None: entries = self.getEntries(self.root)
     currUsagePoint = None
     currReadingBlock = {}
-    for entry in self.getEntries(self.root):
+    for entry in entries:
       (entryType,instance) = self.entryType(entry)
       if entryType == 'UsagePoint':
         siteName = None
@@ -58,7 +93,7 @@ class GBData:
         if siteNameX is not None: siteName = siteNameX.text
         if currUsagePoint is not None: 
           if len(currReadingBlock) > 0:
-            currUsagePoint['ReadingBlock'].append(currReadingBlock)
+            currUsagePoint['ReadingBlock'].append(self.closeBlock(currReadingBlock))
             currReadingBlock = {}
           out['UsagePoints'].append(currUsagePoint)
         currUsagePoint = {
@@ -71,8 +106,8 @@ class GBData:
         if offset is not None:
           currUsagePoint['tzOffset'] = int(offset.text)
       elif entryType == 'MeterReading':
-        if currReadingBlock.get('readings') is not None: 
-          currUsagePoint['ReadingBlock'].append(currReadingBlock)
+        if currReadingBlock.get('chunks') is not None: 
+          currUsagePoint['ReadingBlock'].append(self.closeBlock(currReadingBlock))
           currReadingBlock = {}
         currReadingBlock = {
           'instance'  : instance,
@@ -96,19 +131,57 @@ class GBData:
         readingsX = entry.findall('.//{%s}IntervalReading' % ESPI_NS)
         # there can be multiple IntervalBlocks that organizes readings in arbitrary groups
         # here we just want to append the newer readings to the existing readings so we get
-        # them all eventually
-        readings = currReadingBlock.get('readings',[(),()]) # default is two len zero tuples
-        newReadings = self.parseReadings(readingsX,currUsagePoint['tzOffset'])
-        readings = [readings[0] + newReadings[0], readings[1] + newReadings[1]] # append new ones
-        currReadingBlock['readingCount'] = len(readings[0])
-        currReadingBlock['readings'] = readings
+        # them all eventually. The chunks are only concatenated once, in closeBlock, to avoid
+        # re-copying everything read so far for every block (i.e. for feeds with one block per day)
+        chunks = currReadingBlock.setdefault('chunks',[])
+        chunks.append(self.parseReadings(readingsX,currUsagePoint['tzOffset']))
       else: print 'ignoring entry: %s %s' % (entryType,instance)
     if currUsagePoint is not None: 
       if len(currReadingBlock) > 0: 
-        currUsagePoint['ReadingBlock'].append(currReadingBlock)
+        currUsagePoint['ReadingBlock'].append(self.closeBlock(currReadingBlock))
       out['UsagePoints'].append(currUsagePoint)
+    # feed level elements are read last because, when streaming, the root
+    # is only complete once all of the entries have gone by
+    out['feedType']  = self.text(self.root,'./{%s}title'     % (ATOM_NS))
+    out['updated']   = self.text(self.root,'./{%s}updated'   % (ATOM_NS))
+    out['published'] = self.text(self.root,'./{%s}published' % (ATOM_NS))
     return out
 
+  # generator over the top level entries of the feed that never holds more than
+  # one entry in memory. Entries nested deeper than the feed's children are left
+  # alone, just like getEntries does.
+  def streamEntries(self,gbXMLFile):
+    entryTag = '{%s}entry' % ATOM_NS
+    depth = 0
+    for (event,node) in ElementTree.iterparse(gbXMLFile,events=('start','end')):
+      if event == 'start':
+        if depth == 0: self.root = node
+        depth += 1
+        continue
+      depth -= 1
+      if depth == 1 and node.tag == entryTag:
+        yield node
+        # the caller is done with this entry, so free it and detach it from the root
+        node.clear()
+        self.root.remove(node)
+
+  # concatenates the reading chunks accumulated for a ReadingBlock into one array per column
+  # and converts the times to local wall clock seconds (see localSeconds)
+  def closeBlock(self,block):
+    chunks = block.pop('chunks',None)
+    if chunks is None: return block
+    for (i,col) in enumerate(READING_COLS):
+      parts = [chunk[i] for chunk in chunks]
+      if col == 'costs':
+        if all([part is None for part in parts]): # costs are optional and rarely provided
+          block[col] = None
+          continue
+        parts = [nanArray(len(chunk[0])) if chunk[i] is None else chunk[i] for chunk in chunks]
+      block[col] = np.concatenate(parts)
+    block['times'] = localSeconds(block['times'])
+    block['readingCount'] = len(block['times'])
+    return block
+
   def text(self,node,path):
     targetNode = node.find(path)
     if targetNode is not None: return targetNode.text
@@ -141,9 +214,15 @@ class GBData:
       return (contentType,'001') # there should be only one, but if there are multiple, this returns the first
     return (None,None)
 
+  # returns a tuple of arrays (times,values,durations,costs) for the readings of one IntervalBlock.
+  # times are unix seconds shifted by the tz offset, values are the raw integer readings,
+  # durations are in seconds (0 if missing) and costs are floats, or None if no reading has one
   def parseReadings(self,readingsX,offset=0):
-    tree = self.tree
-    readings = []
+    n = len(readingsX)
+    starts    = np.empty(n,dtype=np.int64)
+    values    = np.empty(n,dtype=np.int64)
+    durations = np.zeros(n,dtype=np.int64)
+    costs     = None
     #tz = timezone('US/Pacific') 
     # Look for all elements that contain readings. They will be in the form:
     #    <IntervalReading>
@@ -157,19 +236,36 @@ class GBData:
     #        </timePeriod>
     #        <value>703</value>
     #    </IntervalReading>
-    for readingX in readingsX:
-      dStr = readingX.find('.//{%s}timePeriod/{%s}start' % (ESPI_NS,ESPI_NS)).text
-      vStr = readingX.find('./{%s}value' % ESPI_NS).text
+    startPath    = './/{%s}timePeriod/{%s}start'    % (ESPI_NS,ESPI_NS)
+    durationPath = './/{%s}timePeriod/{%s}duration' % (ESPI_NS,ESPI_NS)
+    valuePath    = './{%s}value' % ESPI_NS
+    costPath     = './{%s}cost'  % ESPI_NS
+    for (i,readingX) in enumerate(readingsX):
       # UNIX time is GMT, we currently assume Green Button data is provided in local time
-      date  = dt.datetime.fromtimestamp(int(dStr)-offset)# convert unix time to a date objct
-      #date.replace(tzinfo=tz)
-      watts = int(vStr)
-      readings.append((date,watts))
-    return zip(*readings)
+      starts[i] = int(readingX.findtext(startPath))
+      values[i] = int(readingX.findtext(valuePath))
+      dStr = readingX.findtext(durationPath)
+      if dStr is not None: durations[i] = int(dStr)
+      cStr = readingX.findtext(costPath)
+      if cStr is not None:
+        if costs is None: costs = nanArray(n)
+        costs[i] = float(cStr)
+    return (starts - offset,values,durations,costs)
 
+  # the readings as [dates,values] lists, with dates as naive local datetime objects.
+  # Prefer getReadingsArray, which avoids creating a Python object per reading.
   def getReadings(self,usagePointIdx=0,intervalBlockIdx=0):
-    try: return self.parsed['UsagePoints'][usagePointIdx]['ReadingBlock'][intervalBlockIdx]['readings']
+    arrays = self.getReadingsArray(usagePointIdx,intervalBlockIdx)
+    if arrays is None: return None
+    (times,values) = arrays
+    return [times.astype('datetime64[s]').astype(object).tolist(),values.tolist()]
+
+  # the requested READING_COLS of a ReadingBlock as numpy arrays. times are int64 local
+  # wall clock seconds since 1970 (use times.astype('datetime64[s]') for dates).
+  def getReadingsArray(self,usagePointIdx=0,intervalBlockIdx=0,cols=('times','values')):
+    try: block = self.parsed['UsagePoints'][usagePointIdx]['ReadingBlock'][intervalBlockIdx]
     except IndexError as ie: return None
+    return [block[col] for col in cols]
     
 
   def writeReadings(self,readings,out=None):
@@ -182,7 +278,7 @@ class GBData:
         for row in rows:
           f.write(row + '\n')
 
-  def summarize(self):
+  def summarize(self): # requires the full tree, i.e. stream=False
     title = self.root.find('./{%s}title' % (ATOM_NS))
     if title is not None: print 'Feed: %s' % title.text
     sites = self.getEntries(self.root,'UsagePoint')
@@ -212,8 +308,7 @@ if __name__ == '__main__':
     for usagePoint in gbd.parsed['UsagePoints']:
       print usagePoint['name']
       for block in usagePoint['ReadingBlock']:
-        [dates,rates] = block['readings'] # [dates,rates]
-        print 'interval block [%s] %d obs' % (block['instance'], len(dates))
+        print 'interval block [%s] %d obs' % (block['instance'], block['readingCount'])
     [dates,rates] = gbd.getReadings()
     print dates[0],rates[0]
     
\ No newline at end of file
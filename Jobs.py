@@ -0,0 +1,204 @@
+# Background jobs for work that shouldn't hold up a request, like resolving the weather for
+# an upload. A Job runs a function in its own daemon thread and keeps its result (or the
+# exception it raised) so that other threads can check on it or wait for it. Jobs that make
+# several files, like rendering a report, report each file as it is done through Artifacts,
+# which a JobRegistry keeps by session. Files can be made on demand by whichever thread
+# claims them first. A JobQueue builds whatever is left in the background.
+import sys
+import time
+import Queue
+import threading
+import traceback
+
+class Job(object):
+  '''Runs fn(*args,**kwargs) in a background thread, started on construction.
+     result and error hold the return value or exception once done() is True.'''
+  def __init__(self,name,fn,*args,**kwargs):
+    self.name     = name
+    self.result   = None
+    self.error    = None
+    self.started  = time.time()
+    self.finished = None
+    self.event    = threading.Event()
+    self.thread   = threading.Thread(target=self.run,args=(fn,args,kwargs),name=name)
+    self.thread.daemon = True # don't keep the server alive for a job
+    self.thread.start()
+
+  def run(self,fn,args,kwargs):
+    try: self.result = fn(*args,**kwargs)
+    except Exception as e:
+      self.error = e
+      print 'Job %s failed: %s' % (self.name,e)
+      traceback.print_exc(file=sys.stdout)
+    finally:
+      self.finished = time.time()
+      self.event.set()
+
+  def done(self): return self.event.is_set()
+
+  def wait(self,timeout=None):
+    '''waits up to timeout seconds (forever if None) for the job. Returns True if it is done'''
+    self.event.wait(timeout)
+    return self.done()
+
+  def status(self):
+    if not self.done(): return 'running'
+    if self.error is not None: return 'failed'
+    return 'done'
+
+  def __repr__(self):
+    elapsed = (self.finished or time.time()) - self.started
+    return '<Job %s %s %0.2fs>' % (self.name,self.status(),elapsed)
+
+class Artifacts(object):
+  '''Readiness of each of the files (artifacts) a job produces, i.e. the plots of a report, so each
+     can be used as soon as it is done rather than after the whole job. Waiters block on a condition
+     variable that is notified whenever an artifact is finished or fails, rather than polling.
+     Any thread can make an artifact, after claiming it so that concurrent requests for the same
+     artifact wait for one build. Names that aren't listed are ready (or failed) when the job finishes.
+     onDemand names (i.e. a report few people download) are only made when requested, so finishing
+     the job doesn't fail them and nothing waits for them until they are claimed.'''
+  def __init__(self,names,onDemand=()):
+    self.names    = list(names)
+    self.onDemand = set(onDemand)
+    self.ready    = {}   # name -> seconds after the start that it was ready
+    self.failed   = {}   # name -> error message
+    self.started  = time.time()
+    self.finished = None
+    self.error    = None # error message that ended the job early, if any
+    self.claimed  = set() # names being made
+    self.scheduled = False # True while a background build of everything is queued or running
+    self.cond     = threading.Condition()
+
+  def claim(self,names):
+    '''claims all of names for the calling thread to make, if none of them are ready, failed or claimed
+       already. Returns True if they were claimed, in which case the caller must mark each of them
+       ready or failed (see release). Returns False if there is nothing to do but wait.'''
+    with self.cond:
+      for name in names:
+        if name in self.ready or name in self.failed or name in self.claimed: return False
+      self.claimed.update(names)
+      return True
+
+  def release(self,names,error):
+    '''marks the names not ready yet as failed with error, i.e. claimed names a failed build didn't make'''
+    with self.cond:
+      for name in names:
+        if name not in self.ready and name not in self.failed: self.failed[name] = error
+        self.claimed.discard(name)
+      self.cond.notify_all()
+
+  def markReady(self,name):
+    with self.cond:
+      self.ready[name] = time.time() - self.started
+      self.claimed.discard(name)
+      self.cond.notify_all()
+
+  def markFailed(self,name,error):
+    with self.cond:
+      self.failed[name] = error
+      self.claimed.discard(name)
+      self.cond.notify_all()
+
+  def finish(self,error=None):
+    '''ends the job. Artifacts that aren't ready or being made by now fail with error, other than onDemand ones'''
+    with self.cond:
+      self.finished  = time.time()
+      self.error     = error
+      self.scheduled = False
+      for name in self.names:
+        if name not in self.ready and name not in self.failed and name not in self.claimed and name not in self.onDemand: 
+          self.failed[name] = error or '%s was not produced' % name
+      self.cond.notify_all()
+
+  def done(self,name=None):
+    '''True once name is ready or has failed, or the whole job (for None) has finished. A name being
+       made on demand isn't done when the job finishes, only once it is marked ready or failed'''
+    if name is None: return self.finished is not None
+    if name in self.ready or name in self.failed: return True
+    return self.finished is not None and name not in self.claimed and name not in self.onDemand
+
+  def expected(self,name):
+    '''True if waiting for name can end: it is made or being made, a build of everything is scheduled
+       or the job has finished (see done). False means nothing will make it without a new claim'''
+    with self.cond:
+      if name in self.ready or name in self.failed or name in self.claimed: return True
+      if name in self.onDemand: return False # only made once claimed
+      return self.scheduled or self.finished is not None
+
+  def wait(self,name=None,timeout=None):
+    '''waits up to timeout seconds (forever if None) for name (or the whole job) to be ready or fail.
+       Returns True if it is done. See errorFor'''
+    deadline = None if timeout is None else time.time() + timeout
+    with self.cond:
+      while not self.done(name):
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0: break
+        self.cond.wait(remaining)
+      return self.done(name)
+
+  def errorFor(self,name):
+    '''the error message if name failed (or the job failed before an unlisted name was made), else None'''
+    with self.cond:
+      if name in self.ready: return None
+      return self.failed.get(name,self.error)
+
+  def status(self):
+    '''json friendly summary of the job'''
+    with self.cond:
+      state = 'idle' # nothing being made. The rest is made on demand
+      if self.scheduled or len(self.claimed) > 0: state = 'running'
+      if self.finished is not None: state = 'failed' if self.error is not None else 'done'
+      return {
+        'state'   : state,
+        'elapsed' : (self.finished or time.time()) - self.started,
+        'ready'   : self.ready.copy(),
+        'failed'  : self.failed.copy(),
+        'building': sorted(self.claimed),
+        'pending' : [name for name in self.names if name not in self.ready and name not in self.failed
+                     and (name not in self.onDemand or name in self.claimed)],
+      }
+
+class JobRegistry(object):
+  '''Thread safe map of key (i.e. session id) -> Artifacts of the latest job started for it.
+     Jobs that finished more than maxAge seconds ago are dropped as new ones start.'''
+  def __init__(self,maxAge=4 * 3600):
+    self.maxAge = maxAge
+    self.jobs   = {}
+    self.lock   = threading.Lock()
+
+  def start(self,key,names,onDemand=()):
+    artifacts = Artifacts(names,onDemand)
+    with self.lock:
+      old = [k for (k,job) in self.jobs.items() if job.finished is not None and job.finished < time.time() - self.maxAge]
+      for k in old: del self.jobs[k]
+      self.jobs[key] = artifacts
+    return artifacts
+
+  def get(self,key):
+    with self.lock: return self.jobs.get(key,None)
+
+class JobQueue(object):
+  '''Runs queued functions in the order they were queued with a fixed number of background daemon
+     threads, for work that should only use spare capacity, like building whole reports ahead of
+     time while on demand requests are served by the request threads.'''
+  def __init__(self,name,threads=1):
+    self.name  = name
+    self.queue = Queue.Queue()
+    for i in range(threads):
+      thread = threading.Thread(target=self.work,name='%s %d' % (name,i))
+      thread.daemon = True # don't keep the server alive for queued work
+      thread.start()
+
+  def put(self,fn,*args,**kwargs): self.queue.put((fn,args,kwargs))
+
+  def work(self):
+    while True:
+      (fn,args,kwargs) = self.queue.get()
+      try: fn(*args,**kwargs)
+      except Exception as e:
+        print 'Queued job in %s failed: %s' % (self.name,e)
+        traceback.print_exc(file=sys.stdout)
+      finally: self.queue.task_done()
+
+  def __len__(self): return self.queue.qsize()
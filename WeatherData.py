@@ -10,16 +10,306 @@
 # 4) daily (and optionally hourly and monthly) weather summaries for the appropriate time range
 #    also from these: http://cdo.ncdc.noaa.gov/qclcd_ascii/
 #    Note that the wclcd files are monthly and therefore requests will span several.
+# 5) the daily and hourly data of each monthly zip is converted once into binary, station indexed
+#    stores (see ColumnarStore) so station lookups don't have to re-read the national files
+# 6) alternatively, daily max and min temperatures from the GHCN-Daily by_year files with the
+#    stations in weather/ghcnd-US-stations.txt. See GHCNData
 import csv
+import gzip
 import os
-import urllib
+import shutil
+import urllib2
 import zipfile
 import numpy
 import datetime
 import math
+import threading
+from multiprocessing.pool import ThreadPool
+from scipy.spatial import cKDTree
+
+import DataCache
+
+EARTH_RADIUS_KM = 6367 # as used by distLatLon
+
+# unit vectors on the sphere for arrays of lat/lon in decimal degrees
+def unitVectors(lat,lon):
+  (lat,lon) = (numpy.radians(lat),numpy.radians(lon))
+  return numpy.column_stack((numpy.cos(lat) * numpy.cos(lon),numpy.cos(lat) * numpy.sin(lon),numpy.sin(lat)))
+
+class StationIndex(object):
+  '''KD-tree over the 3-D unit vectors of the weather stations in a monthly station file, for
+     vectorized nearest station queries. Straight line (chord) distance between unit vectors
+     increases with great circle distance, so the nearest by chord are the nearest on the ground.
+     latCol and lonCol are the columns of the station rows with the latitude and longitude.
+     An index of no stations has a len of 0 and can't be queried.'''
+  def __init__(self,stations,latCol=9,lonCol=10):
+    self.WBANs   = []
+    self.details = []
+    latLon = []
+    for stationRow in stations:
+      try:
+        latLon.append((float(stationRow[latCol]),float(stationRow[lonCol])))
+        self.WBANs.append(stationRow[0])
+        self.details.append(stationRow[1:]) # details in case we are interested not strictly necessary
+      except: 
+        print 'bad station data'
+        print stationRow
+    latLon = numpy.array(latLon,dtype=float).reshape(-1,2)
+    self.tree = None # cKDTree can't be built without points. See __len__
+    if len(latLon) > 0: self.tree = cKDTree(unitVectors(latLon[:,0],latLon[:,1]))
+
+  def __len__(self): return len(self.WBANs)
+
+  def nearest(self,lat,lon,n=1):
+    '''(indices,km) arrays of the n closest stations to lat/lon (scalars or arrays), closest first'''
+    n = min(n,len(self))
+    points = unitVectors(lat,lon)
+    if numpy.ndim(lat) == 0: points = points[0] # a single point
+    (chord,idx) = self.tree.query(points,k=n)
+    km = 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(chord / 2,1)) # chord to great circle distance
+    return (idx,km)
+
+# StationIndex instances are shared across WeatherData instances (one is created per request)
+# keyed by the station data file and its modification time, so a re-downloaded file is re-indexed.
+# Rankings of the closest stations to each zip code are memoized the same way, for the most
+# recently used MAX_RANKINGS zip code and month pairs.
+MAX_RANKINGS = 20000
+STATION_INDEXES  = {} # (weather zip path,mtime) -> StationIndex
+STATION_RANKINGS = DataCache.LRUCache(MAX_RANKINGS) # (weather zip path,mtime,zip5,n) -> stationList output, 1 'byte' each
+STATION_LOCK = threading.Lock()
+
+class ColumnarStore(object):
+  '''Binary, station indexed copy of a table of weather data, i.e. a month of QCLCD daily data, with
+     one memory mapped array per column, so reading the dates and temperatures of a station only
+     touches the pages of those two columns. Rows are sorted by station and then date (or time).
+     Tables read from text (see build) keep every source column as a fixed width string array
+     (f0, f1, ...) plus numeric columns: date (int YYYYMMDD) and one float column per entry of
+     numeric (nan if missing). A small index holds the first and last+1 row of each station, so
+     the rows of a station are found with a binary search and are a contiguous slice of every
+     column. Files are path.cols.npz (the index, the column names and the source's headers) and
+     path.v<version>/<column>.npy. A rebuild writes a new version and then replaces the index, so
+     readers never see a partially written store. See openStore for the shared instances.'''
+  def __init__(self,path):
+    self.path = path
+    for attempt in range(2): # an index replaced between reading it and its columns is read again
+      idx = numpy.load(path + '.cols.npz')
+      try:
+        self.stations = idx['stations']
+        self.starts   = idx['starts']
+        self.stops    = idx['stops']
+        self.headers  = idx['headers'].tolist()
+        self.names    = idx['names'].tolist()
+        colDir        = ColumnarStore.columnDir(path,str(idx['version']))
+      finally: idx.close()
+      try:
+        self.columns = dict((name,numpy.load(os.path.join(colDir,name + '.npy'),mmap_mode='r')) for name in self.names)
+        break
+      except IOError:
+        if attempt > 0: raise
+
+  def __len__(self): return len(self.columns[self.names[0]])
+
+  @staticmethod
+  def exists(path): return os.path.isfile(path + '.cols.npz')
+
+  @staticmethod
+  def mtime(path): return os.path.getmtime(path + '.cols.npz')
+
+  @staticmethod
+  def columnDir(path,version): return '%s.v%s' % (path,version)
+
+  @staticmethod
+  def build(path,headers,rows,numeric):
+    '''writes the store for rows (lists of strings, with the station in column 0 and a YYYYMMDD date
+       in column 1) to path. numeric is a sequence of (column name,column) to also store as floats.'''
+    nCols = len(headers)
+    rows = [row + [''] * (nCols - len(row)) for row in rows if len(row) > 0]
+    columns = {}
+    for i in range(nCols):
+      col = [row[i] for row in rows]
+      columns['f%d' % i] = numpy.array(col,dtype='S%d' % max([len(val) for val in col] + [1]))
+    columns['date'] = numpy.array([int(floatParse(row[1],0)) for row in rows],dtype=numpy.int32)
+    for (name,i) in numeric: columns[name] = numpy.array([floatParse(row[i]) for row in rows],dtype=numpy.float32)
+    ColumnarStore.write(path,columns,headers,'f0','date')
+
+  @staticmethod
+  def write(path,columns,headers=(),station='f0',order='date'):
+    '''writes the store of columns (a dict of name -> equal length arrays) to path, with the rows
+       sorted by the station column and then the order column'''
+    sort = numpy.lexsort((columns[order],columns[station]))
+    columns = dict((name,numpy.asarray(col)[sort]) for (name,col) in columns.items())
+    (stations,starts) = numpy.unique(columns[station],return_index=True)
+    stops = numpy.append(starts[1:],len(sort))[0:len(starts)].astype(starts.dtype) # none for an empty table
+    pid = '%d.%d' % (os.getpid(),threading.current_thread().ident)
+    version = '%d.%s' % (int(time.time() * 1000),pid)
+    colDir = ColumnarStore.columnDir(path,version)
+    os.makedirs(colDir)
+    for (name,col) in columns.items(): numpy.save(os.path.join(colDir,name + '.npy'),col)
+    numpy.savez(path + '.cols.%s.tmp.npz' % pid,stations=stations,starts=starts,stops=stops,
+                headers=numpy.array(list(headers)),names=numpy.array(sorted(columns)),version=numpy.array(version))
+    if os.name == 'nt' and ColumnarStore.exists(path): os.remove(path + '.cols.npz') # no atomic replace on windows
+    os.rename(path + '.cols.%s.tmp.npz' % pid,path + '.cols.npz') # the new version is live
+    # older versions are removed. Open instances keep their memory maps (except on windows, where removal fails)
+    parent = os.path.dirname(path) or '.'
+    prefix = os.path.basename(ColumnarStore.columnDir(path,''))
+    for other in os.listdir(parent):
+      otherPath = os.path.join(parent,other)
+      if other.startswith(prefix) and otherPath != colDir and os.path.isdir(otherPath): shutil.rmtree(otherPath,ignore_errors=True)
+
+  def slice(self,station):
+    '''dict of column name -> the (memory mapped) values of station, sorted by date. Empty if there are none'''
+    i = numpy.searchsorted(self.stations,station)
+    if i == len(self.stations) or self.stations[i] != station: (start,stop) = (0,0)
+    else: (start,stop) = (self.starts[i],self.stops[i])
+    return dict((name,col[start:stop]) for (name,col) in self.columns.items())
+
+  def rows(self,columns,subset=None):
+    '''columns (all of them or a slice) as lists of strings, like the rows of the source, optionally
+       just the columns in subset'''
+    if subset is None: subset = range(len(self.headers))
+    return [list(row) for row in zip(*[columns['f%d' % i].tolist() for i in subset])]
+
+STORES = {} # (store path,mtime) -> ColumnarStore, shared like STATION_INDEXES
+STORE_LOCKS = {} # store path -> lock held while checking for, building or opening that store
+STORE_LOCK = threading.Lock() # guards STORES and STORE_LOCKS
+
+def storeLock(path):
+  with STORE_LOCK:
+    lock = STORE_LOCKS.get(path,None)
+    if lock is None:
+      lock = threading.Lock()
+      STORE_LOCKS[path] = lock
+  return lock
+
+def openStore(path):
+  '''the shared ColumnarStore for path, opened once per version of the store. Call with storeLock(path) held'''
+  key = (path,ColumnarStore.mtime(path))
+  with STORE_LOCK: store = STORES.get(key,None)
+  if store is None:
+    store = ColumnarStore(path)
+    with STORE_LOCK:
+      for oldKey in [k for k in STORES if k[0] == path]: del STORES[oldKey]
+      STORES[key] = store
+  return store
+
+QCLCD_NUMERIC = (('tmax',2),('tmin',4),('tavg',6)) # numeric columns of QCLCD daily data
+QCLCD_HOURLY_NUMERIC = (('drybulb',10),) # numeric columns of QCLCD hourly data kept in the hourly stores
+MAX_HOURLY_GAP    = 3*3600  # hourly observations further apart than this (seconds) aren't interpolated between
+
+class ZipGeocoder(object):
+  '''Read only, dict like map of int zip codes to (lat,lon), backed by sorted int32 zip and
+     float32 lat/lon arrays (plus whether each zip observes daylight saving time, see observesDst),
+     so lookups are binary searches. The arrays are read from a binary
+     copy of the zip code csv (zipFile with .npy for .csv), written the first time it is needed
+     and memory mapped, so processes share its pages. Use zipGeocoder() for the shared instance.'''
+  def __init__(self,zipFile):
+    binFile = os.path.splitext(zipFile)[0] + '.npy'
+    self.records = None
+    if os.path.isfile(binFile) and os.path.getmtime(binFile) >= os.path.getmtime(zipFile):
+      self.records = numpy.load(binFile,mmap_mode='r')
+    if self.records is None:
+      self.records = self.build(zipFile)
+      try:
+        tmpFile = '%s.%d.%d.tmp.npy' % (binFile,os.getpid(),threading.current_thread().ident)
+        numpy.save(tmpFile,self.records)
+        os.rename(tmpFile,binFile)
+      except (IOError,OSError) as e: # the in memory copy works, it just isn't shared
+        print 'Warning: could not write zip code cache %s: %s' % (binFile,e)
+    self.zips = self.records['zip']
+    print 'Zip to lat/long lookup initialized with %d entries' % len(self.zips)
+
+  @staticmethod
+  def build(zipFile):
+    # ['zip', 'city', 'state', 'latitude', 'longitude', 'timezone', 'dst']
+    with open(zipFile,'rb') as f:
+      fReader = csv.reader(f)
+      fReader.next() # headers
+      # a missing dst flag is taken as observing it, like most of the US
+      zipList = [(int(row[0]),float(row[3]),float(row[4]),row[6:7] != ['0']) for row in fReader if len(row) > 0]
+    records = numpy.array(zipList,dtype=[('zip',numpy.int32),('lat',numpy.float32),('lon',numpy.float32),('dst',numpy.bool_)])
+    records = records[numpy.argsort(records['zip'],kind='mergesort')]
+    last = numpy.append(records['zip'][1:] != records['zip'][:-1],True) # later rows win, like a dict
+    return records[last]
+
+  def index(self,zip5):
+    i = numpy.searchsorted(self.zips,zip5)
+    if i < len(self.zips) and self.zips[i] == zip5: return i
+    return None
+
+  def get(self,zip5,default=None):
+    i = self.index(int(zip5))
+    if i is None: return default
+    return (float(self.records['lat'][i]),float(self.records['lon'][i]))
+
+  def __getitem__(self,zip5):
+    latLon = self.get(zip5)
+    if latLon is None: raise KeyError(zip5)
+    return latLon
+
+  def __contains__(self,zip5): return self.index(int(zip5)) is not None
+
+  def observesDst(self,zip5):
+    '''False for zip codes known not to observe daylight saving time (i.e. most of Arizona and Hawaii)'''
+    i = self.index(int(zip5))
+    return i is None or bool(self.records['dst'][i])
+
+  def __len__(self): return len(self.zips)
+
+# Quality controlled local hourly, daily, monthly weather for the whole US from NOAA.
+# Can be pointed elsewhere, i.e. a local mirror or a test server. See WeatherData
+QCLCD_BASE_URL = 'http://cdo.ncdc.noaa.gov/qclcd_ascii/'
+FETCH_THREADS  = 4  # max concurrent weather downloads (per process)
+FETCH_LOCKS = {}    # file path -> lock held while checking for and downloading that file
+FETCH_LOCK  = threading.Lock() # guards FETCH_LOCKS and FETCH_POOL
+FETCH_POOL  = None  # ThreadPool for prefetching, created on first use
+
+def fetchLock(filePath):
+  with FETCH_LOCK:
+    lock = FETCH_LOCKS.get(filePath,None)
+    if lock is None:
+      lock = threading.Lock()
+      FETCH_LOCKS[filePath] = lock
+  return lock
+
+def fetchPool():
+  global FETCH_POOL
+  with FETCH_LOCK:
+    if FETCH_POOL is None: FETCH_POOL = ThreadPool(FETCH_THREADS)
+  return FETCH_POOL
+
+def isGzip(filePath):
+  with open(filePath,'rb') as f: return f.read(2) == '\x1f\x8b'
+
+def download(url,filePath,isValid=zipfile.is_zipfile):
+  '''downloads url to a temp file next to filePath and renames it into place once it is complete
+     and isValid (a zip file by default), so readers never see a partial download. Raises IOError on failure.'''
+  tmpPath = '%s.%d.%d.tmp' % (filePath,os.getpid(),threading.current_thread().ident)
+  try:
+    response = urllib2.urlopen(url,timeout=60)
+    try:
+      with open(tmpPath,'wb') as f: shutil.copyfileobj(response,f,2**16)
+    finally: response.close()
+    if not isValid(tmpPath): raise IOError('%s is not a valid download (%s failed)' % (url,isValid.__name__))
+    if os.name == 'nt' and os.path.isfile(filePath): os.remove(filePath) # no atomic replace on windows
+    os.rename(tmpPath,filePath)
+  finally:
+    if os.path.isfile(tmpPath): os.remove(tmpPath)
+
+GEOCODERS = {} # zip file path -> ZipGeocoder
+GEOCODER_LOCK = threading.Lock()
+
+def zipGeocoder(zipFile):
+  '''the process wide ZipGeocoder for zipFile, created on first use'''
+  path = os.path.abspath(zipFile)
+  with GEOCODER_LOCK:
+    geocoder = GEOCODERS.get(path,None)
+    if geocoder is None:
+      geocoder = ZipGeocoder(path)
+      GEOCODERS[path] = geocoder
+  return geocoder
 
 class WeatherData(object):
-  def __init__(self,dataDir):
+  def __init__(self,dataDir,baseUrl=None):
     self.ZIP_MAP = None # lazy init later. See zipMap
 
     self.DATA_DIR = dataDir
@@ -27,7 +317,7 @@ class WeatherData(object):
                                                           # list of historic through current WBAN stations
     self.ZIP5_FILE = os.path.join(dataDir,'Erle_zipcodes.csv')    # Zip codes with lat/lon from about 2004
                                                                   # see http://jeffreybreen.wordpress.com/2010/12/11/geocode-zip-codes/
-    self.NOAA_QCLCD_DATA_DIR = 'http://cdo.ncdc.noaa.gov/qclcd_ascii/'  # Quality controlled local hourly, daily, monthly weather
+    self.NOAA_QCLCD_DATA_DIR = baseUrl or QCLCD_BASE_URL                # Quality controlled local hourly, daily, monthly weather
                                                                         # for the whole US from NOAA. Downloaded 1 month at a time
                                                                         # also contains a station information file.
                                                                         # Naming convention: QCLCD201103.zip
@@ -40,14 +330,9 @@ class WeatherData(object):
   def hourlyFile(self,year,month):  return '%s%02dhourly.txt'  % (year,month) # file from within weatherZip
   
   
+  # dict like zip5 -> (lat,lon) lookup, shared by all WeatherData instances. See ZipGeocoder
   def zipMap(self):
-    if(self.ZIP_MAP is None): 
-      # ['zip', 'city', 'state', 'latitude', 'longitude', 'timezone', 'dst']
-      zipList = self.csvData(self.ZIP5_FILE,skip=1)
-      self.ZIP_MAP = {}
-      for zipRow in zipList:
-        self.ZIP_MAP[int(zipRow[0])] = (float(zipRow[3]),float(zipRow[4]))
-      print 'Zip to lat/long lookup initialized with %d entries' % len(self.ZIP_MAP)
+    if(self.ZIP_MAP is None): self.ZIP_MAP = zipGeocoder(self.ZIP5_FILE)
     return self.ZIP_MAP
 
   # daily data cols
@@ -68,19 +353,30 @@ class WeatherData(object):
 
   # also available: monthly, precip, and remarks
   # checks for file's existence. If not present, downloads and then returns.
-  # Note that this will take a while and it is not thread safe in that another. 
-  # thread might reproduce the download efforts. So it probably shouldn't
-  # be run in the main stream of the code. On the other hand, urlretrieve will
-  # probably touch the file in question fairly quickly, and after that others will
-  # get read only access to the partial file.
+  # Note that this will take a while, so it probably shouldn't be run in the main 
+  # stream of the code. See prefetch. Checks and downloads hold a per file lock, so
+  # concurrent requests for the same month wait for a single download, and files are
+  # renamed into place once complete, so they are never read partially written.
   def confirmedWeatherZip(self,year,month):
-    retrieveFile = False
     filePath = self.weatherZip(year,month)
+    if not self.needsDownload(year,month,filePath): return filePath # the usual case. No need to lock
+    with fetchLock(os.path.abspath(filePath)):
+      if self.needsDownload(year,month,filePath): # unless another thread just got it
+        url = self.weatherUrl(year,month)
+        print "%s not found. Attempting download at %s" % (filePath,url)
+        try: download(url,filePath)
+        except IOError as e:
+          if not os.path.isfile(filePath): raise
+          print 'Warning: could not refresh %s (%s). Using the existing file' % (filePath,e)
+    return filePath
+
+  def needsDownload(self,year,month,filePath):
+    retrieveFile = False
     if os.path.isfile(filePath):
       now      = datetime.datetime.now()
       # empirically, definitive weather files seem to be posted by the 5th or 6th of the next month
       # however, this could result in excessive file downloads. This code should keep it to once a day, 
-      # but there are threa safety issues as well as excessive wait times to consider. 
+      # but there are excessive wait times to consider. 
       # We might need to store the modification  time of the file on the server
       postYear  = year
       postMonth = (month + 1) % 13
@@ -93,13 +389,20 @@ class WeatherData(object):
         if now.date() == modTime.date(): pass # we've already dl'd the file today
         else: retrieveFile = True
     else: retrieveFile = True
-    if  retrieveFile: # download it and raise exception on failure
-      # TODO: do more to protect against race conditions. File lock?
-      url = self.weatherUrl(year,month)
-      print "%s not found. Attempting download at %s" % (filePath,url)
-      urllib.urlretrieve(url,filePath)
-      
-    return filePath
+    return retrieveFile
+
+  # downloads (as needed) the weather files for all the months from start to end in parallel, using
+  # the shared pool of FETCH_THREADS threads. With wait, returns a list with the file path or the
+  # exception raised for each month. Otherwise returns immediately with the pool's AsyncResult.
+  def prefetch(self,start,end,wait=True):
+    def fetch(month):
+      try: return self.confirmedWeatherZip(*month)
+      except Exception as e:
+        print 'Warning: weather download for %d/%d failed: %s' % (month[1],month[0],e)
+        return e
+    result = fetchPool().map_async(fetch,monthRange(start,end))
+    if not wait: return result
+    return result.get()
     
   def csvData(self,filePath,delim=',',colVal=None,subset=None,skip=0):
     with open(filePath,'rb') as f:
@@ -134,9 +437,90 @@ class WeatherData(object):
     finally: zf.close()
 
   def stationData(self,y,m,colVal=None,subset=None,skip=0): return self.zippedData(self.confirmedWeatherZip(y,m),self.stationFile(y,m),'|',colVal,subset,skip)
-  def dailyData(self,y,m,colVal=None,subset=None,skip=0):   return self.zippedData(self.confirmedWeatherZip(y,m),self.dailyFile(y,m),',',colVal,subset,skip)
   def hourlyData(self,y,m,colVal=None,subset=None,skip=0):  return self.zippedData(self.confirmedWeatherZip(y,m),self.hourlyFile(y,m),',',colVal,subset,skip)
 
+  # daily data comes from a columnar copy of the zip's daily file (see dailyStore). Filtering by
+  # WBAN (colVal=(0,wban)) is then a binary search and a slice. Other filters and skipping more
+  # than the header row fall back to reading the zip.
+  def dailyData(self,y,m,colVal=None,subset=None,skip=0):
+    if skip > 1 or (colVal is not None and colVal[0] != 0): 
+      return self.zippedData(self.confirmedWeatherZip(y,m),self.dailyFile(y,m),',',colVal,subset,skip)
+    store = self.dailyStore(y,m)
+    if colVal is not None: return store.rows(store.slice(colVal[1]),subset)
+    rows = store.rows(store.columns,subset)
+    if skip == 0: rows.insert(0,[store.headers[i] for i in (subset or range(len(store.headers)))])
+    return rows
+
+  def dailyStorePath(self,year,month): return os.path.join(self.DATA_DIR,'QCLCD%s%02ddaily' % (year,month))
+
+  # the ColumnarStore of the daily data for y/m, built from the zip the first time it is needed
+  # and rebuilt whenever the zip is newer than the store
+  def dailyStore(self,y,m):
+    zipPath = self.confirmedWeatherZip(y,m)
+    path = os.path.abspath(self.dailyStorePath(y,m))
+    with storeLock(path): # other months build concurrently
+      if not ColumnarStore.exists(path) or ColumnarStore.mtime(path) < os.path.getmtime(zipPath):
+        print 'Building daily weather store %s' % path
+        rows = self.zippedData(zipPath,self.dailyFile(y,m))
+        ColumnarStore.build(path,rows[0],rows[1:],QCLCD_NUMERIC)
+      return openStore(path)
+
+  def hourlyStorePath(self,year,month): return os.path.join(self.DATA_DIR,'QCLCD%s%02dhourly' % (year,month))
+
+  # the ColumnarStore of the hourly data for y/m (station, time and QCLCD_HOURLY_NUMERIC columns),
+  # built like dailyStore. The national hourly file is read once per month rather than per station
+  def hourlyStore(self,y,m):
+    zipPath = self.confirmedWeatherZip(y,m)
+    path = os.path.abspath(self.hourlyStorePath(y,m))
+    with storeLock(path):
+      if not ColumnarStore.exists(path) or ColumnarStore.mtime(path) < os.path.getmtime(zipPath):
+        print 'Building hourly weather store %s' % path
+        ColumnarStore.write(path,self.hourlyColumns(zipPath,y,m),station='station',order='time')
+      return openStore(path)
+
+  def hourlyColumns(self,zipPath,y,m):
+    '''dict of station (WBAN), time (int64 local standard time seconds since 1970) and
+       QCLCD_HOURLY_NUMERIC column arrays (nan if missing) from one streamed pass over the hourly file'''
+    lastCol = max([col for (name,col) in QCLCD_HOURLY_NUMERIC])
+    (stations,dates,hhmm) = ([],[],[])
+    values = [[] for entry in QCLCD_HOURLY_NUMERIC]
+    zf = zipfile.ZipFile(zipPath,'r')
+    try:
+      f = zf.open(self.hourlyFile(y,m))
+      f.readline() # headers
+      for line in f:
+        row = line.split(',',lastCol + 1) # the columns after lastCol aren't split
+        if len(row) <= lastCol or not row[1].isdigit() or not row[2].isdigit(): continue
+        stations.append(row[0])
+        dates.append(row[1])
+        hhmm.append(row[2])
+        for (i,(name,col)) in enumerate(QCLCD_HOURLY_NUMERIC): values[i].append(row[col])
+    finally: zf.close()
+    hhmm = numpy.array(hhmm,dtype=numpy.int64)
+    columns = {'station': numpy.array(stations,dtype='S%d' % max([len(s) for s in stations] + [1])),
+               'time'   : yyyymmddToDays(numpy.array(dates,dtype=numpy.int64)).astype(numpy.int64) * 86400 + (hhmm // 100) * 3600 + (hhmm % 100) * 60}
+    for (i,(name,col)) in enumerate(QCLCD_HOURLY_NUMERIC): columns[name] = numpy.array([floatParse(x) for x in values[i]],dtype=numpy.float32)
+    return columns
+
+  def dailyArray(self,y,m,wban,col='tavg'):
+    '''(dates,values) numpy arrays of the daily values of col (tmax, tmin or tavg) for wban in y/m.
+       dates are YYYYMMDD ints and missing values are nan'''
+    records = self.dailyStore(y,m).slice(wban)
+    return (numpy.array(records['date']),numpy.array(records[col],dtype=float))
+
+  def hourlyArray(self,y,m,wban,col='drybulb'):
+    '''(times,values) numpy arrays of the hourly observations of col (see QCLCD_HOURLY_NUMERIC) for wban
+       in y/m, sorted by time. times are int64 local standard time seconds since 1970 and missing values
+       are nan. See hourlyStore'''
+    columns = self.hourlyStore(y,m).slice(wban)
+    return (numpy.array(columns['time']),numpy.array(columns[col],dtype=float))
+
+  def stationSeries(self,wban,start,end,col='tavg'):
+    '''(dates,values) like dailyArray for wban over all of the months from start to end'''
+    parts = [self.dailyArray(year,mon,wban,col) for (year,mon) in monthRange(start,end)]
+    return (numpy.concatenate([p[0] for p in parts] or [numpy.zeros(0,dtype=numpy.int32)]),
+            numpy.concatenate([p[1] for p in parts] or [numpy.zeros(0)]))
+
   
   # Calculate the distance between two lat/lon locations using the Haversine formula
   def distLatLon(self,lat1,lon1,lat2,lon2):
@@ -161,45 +545,46 @@ class WeatherData(object):
   def closestWBAN(self,zip5,y,m,rnk=0):
     return self.stationList(zip5,y,m,n=1)[rnk]
 
+  # the StationIndex for the station file of y/m, built once per file (see STATION_INDEXES)
+  # or None if there is no station data
+  def stationIndex(self,y,m):
+    filePath = self.confirmedWeatherZip(y,m)
+    key = (os.path.abspath(filePath),os.path.getmtime(filePath))
+    with STATION_LOCK: index = STATION_INDEXES.get(key,None)
+    if index is None:
+      #with Timer('stations'): # this next line takes about 0.038 to run
+      stations = self.stationData(y,m,skip=1)
+      index = StationIndex(stations)
+      with STATION_LOCK:
+        for oldKey in [k for k in STATION_INDEXES if k[0] == key[0]]: del STATION_INDEXES[oldKey] # stale versions of the file
+        STATION_INDEXES[key] = index
+    if len(index) == 0: return None
+    return index
+
   def stationList(self,zip5,y,m,n=1): # returns the details for the n closest stations to zip5
     if type(zip5) is not int: zip5 = int(zip5)
+    filePath = self.confirmedWeatherZip(y,m)
+    memoKey = (os.path.abspath(filePath),os.path.getmtime(filePath),zip5,n)
+    bestList = STATION_RANKINGS.get(memoKey,None)
+    if bestList is not None: return list(bestList)
     zips  = self.zipMap()
-    #with Timer('stations'): # this next line takes about 0.038 to run
-    stations = self.stationData(y,m,skip=1)
-    if len(stations) == 0: 
+    index = self.stationIndex(y,m)
+    if index is None: 
       print "Warning: no station data for %d/%d, so closest WBAN not found" % (m,y)
       return None # this could be the result of a bad weather file, or just the beginning of the month
-    stationMap    = {}
-    stationLatLon = {}
-    #with Timer('stations'): this code takes about 0.017 to run
-    for stationRow in stations:
-      try:
-        stationLatLon[stationRow[0]] = (float(stationRow[9]),float(stationRow[10]))
-        stationMap[stationRow[0]] = stationRow[1:] # details in case we are interested not strictly necessary
-      except: 
-        print 'bad station data'
-        print stationRow
-    WBANs = []
-    dist = []
-    for key in stationLatLon:
-      WBANs.append(key)
-      dist.append( self.distLatLon( *(zips[zip5] + stationLatLon[key]) ) )
-    # get indices of distances in rank order, so we can look at the top N
-    rank = sorted(range(len(dist)), key=dist.__getitem__) # sorts the first by the second
-    print(rank[0:10])
+    (lat,lon) = zips[zip5]
+    (idx,km) = index.nearest(lat,lon,n)
+    (idx,km) = (numpy.atleast_1d(idx),numpy.atleast_1d(km))
     warnDist = 15 # km
     bestList = []
-    for rnk in range(n):
-      wban = WBANs[rank[rnk]]
-      if (rnk == 0 and dist[rank[rnk]] > warnDist): print 'WARNING. Closest weather station to %s (WBAN %s) is %0.2fkm away %s' % (zip5,wban,dist[rank[rnk]],str(stationMap[ wban ] ))
-      #print([dist[i] for i in rank[0:10]]) # top ten distances
-      #print([WBANs[i] for i in rank[0:10]]) # top ten stations
-      #print stationMap[bestWBAN] # station details
-      
-      entry = [wban,dist[rank[rnk]]]
-      entry.extend(stationMap[wban])
+    for rnk in range(len(idx)):
+      wban = index.WBANs[idx[rnk]]
+      if (rnk == 0 and km[rnk] > warnDist): print 'WARNING. Closest weather station to %s (WBAN %s) is %0.2fkm away %s' % (zip5,wban,km[rnk],str(index.details[idx[rnk]]))
+      entry = [wban,float(km[rnk])]
+      entry.extend(index.details[idx[rnk]])
       bestList.append(entry)
-    return bestList
+    STATION_RANKINGS.put(memoKey,bestList,1)
+    return list(bestList)
   
   # return daily weather data for the zip code and month in question
   def weatherMonth(self,zip5,y,m,subset=[0,1,2,4,6]): # cols for WBAN,date,tmax,tmin,tavg
@@ -219,50 +604,256 @@ class WeatherData(object):
     return weather
 
   def weatherRange(self,zip5,start,end,subset=[0,1,2,4,6]): # cols for WBAN,date,tmax,tmin,tavg
+    self.prefetch(start,end) # get all the months downloading at once
     weather = []
-    for year in range(start.year,end.year+1):
-      sMon = 1
-      eMon = 12
-      if year == start.year: sMon = start.month
-      if year == end.year:   eMon = end.month
-      for mon in range(sMon,eMon+1):
-        #with Timer('weatherMonth'): # each month takes about 1.5-1.6 seconds
-        print year,mon
-        weather.extend(self.weatherMonth(zip5,year,mon,subset))
+    for (year,mon) in monthRange(start,end):
+      #with Timer('weatherMonth'): # each month takes about 1.5-1.6 seconds
+      weather.extend(self.weatherMonth(zip5,year,mon,subset))
     return weather
 
-  # get the touts for the dates passed in
+  # numeric version of weatherMonth: (dates,values) arrays of YYYYMMDD ints and col (tmax, tmin
+  # or tavg) of the closest of the 5 nearest stations to zip5 that has data for y/m
+  def weatherMonthArray(self,zip5,y,m,col='tavg'):
+    stationList = self.stationList(zip5,y,m,5)
+    for cWB in (stationList or []):
+      (dates,values) = self.dailyArray(y,m,cWB[0],col)
+      if len(dates) > 0: return (dates,values) # otherwise try again because the current station has no data
+    return (numpy.zeros(0,dtype=numpy.int32),numpy.zeros(0))
+
+  # numeric version of weatherRange: (dates,values) with dates as datetime64[D], sorted
+  def weatherRangeArray(self,zip5,start,end,col='tavg'):
+    self.prefetch(start,end) # get all the months downloading at once
+    parts = [self.weatherMonthArray(zip5,year,mon,col) for (year,mon) in monthRange(start,end)]
+    dates  = numpy.concatenate([p[0] for p in parts])
+    values = numpy.concatenate([p[1] for p in parts])
+    return (yyyymmddToDays(dates),values)
+
+  # hourly version of weatherMonthArray, for the closest station with hourly data for col in y/m
+  def hourlyMonthArray(self,zip5,y,m,col='drybulb'):
+    stationList = self.stationList(zip5,y,m,5)
+    for cWB in (stationList or []):
+      (times,values) = self.hourlyArray(y,m,cWB[0],col)
+      if numpy.isfinite(values).any(): return (times,values)
+    return (numpy.zeros(0,dtype=numpy.int64),numpy.zeros(0))
+
+  # hourly version of weatherRangeArray: (times,values) with times as int64 seconds since 1970
+  def hourlyRangeArray(self,zip5,start,end,col='drybulb'):
+    self.prefetch(start,end)
+    parts = [self.hourlyMonthArray(zip5,year,mon,col) for (year,mon) in monthRange(start,end)]
+    return (numpy.concatenate([p[0] for p in parts]),numpy.concatenate([p[1] for p in parts]))
+
+  # the hourly outside temperature interpolated onto times (an int64 array of local wall clock seconds
+  # since 1970 or a datetime64 array, of any shape). Returns a float array the shape of times with nans
+  # where there are no observations close enough to interpolate from (see interpolateTimes).
+  # QCLCD times are local standard time, so times are converted to standard time for zip codes
+  # that observe daylight saving time.
+  def matchHourly(self,times,zip5):
+    times = asSeconds(times)
+    if self.zipMap().observesDst(zip5): times = wallToStandard(times)
+    (start,end) = [datetime.datetime.utcfromtimestamp(t).date() for t in (times.min(),times.max())]
+    (wTimes,tout) = self.hourlyRangeArray(zip5,start,end)
+    return interpolateTimes(times,wTimes,tout)
+
+  # heating and cooling degree-hours (see dailyDegreeHours) for the dates passed in. Returns (hdh,cdh)
+  # float arrays with nans for dates without a full day of hourly data
+  def matchDegreeHours(self,dates,zip5,heatBase=65.0,coolBase=65.0):
+    days = asDays(dates)
+    (wTimes,tout) = self.hourlyRangeArray(zip5,days.min().astype(object),days.max().astype(object))
+    (wDays,hdh,cdh) = dailyDegreeHours(wTimes,tout,heatBase,coolBase,dst=self.zipMap().observesDst(zip5))
+    return (alignDays(days,wDays,hdh),alignDays(days,wDays,cdh))
+
+  # get the touts for the dates passed in. Returns (dates,tout) where dates are the dates passed
+  # in as datetime.date objects and tout is a float array of the mean temperature on each, with
+  # nans for dates without weather data
   def matchWeather(self,dates,zip5):
-    if type(dates[0]) == datetime.datetime:
-      dates = [x.date() for x in dates] # this thing runs of datetime.date objects
-    start = dates[0]
-    end = dates[-1]
-    weather = self.weatherRange(zip5,start,end,[1,6])
-    wa = numpy.array(weather)
-    wDates = [datetime.datetime.strptime(dateStr,'%Y%m%d').date() for dateStr in wa[:,0]]
-    tout   = [floatParse(x) for x in wa[:,1]]
-    md = self.matchDates(dates,wDates) # get the indices for matching dates for both arrays (md[0] is dates and md[1] is wDates
-    matches = [numpy.nan] * len(dates) # populate an empty array
-    for i in range(len(md[0])):   
-      matches[md[0][i]] = tout[md[1][i]] # fill in just the values for which the dates match, at the locations of the first date argument
-    return (dates,matches)
-
-  # find the indices for each list where they share the same values
+    days = asDays(dates)
+    (wDates,tout) = self.weatherRangeArray(zip5,days.min().astype(object),days.max().astype(object))
+    return (days.astype(object).tolist(),alignDays(days,wDates,tout))
+
+  # matchWeather for many buildings in the same zip code in one go. dayLists is a list of lists
+  # (or arrays) of dates, one per building. The weather is read once for the full range of dates
+  # and aligned with every list at once. Returns a list of tout arrays, one per building.
+  def matchWeatherMany(self,dayLists,zip5):
+    days = [asDays(dates) for dates in dayLists]
+    allDays = numpy.concatenate(days)
+    (wDates,tout) = self.weatherRangeArray(zip5,allDays.min().astype(object),allDays.max().astype(object))
+    return numpy.split(alignDays(allDays,wDates,tout),numpy.cumsum([len(d) for d in days])[:-1])
+
+  # find the indices for each list where they share the same values. Both must be sorted
   def matchDates(self,dates,wDates):
-    j = 0 # index of wDates
-    wIdx = []
-    dIdx = []
+    (dates,wDates) = (asDays(dates),asDays(wDates))
+    idx = numpy.minimum(numpy.searchsorted(wDates,dates),max(len(wDates) - 1,0))
+    dIdx = numpy.where(wDates[idx] == dates)[0] if len(wDates) > 0 else numpy.zeros(0,dtype=int)
+    return(dIdx.tolist(),idx[dIdx].tolist())
+
+# GHCN-Daily (Global Historical Climatology Network) by_year files: one gzipped csv per year with a row
+# per station, day and element: ID,YYYYMMDD,ELEMENT,VALUE,M-FLAG,Q-FLAG,S-FLAG,OBS-TIME. See weather/readme.txt
+GHCN_BASE_URL   = 'ftp://ftp.ncdc.noaa.gov/pub/data/ghcn/daily/by_year/'
+GHCN_ELEMENTS   = {'TMAX':0,'TMIN':1} # elements kept -> index in the values of a station day
+GHCN_HEADERS    = ['ID','YearMonthDay','Tmax','Tmin','Tavg']
+GHCN_NUMERIC    = (('tmax',2),('tmin',3),('tavg',4)) # numeric columns of GHCN stores, in F like QCLCD's
+GHCN_CANDIDATES = 10 # closest stations considered for each site, as many only report precipitation
+
+def readGHCNStations(stationFile):
+  '''rows of [ID,lat,lon,elevation,state,name] from the fixed width GHCN station list'''
+  with open(stationFile,'rb') as f:
+    return [[line[0:11],line[12:20],line[21:30],line[31:37].strip(),line[38:40],line[41:71].strip()] for line in f if len(line) > 40]
+
+def tenthsCToF(tenths): return tenths * 0.18 + 32 # GHCN temperatures are in tenths of a degree C
+
+class GHCNData(object):
+  '''Daily temperatures from the GHCN-Daily by_year files, with the same matchWeather interface as
+     WeatherData. A yearly file is several GB uncompressed, so it is streamed in one pass that keeps
+     the TMAX and TMIN of just the stations asked for, in a ColumnarStore (dataDir/ghcnd<year>) with
+     the same layout as the QCLCD daily stores. The stations each store has been searched for are
+     kept alongside it (.scanned.txt), so files are only re-read for new stations. Batch runs should
+     call prefetchSites with all of their zip codes to ingest each year once for all the sites.'''
+  def __init__(self,dataDir,baseUrl=None):
+    self.DATA_DIR     = dataDir
+    self.STATION_FILE = os.path.join(dataDir,'ghcnd-US-stations.txt') # fixed width: ID,lat,lon,elevation,state,name,...
+    self.ZIP5_FILE    = os.path.join(dataDir,'Erle_zipcodes.csv')
+    self.BASE_URL     = baseUrl or GHCN_BASE_URL
+
+  def yearUrl(self,year):   return self.BASE_URL + '%d.csv.gz' % year
+  def yearFile(self,year):  return os.path.join(self.DATA_DIR,'%d.csv.gz' % year)
+  def storePath(self,year): return os.path.join(self.DATA_DIR,'ghcnd%d' % year)
+  def zipMap(self):         return zipGeocoder(self.ZIP5_FILE)
+
+  # shared StationIndex of the station list (station IDs are in its WBANs)
+  def stationIndex(self):
+    key = (os.path.abspath(self.STATION_FILE),os.path.getmtime(self.STATION_FILE))
+    with STATION_LOCK: index = STATION_INDEXES.get(key,None)
+    if index is None:
+      index = StationIndex(readGHCNStations(self.STATION_FILE),latCol=1,lonCol=2)
+      with STATION_LOCK: STATION_INDEXES[key] = index
+    return index
+
+  def candidates(self,zips,n=GHCN_CANDIDATES):
+    '''dict of int zip5 -> IDs of the n closest stations, closest first, for each of zips that can be geocoded'''
+    geocoder = self.zipMap()
+    found = [(int(zip5),geocoder.get(zip5)) for zip5 in zips]
+    found = [(zip5,latLon) for (zip5,latLon) in found if latLon is not None]
+    index = self.stationIndex()
+    if len(found) == 0 or len(index) == 0: return {}
+    latLon = numpy.array([latLon for (zip5,latLon) in found])
+    (idx,km) = index.nearest(latLon[:,0],latLon[:,1],n)
+    idx = idx.reshape(len(found),-1)
+    return dict((zip5,[index.WBANs[i] for i in row]) for ((zip5,latLon),row) in zip(found,idx))
+
+  def stationList(self,zip5,n=GHCN_CANDIDATES): return self.candidates([zip5],n).get(int(zip5),[])
+
+  # past years are final once the file was downloaded well into the next year. The current year's
+  # file is updated daily, so it is refreshed once it is a day old
+  def needsDownload(self,year,filePath):
+    if not os.path.isfile(filePath): return True
+    modified = datetime.datetime.fromtimestamp(os.path.getmtime(filePath))
+    if modified > datetime.datetime(year + 1,1,15): return False
+    return datetime.datetime.now() - modified > datetime.timedelta(days=1)
+
+  def confirmedYearFile(self,year):
+    filePath = self.yearFile(year)
+    if not self.needsDownload(year,filePath): return filePath
+    with fetchLock(os.path.abspath(filePath)):
+      if self.needsDownload(year,filePath):
+        url = self.yearUrl(year)
+        print "%s not found. Attempting download at %s" % (filePath,url)
+        try: download(url,filePath,isGzip)
+        except IOError as e:
+          if not os.path.isfile(filePath): raise
+          print 'Warning: could not refresh %s (%s). Using the existing file' % (filePath,e)
+    return filePath
+
+  def streamYear(self,year,stations):
+    '''[ID,YYYYMMDD,tmax,tmin,tavg] rows (F, '' if missing) for the set of stations from one pass over
+       the year's file. Values that failed quality checks (with a Q-FLAG) are treated as missing.'''
+    values = {} # (station,date) -> [tmax,tmin]
+    f = gzip.open(self.confirmedYearFile(year),'rb')
     try:
-      for i,d in enumerate(dates):
-        while wDates[j] < d: j = j + 1
-        if wDates[j] == d: 
-          wIdx.append(j)
-          dIdx.append(i)
-    except IndexError as ie: pass # if we run out of wDates, the loop should end
-    #print wIdx
-    #print dIdx
-    #print [dates[i] for i in dIdx]
-    return(dIdx,wIdx)
+      for line in f:
+        element = GHCN_ELEMENTS.get(line[21:25],None) # cheap checks first, as almost every line is skipped
+        if element is None or line[0:11] not in stations: continue
+        row = line.split(',')
+        if row[5] != '' or row[3] == '-9999': continue
+        values.setdefault((row[0],row[1]),[numpy.nan,numpy.nan])[element] = tenthsCToF(int(row[3]))
+    finally: f.close()
+    def fmt(val): return '' if numpy.isnan(val) else '%0.1f' % val
+    return [[station,date,fmt(tmax),fmt(tmin),fmt((tmax + tmin) / 2)] for ((station,date),(tmax,tmin)) in sorted(values.items())]
+
+  def yearStore(self,year,stations=()):
+    '''the ColumnarStore for year with the data of (at least) stations, first streaming the year's
+       file for any stations it hasn't been searched for. Searches that find nothing still write a
+       (possibly empty) store, so the file isn't streamed again for the same stations. None if no
+       stations have been searched for yet.'''
+    path = os.path.abspath(self.storePath(year))
+    with storeLock(path):
+      scannedFile = path + '.scanned.txt'
+      scanned = set()
+      if os.path.isfile(scannedFile) and ColumnarStore.exists(path): # without the store, nothing has been kept
+        with open(scannedFile,'rb') as f: scanned = set(f.read().split())
+      yearFile = self.yearFile(year)
+      if ColumnarStore.exists(path) and os.path.isfile(yearFile) and ColumnarStore.mtime(path) < os.path.getmtime(yearFile):
+        (stations,scanned) = (scanned | set(stations),set()) # the year's file has been refreshed, so start over
+      missing = set(stations) - scanned
+      if len(missing) > 0:
+        print 'Reading GHCN %d data for %d stations' % (year,len(missing))
+        rows = self.streamYear(year,missing)
+        if len(scanned) > 0 and ColumnarStore.exists(path):
+          old = ColumnarStore(path)
+          rows = old.rows(old.columns) + rows
+        ColumnarStore.build(path,GHCN_HEADERS,rows,GHCN_NUMERIC) # even with no rows, as the scan is only kept with a store
+        tmpFile = '%s.%d.%d.tmp' % (scannedFile,os.getpid(),threading.current_thread().ident)
+        with open(tmpFile,'wb') as f: f.write('\n'.join(sorted(scanned | missing)))
+        os.rename(tmpFile,scannedFile)
+      if not ColumnarStore.exists(path): return None
+      return openStore(path)
+
+  def prefetchSites(self,zips,start,end,n=GHCN_CANDIDATES):
+    '''ingests every year from start to end with one pass over each year's file for the candidate
+       stations of all of zips'''
+    stations = set()
+    for ids in self.candidates(zips,n).values(): stations.update(ids)
+    for year in range(start.year,end.year + 1): self.yearStore(year,stations)
+
+  def dailyArray(self,year,station,col='tavg'):
+    '''(dates,values) numpy arrays of the daily values of col (tmax, tmin or tavg) for station in year.
+       dates are YYYYMMDD ints and missing values are nan'''
+    store = self.yearStore(year,[station])
+    if store is None: return (numpy.zeros(0,dtype=numpy.int32),numpy.zeros(0))
+    records = store.slice(station)
+    return (numpy.array(records['date']),numpy.array(records[col],dtype=float))
+
+  # (dates,values) for the closest of the candidate stations with data for col in year
+  def weatherYearArray(self,zip5,year,col='tavg'):
+    stations = self.stationList(zip5)
+    try: store = self.yearStore(year,stations)
+    except IOError as e: # i.e. a year that isn't available, which shouldn't rule out the rest of a range
+      print 'Warning: no GHCN data for %d: %s' % (year,e)
+      store = None
+    for station in (stations if store is not None else []):
+      records = store.slice(station)
+      if numpy.isfinite(records[col]).any(): return (numpy.array(records['date']),numpy.array(records[col],dtype=float))
+    return (numpy.zeros(0,dtype=numpy.int32),numpy.zeros(0))
+
+  # like WeatherData.weatherRangeArray: (dates,values) with dates as datetime64[D], sorted
+  def weatherRangeArray(self,zip5,start,end,col='tavg'):
+    parts = [self.weatherYearArray(zip5,year,col) for year in range(start.year,end.year + 1)]
+    days   = yyyymmddToDays(numpy.concatenate([p[0] for p in parts]))
+    values = numpy.concatenate([p[1] for p in parts])
+    keep = (days >= numpy.datetime64(start,'D')) & (days <= numpy.datetime64(end,'D'))
+    return (days[keep],values[keep])
+
+  # see WeatherData.matchWeather
+  def matchWeather(self,dates,zip5):
+    days = asDays(dates)
+    (wDates,tout) = self.weatherRangeArray(zip5,days.min().astype(object),days.max().astype(object))
+    return (days.astype(object).tolist(),alignDays(days,wDates,tout))
+
+  # see WeatherData.matchWeatherMany
+  def matchWeatherMany(self,dayLists,zip5):
+    days = [asDays(dates) for dates in dayLists]
+    allDays = numpy.concatenate(days)
+    (wDates,tout) = self.weatherRangeArray(zip5,allDays.min().astype(object),allDays.max().astype(object))
+    return numpy.split(alignDays(allDays,wDates,tout),numpy.cumsum([len(d) for d in days])[:-1])
 
 # Utility timer class. Usage:
 #with Timer('foo_stuff'):
@@ -281,6 +872,100 @@ class Timer(object):
       print '[%s]' % self.name,
     print 'Elapsed: %s' % (time.time() - self.tstart)
 
+# datetime64[D] array of the dates in a list of date or datetime objects (or a datetime64 array)
+def asDays(dates):
+  if isinstance(dates,numpy.ndarray) and dates.dtype.kind == 'M': return dates.astype('datetime64[D]')
+  return numpy.array([d.date() if isinstance(d,datetime.datetime) else d for d in dates],dtype='datetime64[D]')
+
+# datetime64[D] array of an array of YYYYMMDD ints, computed arithmetically rather than by parsing
+def yyyymmddToDays(ints):
+  ints  = numpy.asarray(ints,dtype=numpy.int64)
+  months = (ints // 10000 - 1970) * 12 + (ints // 100) % 100 - 1 # months since 1970-01
+  return months.astype('datetime64[M]').astype('datetime64[D]') + (ints % 100 - 1)
+
+def alignDays(days,wDates,values):
+  '''values (for the sorted datetime64[D] wDates) at each of days (a datetime64[D] array of any shape,
+     i.e. one row per building) as a float array the shape of days, with nans where there is no value'''
+  out = numpy.empty(days.shape)
+  out.fill(numpy.nan)
+  if len(wDates) == 0: return out
+  idx = numpy.minimum(numpy.searchsorted(wDates,days),len(wDates) - 1)
+  hit = wDates[idx] == days
+  out[hit] = values[idx[hit]]
+  return out
+
+# int64 seconds since 1970 from a list of datetimes, a datetime64 array or int seconds
+def asSeconds(dates):
+  if isinstance(dates,numpy.ndarray):
+    if dates.dtype.kind in 'iu': return dates.astype(numpy.int64)
+    if dates.dtype == numpy.dtype('datetime64[s]'): return dates.view(numpy.int64) # no copy needed
+    if dates.dtype.kind == 'M':  return dates.astype('datetime64[s]').astype(numpy.int64)
+  return numpy.array(dates,dtype='datetime64[s]').astype(numpy.int64)
+
+def dstRange(year):
+  '''(start,end) local wall clock seconds since 1970 of US daylight saving time in year: from 2am on
+     the second Sunday of March to 2am on the first Sunday of November since 2007, and from the first
+     Sunday of April to the last Sunday of October before then'''
+  def sunday(d,n): return d + datetime.timedelta(days=(6 - d.weekday()) % 7 + 7 * n) # nth Sunday on or after d
+  if year >= 2007: (start,end) = (sunday(datetime.date(year,3,1),1),sunday(datetime.date(year,11,1),0))
+  else:            (start,end) = (sunday(datetime.date(year,4,1),0),sunday(datetime.date(year,10,25),0))
+  return tuple((d - datetime.date(1970,1,1)).days * 86400 + 2 * 3600 for d in (start,end))
+
+def wallToStandard(times):
+  '''local standard time int64 seconds for local wall clock times (int64 seconds since 1970, any shape)
+     under US daylight saving rules. The repeated hour at the end of daylight saving is taken as daylight time.'''
+  times = numpy.asarray(times,dtype=numpy.int64)
+  out = times.copy()
+  if times.size == 0: return out
+  for year in range(datetime.datetime.utcfromtimestamp(times.min()).year,datetime.datetime.utcfromtimestamp(times.max()).year + 1):
+    (start,end) = dstRange(year)
+    out[(times >= start) & (times < end)] -= 3600
+  return out
+
+def interpolateTimes(times,wTimes,values,maxGap=MAX_HOURLY_GAP):
+  '''values (observed at the sorted int64 seconds wTimes) linearly interpolated onto times (int64 seconds,
+     any shape) as a float array the shape of times. Missing (nan) values are skipped. Times within
+     maxGap of the first or last observation but outside of them take its value. Times further out, or
+     between observations more than maxGap seconds apart, are nan.'''
+  ok = numpy.isfinite(values)
+  (wTimes,values) = (wTimes[ok],values[ok])
+  flat = numpy.asarray(times,dtype=numpy.int64).ravel()
+  out = numpy.empty(flat.shape)
+  out.fill(numpy.nan)
+  if len(wTimes) == 0: return out.reshape(numpy.shape(times))
+  after  = numpy.clip(numpy.searchsorted(wTimes,flat),0,len(wTimes) - 1)      # first observation at or after each time
+  before = numpy.maximum(numpy.searchsorted(wTimes,flat,'right') - 1,0)        # last observation at or before
+  span = wTimes[after] - wTimes[before] # between the observations on either side
+  span = numpy.where(flat < wTimes[0],wTimes[0] - flat,numpy.where(flat > wTimes[-1],flat - wTimes[-1],span))
+  hit = span <= maxGap
+  out[hit] = numpy.interp(flat[hit],wTimes,values) # which holds the end values beyond either end
+  return out.reshape(numpy.shape(times))
+
+def dailyDegreeHours(wTimes,values,heatBase=65.0,coolBase=65.0,maxGap=MAX_HOURLY_GAP,dst=False):
+  '''(days,hdh,cdh) for every day from the first to the last of the hourly observations values at the
+     int64 seconds wTimes: datetime64[D] days and the heating and cooling degree-hours (degrees below
+     heatBase or above coolBase times hours) of each, from the values interpolated onto the middle of
+     each hour. With dst, wTimes are standard time (like QCLCD's) and the days are wall clock days, so
+     the middle of each wall clock hour is converted with wallToStandard. Days with any hour that can't
+     be interpolated are nan.'''
+  if len(wTimes) == 0: return (numpy.zeros(0,dtype='datetime64[D]'),numpy.zeros(0),numpy.zeros(0))
+  dayNums = numpy.arange(wTimes[0] // 86400,wTimes[-1] // 86400 + 1)
+  hours = dayNums[:,numpy.newaxis] * 86400 + numpy.arange(24) * 3600 + 1800 # (day,hour) grid of mid hour times
+  if dst: hours = wallToStandard(hours)
+  tout = interpolateTimes(hours,wTimes,values,maxGap)
+  return (dayNums.astype('datetime64[D]'),numpy.maximum(heatBase - tout,0).sum(axis=1),numpy.maximum(tout - coolBase,0).sum(axis=1))
+
+# (year,month) tuples for every month from the month of start through to the month of end
+def monthRange(start,end):
+  months = []
+  for year in range(start.year,end.year+1):
+    sMon = 1
+    eMon = 12
+    if year == start.year: sMon = start.month
+    if year == end.year:   eMon = end.month
+    months.extend([(year,mon) for mon in range(sMon,eMon+1)])
+  return months
+
 def floatParse(string, fail=numpy.nan):
     try:              return float(string)
     except Exception: return fail;
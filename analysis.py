@@ -4,8 +4,13 @@
 import os
 import cherrypy
 import datetime
+import hashlib
 import re
+import sys
 import time # for time.sleep
+import threading
+import traceback
+import multiprocessing
 
 import numpy as np
 import scipy.stats
@@ -26,9 +31,12 @@ from matplotlib.backends.backend_pdf import FigureCanvasPdf # for rendering figu
 from StringIO import StringIO # library that allows interaction with Strings as though they are files
 
 from jinja2        import Environment, FileSystemLoader # jinja2 template rendering adapters for CherryPy
-from WeatherData   import WeatherData # Custom class that manages weather data
+from WeatherData   import WeatherData, asSeconds # Custom class that manages weather data
 import GBParse                        # Custom class that parses the GreenButtonXML data format
 import CSVParse                       # Custom class that does simple csv parsing
+import DataCache                      # Custom caching of parsed data files
+import ChangePoint                    # Custom change point models for weather normalization
+from Jobs import Job                  # Custom background jobs
 
 # Enable the Jinja2 engine
 current_dir = os.path.dirname(os.path.abspath(__file__)) # the dir this file is in
@@ -40,191 +48,574 @@ parserMap = {
   'csv':CSVParse,
 }
 # load and parse data from a source file
-dataCache = {} # init a quick memory cache
+dataCache = DataCache.LRUCache(maxBytes=256 * 2**20) # bounded in memory cache of parsed readings
 def parseDataFile(source,useCache=False):
   # the source is the file containing the data (i.e. GB.xml or GB.csv)
-  # a quick dict based memory cache can be used for repeated access
-  readings = None
-  if useCache: parsedData = dataCache.get(source,None)
-  if readings is None: 
-    #fileLock.acquire()
-    try:
-      ext = source.split(".")[-1]
-      dataParser = parserMap.get(ext,None) # find the extension appropriate parser
-      # TODO: more aggressive failure for unknown extensions?
-      if dataParser is None: 
-        print 'Warning: no parser matching extension %s. Using GBParse' % (ext)
-        dataParser = GBParse
-      parsedData = dataParser.getInstance(source)
-      dataCache[source] = parsedData
-    finally: pass #fileLock.release()
+  # with useCache, the parsed readings are cached in memory and in a binary sidecar file
+  # next to the source (see DataCache), keyed by the file contents and parser version.
+  # Cached data is returned as a DataCache.ParsedReadings, which only supports the
+  # getReadings()/getReadingsArray() accessors for the first block of readings.
+  ext = source.split(".")[-1]
+  dataParser = parserMap.get(ext,None) # find the extension appropriate parser
+  # TODO: more aggressive failure for unknown extensions?
+  if dataParser is None: 
+    print 'Warning: no parser matching extension %s. Using GBParse' % (ext)
+    dataParser = GBParse
+  if not useCache: return dataParser.getInstance(source)
+  # GBParse converts times to the server's local time zone, so that is part of the key too
+  key = DataCache.contentKey(source,'%s-%s-%s' % (dataParser.__name__,dataParser.PARSER_VERSION,'/'.join(time.tzname)))
+  parsedData = dataCache.get(key)
+  if parsedData is None: 
+    parsedData = DataCache.loadSidecar(source,key) # memory mapped, so this is cheap
+    if parsedData is None:
+      parser = dataParser.getInstance(source)
+      if parser.getReadingsArray() is None: return parser # nothing worth caching
+      parsedData = DataCache.ParsedReadings(*parser.getReadingsArray())
+      DataCache.writeSidecar(source,key,parsedData)
+    dataCache.put(key,parsedData,parsedData.nbytes)
   return parsedData
 
+GRID_PERCENTILES = (5,95) # percentiles reported as 'min' and 'max' by gridStats
+
+if hasattr(np,'partition'): # numpy >= 1.8
+  def orderStats(lines,kth): return np.partition(lines,kth,axis=1)
+else:
+  def orderStats(lines,kth): return np.sort(lines,axis=1)
+
+def floatGrid(dataGrid):
+  '''dataGrid as a float array with nans for masked cells, the form gridStats works on'''
+  return np.ma.filled(np.ma.asarray(dataGrid,dtype=float),np.nan)
+
+def gridStats(dataGrid,axis=0):
+  '''Computes mean, std, 5th and 95th percentiles ('min' and 'max') and their ratio
+     ('mxmn') along axis of a grid of readings, ignoring nans and masked cells.
+     The grid can have any number of dimensions. The percentiles come from the valid
+     readings only (no fill values), so missing readings don't skew them, and are
+     linearly interpolated like np.percentile. Lines with the same number of valid
+     readings are partitioned together around just the order statistics needed
+     rather than fully sorted. Returns a dict of masked arrays, masked where there
+     were no valid readings.'''
+  grid = floatGrid(dataGrid)
+  grid = np.rollaxis(grid,axis,grid.ndim)    # put the axis being summarized last
+  outShape = grid.shape[:-1]
+  grid = grid.reshape(-1,grid.shape[-1])     # one line per output value
+  valid = np.isfinite(grid)
+  n = valid.sum(axis=1)
+  empty = n == 0
+  nn = np.maximum(n,1)                       # avoids dividing by zero for empty lines
+  vals = np.where(valid,grid,0.0)
+  mean = vals.sum(axis=1) / nn
+  dev = np.where(valid,grid - mean[:,np.newaxis],0.0)
+  std = np.sqrt((dev * dev).sum(axis=1) / nn)
+  vals = np.where(valid,grid,np.inf)         # invalid readings order after the valid ones
+  pcts = [np.zeros(len(grid)) for p in GRID_PERCENTILES] # values of empty lines are masked anyway
+  for count in np.unique(n[~empty]):
+    rows = np.flatnonzero(n == count)
+    pos  = [(count - 1) * (p / 100.0) for p in GRID_PERCENTILES] # fractional index of each percentile
+    ends = [(int(np.floor(x)),min(int(np.floor(x)) + 1,count - 1)) for x in pos]
+    part = orderStats(vals[rows],sorted(set(i for pair in ends for i in pair)))
+    for (pct,x,(lo,hi)) in zip(pcts,pos,ends):
+      pct[rows] = part[:,lo] * (1 - (x - lo)) + part[:,hi] * (x - lo)
+  def out(arr): return np.ma.masked_array(arr.reshape(outShape),empty.reshape(outShape))
+  stats = {
+    'mean' : out(mean),
+    'std'  : out(std),
+    'min'  : out(pcts[0]),
+    'max'  : out(pcts[1]),
+  }
+  with np.errstate(divide='ignore',invalid='ignore'):
+    stats['mxmn'] = np.ma.masked_invalid(out(pcts[1] / pcts[0]))
+  return stats
+
+def gridStatsAll(dayGrid,weekGrid):
+  '''gridStats of both axes of the day and week grids. Each grid is converted to
+     floats once and shared by its two axes; the statistics themselves are one
+     gridStats call per axis. Returns (dailyStats,dayStats,weeklyStats,weekStats),
+     see Building'''
+  dayGrid  = floatGrid(dayGrid)
+  weekGrid = floatGrid(weekGrid)
+  return (gridStats(dayGrid,axis=1),gridStats(dayGrid,axis=0),
+          gridStats(weekGrid,axis=1),gridStats(weekGrid,axis=0))
+
 class Building(object):
+  '''Interval data for a building and the statistics derived from it.
+     Buildings live in the (ram) sessions of the server for the length of a visit,
+     so they are kept compact: readings are stored as typed arrays, __slots__ avoids
+     a per instance dict, and the day and week grids are rebuilt on demand rather than
+     stored. Buildings pickle to little more than their arrays, so sessions can also be
+     spilled to disk with cherrypy's file session storage (see fingerprint.conf.example).
+     The grids and the statistics derived from them are computed the first time they
+     are used and cached until the readings change (assigning to data clears them),
+     so a request only pays for the views it actually needs.'''
+  __slots__ = ('times','watts','dow','attr','zip5','occupancy','sqft','obsPerDay','obsPerWeek','_cache','weatherJob')
+  TRANSIENT = ('_cache','weatherJob') # slots that aren't pickled
+
   def __init__(self,intervalData,zip5,attr):
-    self.data = intervalData  # tuple of datetime, watt lists
+    self._cache = {}          # derived views, by name. See cached and invalidate
+    self.weatherJob = None    # background Job resolving the weather. See startWeather
     self.attr = attr          # dict of named building attributes
     self.occupancy = float(self.attr.get('occ_count',1))
     self.sqft      = float(self.attr.get('bldg_size',1))
 
     self.zip5 = zip5
-    n = len(self.data[0])-1
-    DOW = [x.weekday() for x in self.data[0]]   # days of the week mon=0 sun=6
-    DOM = [x.day       for x in self.data[0]]   # days of the month
-    MOY = [x.month     for x in self.data[0]]   # month of year
-    #print np.where(np.diff(DOM))[0] # for some reason, where returns a tuple with the array inside
-    self.dayBreaks  = np.concatenate( (np.where(np.diff(DOM))[0],[n]))   # indices where DOMs change
-    self.weekBreaks = np.concatenate( (np.where(np.diff(DOW)<0)[0],[n])) # indices where DOWs wrap back to mon
-    dayLengths      = np.diff(self.dayBreaks)   # distance between dayBreaks in nObs
-    counts          = np.bincount(dayLengths)   # counts of each value
-    self.obsPerDay  = np.argmax(counts)         # maximum count is the modal nObs/day
+    self.data = intervalData[0:2]
+
+  # returns the named derived view, computing it with fn() and caching it if it isn't already
+  def cached(self,name,fn):
+    if name not in self._cache: self._cache[name] = fn()
+    return self._cache[name]
+
+  # drop all derived views. Needed whenever the readings change
+  def invalidate(self): self._cache = {}
+
+  # pickling support, needed because of __slots__. The state is just the slot values,
+  # which are numpy arrays and small dicts, so this is fast and compact. Derived views
+  # are left out and recomputed when needed
+  def __getstate__(self):
+    return dict([(name,getattr(self,name)) for name in self.__slots__ if name not in self.TRANSIENT])
+
+  def __setstate__(self,state):
+    self._cache = {}
+    self.weatherJob = None
+    for (name,val) in state.items(): setattr(self,name,val)
+
+  @property
+  def seconds(self): return self.times.view(np.int64) # int64 local seconds since 1970
+
+  @property
+  def data(self): return (self.times,self.watts) # tuple of datetime64, watt arrays
+
+  # replaces the readings with (dates,watts) and invalidates everything derived from them
+  @data.setter
+  def data(self,intervalData):
+    (dates,watts) = intervalData
+    self.times = asSeconds(dates).astype('datetime64[s]') # local time of each reading
+    self.watts = np.asarray(watts,dtype=np.float32)       # readings in W
+    days = self.seconds // 86400                # days since 1970
+    self.dow = ((days + 3) % 7).astype(np.uint8) # days of the week mon=0 sun=6 (1970-01-01 was a Thursday)
+    dayCounts = np.bincount(days - days[0])     # nObs for each day
+    dayLengths = dayCounts[1:]                  # the first day is usually partial, so it doesn't vote
+    dayLengths = dayLengths[dayLengths > 0]     # and neither do days missing from the data
+    if len(dayLengths) == 0: dayLengths = dayCounts
+    self.obsPerDay  = np.argmax(np.bincount(dayLengths)) # maximum count is the modal nObs/day
     self.obsPerWeek = self.obsPerDay * 7        # 7 * nObs/day = nObs/week
-    
-    self.dailyData = self.reshape(self.data,wrap='day')
-    self.weeklyData = self.reshape(self.data,wrap='week')
+    self.invalidate()
 
-    wattsD = self.dailyData[1]
-    datesD = self.dailyData[0]
+  # the day and week grids, folded from the readings on first use. See reshape for details
+  @property
+  def dailyData(self): return self.cached('dailyData',lambda: self.reshape(wrap='day'))
 
-    wattsW = self.weeklyData[1]
-    datesW = self.weeklyData[0]
-    
-    # compute daily aggretage values
-    self.days        = [x.date() for x in datesD[:,0]] # convert from datetime to date objects
-    self.dailyStats  = self.gridStats(wattsD,axis=1)   # one number per day
-    self.dayStats    = self.gridStats(wattsD,axis=0)   # one number per time of day
-    self.weeklyStats = self.gridStats(wattsW,axis=1)   # one number per week
-    self.weekStats   = self.gridStats(wattsW,axis=0)   # one number per time of week
-    self.stats = {
-      'mean'  : np.mean(self.dailyStats['mean']), # mean
-      'max'   : np.mean(self.dailyStats['max']),  # max
-      'min'   : np.mean(self.dailyStats['min']),  # min
-      'mxmn'  : np.mean( np.ma.masked_invalid(self.dailyStats['mxmn']) ), # max/min
-      'range' : np.mean(self.dailyStats['max'] - self.dailyStats['min']), # range
-    }
-# todo: support OLS regression and other forms of analysis
-# will require more robust data cleansing and time diffs
-#
-#    import ols
-#    wd = WeatherData('weather')
-#    
-#    y = np.matrix(self.dailyStats['mean'] * 24)
-#    (dates,tout) = wd.matchWeather(self.days,self.zip5)
-#    x = np.matrix(tout)
-#    print len(x)
-#    print len(y)
-#    print len(self.days)
-#    print y
-#    lm = ols.ols(y,x,'y',['tout'])
-#    print(dir(lm))
-#    print(lm.summary())
-    # performance score is intended to be a quantified metrics of home energy 
-    # performance supported by benchmarking data.
-    self.score = self.performanceScores()
-
-
-  def gridStats(self,dataGridRaw,axis=0):
+  @property
+  def weeklyData(self): return self.cached('weeklyData',lambda: self.reshape(wrap='week'))
+
+  @property
+  def days(self): # one date object per row of the day grid
+    return self.cached('days',lambda: self.dailyData[0][:,0].astype('datetime64[D]').astype(object).tolist())
+
+  # aggregate values of the grids. The reports use all four, so they are computed together. See allGridStats
+  @property
+  def dailyStats(self):  return self.allGridStats()[0] # one number per day
+  @property
+  def dayStats(self):    return self.allGridStats()[1] # one number per time of day
+  @property
+  def weeklyStats(self): return self.allGridStats()[2] # one number per week
+  @property
+  def weekStats(self):   return self.allGridStats()[3] # one number per time of week
+
+  @property
+  def stats(self): return self.cached('stats',lambda: summaryStats(self.dailyStats))
+
+  # performance score is intended to be a quantified metrics of home energy 
+  # performance supported by benchmarking data.
+  @property
+  def score(self): return self.cached('score',self.performanceScores)
+
+  # multiply the mean by 24 hrs to get kWh - this is independent of observation interval
+  @property
+  def dailyKWh(self): return self.dailyStats['mean'] * 24 / 1000
+
+  # sha1 of the readings, identifying them in the render cache. See PlotMaker.renderKey
+  @property
+  def contentHash(self): return self.cached('contentHash',lambda: hashArrays(self.times,self.watts))
+
+  # mean daily outside temperature (F) for each of self.days, nan for days without weather data,
+  # or None if the weather can't be found. Loading it can involve downloading weather files,
+  # so it can also be assigned, i.e. by a background job. See startWeather
+  @property
+  def tout(self):
+    if 'tout' not in self._cache and self.weatherJob is not None: self.weatherJob.wait()
+    return self.cached('tout',self.loadTout)
+
+  @tout.setter
+  def tout(self,tout):
+    self._cache['tout'] = None if tout is None else np.asarray(tout,dtype=float)
+    for name in ('weatherModel','score'): self._cache.pop(name,None) # derived from tout
+
+  def loadTout(self):
+    try:
+      (dates,tout) = WeatherData('weather',cherrypy.config.get('weather.base.url')).matchWeather(self.days,self.zip5)
+      return np.asarray(tout,dtype=float)
+    except Exception as e:
+      print 'Warning: no weather data for zip %s: %s' % (self.zip5,e)
+      return None
+
+  # hourly outside temperature (F) interpolated onto each of self.times (nan where there are no
+  # hourly observations close enough) or None if the weather can't be found. Like tout, it waits
+  # for any weather job so the weather files are only downloaded once
+  @property
+  def intervalTout(self):
+    if 'intervalTout' not in self._cache and self.weatherJob is not None: self.weatherJob.wait()
+    return self.cached('intervalTout',lambda: self.loadHourly('matchHourly',self.times))
+
+  # (hdh,cdh) heating and cooling degree-hours (base 65F) for each of self.days from the hourly
+  # weather, nan for days without a full day of observations, or None if the weather can't be found
+  @property
+  def degreeHours(self):
+    if 'degreeHours' not in self._cache and self.weatherJob is not None: self.weatherJob.wait()
+    return self.cached('degreeHours',lambda: self.loadHourly('matchDegreeHours',self.days))
+
+  def loadHourly(self,method,when):
+    try: return getattr(WeatherData('weather',cherrypy.config.get('weather.base.url')),method)(when,self.zip5)
+    except Exception as e:
+      print 'Warning: no hourly weather data for zip %s: %s' % (self.zip5,e)
+      return None
+
+  # finds the closest weather station (stored as attr['bestWBAN']) and the daily tout for the
+  # dates of the building. Can take a while if weather files need downloading. See startWeather
+  def resolveWeather(self,baseUrl=None):
+    weather = WeatherData('weather',baseUrl)
+    (first,last) = (self.days[0],self.days[-1])
+    weather.prefetch(first,last) # download all the months at once
+    try: self.attr['bestWBAN'] = weather.closestWBAN(int(self.zip5),first.year,first.month)
+    except Exception as e: print 'Warning: no weather station found for zip %s: %s' % (self.zip5,e)
+    try: 
+      (dates,tout) = weather.matchWeather(self.days,self.zip5)
+      self.tout = tout
+    except Exception as e:
+      print 'Warning: no weather data for zip %s: %s' % (self.zip5,e)
+      self.tout = None
+    return self.attr.get('bestWBAN',None)
+
+  # runs resolveWeather in a background Job. Until it is done, tout (and the plots that use it)
+  # wait for it, while everything else carries on
+  def startWeather(self,baseUrl=None):
+    self.weatherJob = Job('weather %s' % self.zip5,self.resolveWeather,baseUrl)
+    return self.weatherJob
+
+  # best fitting change point model of daily kWh against tout (a ChangePoint.ChangePointModel,
+  # with coefficients, balance points and cvrmse) or None if there isn't enough weather data
+  @property
+  def weatherModel(self):
+    def fit():
+      if self.tout is None: return None
+      return ChangePoint.bestModel(self.tout,self.dailyKWh)
+    return self.cached('weatherModel',fit)
+
+
+  def gridStats(self,dataGrid,axis=0):
     '''This function calculates some standard statistics for the data passed in.
        It assumes a 2D grid of data readings with 1 row per day or week and 
-       columns across all times of day/week. i.e. the output of reshape()...'''
-    dataGrid = np.ma.masked_array(dataGridRaw,np.isnan(dataGridRaw))
-    #dataGrid = dataGridRaw
-    out = {
-      'mean'  : dataGrid.mean(axis=axis),
-      'std'   : dataGrid.std(axis=axis),
-      #'max'   : np.max(dataGrid,axis=axis), # true max - too volatile
-      #'min'   : np.min(dataGrid,axis=axis), # true min - too ephemeral
-    }
-    # HACK!
-    # percentile doesn't respect masked nans, so we need to fill with a respectable value
-    # and hope that it doesn't throw things off too much. For the record, nan is treated as 
-    # a very large number, so max in particular is impacted
-    dataGrid = dataGrid.filled(dataGrid.mean())
-    out['max'] = np.percentile(dataGrid,95,axis=axis)
-    out['min'] = np.percentile(dataGrid,5,axis=axis)
-    out['mxmn'] = np.ma.masked_invalid( np.divide(out['max'],out['min']) )
-    return(out)
+       columns across all times of day/week. i.e. the output of reshape()...
+       See the module level gridStats for details.'''
+    # 'max' and 'min' are the 95th and 5th percentiles. The true max and min are too volatile
+    return gridStats(dataGrid,axis=axis)
 
+  # computes all four of the grid stats in one go (see gridStatsAll) the first time any of them is used
+  def allGridStats(self):
+    names = ('dailyStats','dayStats','weeklyStats','weekStats')
+    if not all([name in self._cache for name in names]):
+      self._cache.update(zip(names,gridStatsAll(self.dailyData[1],self.weeklyData[1])))
+    return [self._cache[name] for name in names]
+
+  # folds the readings into a grid with one row per day (or week) and one column per
+  # observation interval of the day (or week). Returns (datesA,wattsA) where wattsA is a
+  # float grid masked where there is no reading and datesA is a datetime64 grid with the
+  # nominal time of each cell.
   def reshape(self,data=None,wrap='day'):
-    if(data == None): data = self.data # use the stored data if none is passed in
-    dates = np.array(data[0])
-    watts = np.array(data[1])
-    if(wrap == 'day'): 
-      wrapAt  = self.obsPerDay
-      breaks  = self.dayBreaks
-    if(wrap == 'week'): 
-      wrapAt  = self.obsPerDay * 7
-      breaks  = self.weekBreaks
-    
-    foldedWatts = self.breakAt(watts,breaks,wrapAt)
+    if(data is None): (times,watts,dow) = (self.seconds,self.watts,self.dow) # use the stored data if none is passed in
+    else:             (times,watts,dow) = (asSeconds(data[0]),data[1],None)
+    watts = np.asarray(watts,dtype=float)
+    (rows,cols,rowStarts,nCols) = self.foldIndices(times,wrap,dow)
+    keep = (rows >= 0) & (rows < len(rowStarts))
+    foldedWatts = np.empty((len(rowStarts),nCols),dtype=float)
+    foldedWatts.fill(np.nan) # cells without readings are nans
+    foldedWatts[rows[keep],cols[keep]] = watts[keep] # scatter all the readings in one go
     msk = ~(np.isfinite(foldedWatts)) # build a mask over the non-finite readings
-    # apply the mask to the watts readings and dates
-    #print msk
+    # apply the mask to the watts readings
     wattsA = np.ma.masked_where(msk,foldedWatts)
-    datesA = np.ma.masked_where(msk,self.breakAt(dates,breaks,wrapAt))
+    cellOffsets = np.arange(nCols,dtype=np.int64) * 86400 // self.obsPerDay
+    datesA = (rowStarts[:,np.newaxis] + cellOffsets).astype('datetime64[s]')
     return (datesA,wattsA)
 
-  # this breaks the array of values at the indices specified in the array of breaks
-  # into a a matrix with nCols cols and len(breaks)-1 rows
-  # note that it starts its first row at the first break index, so if the first break is not
-  # 0, it will drop the values leading up to the first break. This is the desired behavior
-  # when using data starting with a partial day or week 
-  # WARNING: this method will produce potentially  inaccurate or error prone results if the 
-  # number of observations per day/week changes over time
-  def breakAt(self,vals,breaks,nCols):
-    n = len(breaks) # number of rows
-    m = nCols
-    data = None
-    if type(vals[0]) == datetime.datetime: 
-      data = np.empty((n-1,m),dtype=np.object)
-      data.fill(None) # blank for objects should be None...
-    else:
-      data = np.empty((n-1,m),dtype=float)
-      data.fill(np.nan) # blank for floats should be nans...
-    for i in range(n-1):
-      begin = breaks[i] + 1
-      end = min(begin+m,breaks[i+1]+1) # if the row is too long, truncate it at the agreed row length
-      data[i,0:(end-begin)] = vals[begin:end]
-      #print vals[begin:end]
-    return data
+  # computes the grid row and column of every reading from its timestamp. Rows start at
+  # midnight for days and midnight Monday for weeks and columns are the observation interval
+  # the reading falls in. The first day (or week) is dropped, as it is usually partial.
+  # Rows of days missing from the data are all nans.
+  # Returns (rows,cols,rowStarts,nCols), with rowStarts in seconds, and rows outside
+  # of 0 to len(rowStarts)-1 for readings that don't belong in the grid.
+  # WARNING: readings are assigned to columns using the modal number of observations
+  # per day, so data whose observation interval changes over time will collide or leave gaps
+  def foldIndices(self,times,wrap='day',dow=None):
+    days  = times // 86400                                 # days since 1970
+    if dow is None: dow = (days + 3) % 7                   # days of the week mon=0 sun=6
+    dow   = dow.astype(np.int64)
+    slots = (times - days * 86400) * self.obsPerDay // 86400 # observation interval within the day
+    if(wrap == 'day'):
+      first = days[0] + 1                                  # drop the first day
+      step  = 1
+      nCols = self.obsPerDay
+      rows  = days - first
+      cols  = slots
+    if(wrap == 'week'):
+      first = days[0] - dow[0] + 7                         # the Monday after the first day
+      step  = 7
+      nCols = self.obsPerDay * 7
+      rows  = (days - first) // 7
+      cols  = dow * self.obsPerDay + slots
+    nRows = max(0,(days[-1] - first) // step + 1)
+    rowStarts = (first + np.arange(nRows,dtype=np.int64) * step) * 86400
+    return (rows,cols,rowStarts,nCols)
   
   def performanceScores(self):
     '''Method designed to score the performance of a building via benchmarking... 
        when the data becomes available. This can be ignored for the time being. '''
-    stats = np.array([
-      np.mean(self.dailyStats['mean']), # mean
-      np.mean(self.dailyStats['max']),  # max
-      np.mean(self.dailyStats['min']),  # min
-      np.mean(np.ma.masked_invalid(self.dailyStats['mxmn']) ), # max/min
-      np.mean(self.dailyStats['max'] - self.dailyStats['min']), # range
-      0.5                               # duration
-    ])                             
-
-    weights = np.array([
-      [0.3,0,0,0,1.0],
-      [0.3,-0.2,0.6,-0.8,0.5],
-      [0.3,0.7,0.1,0.5,0],
-      [0.3,0.7,0.7,0.5,0],
-      [0.3,0.8,0.3,0.5,0],
-      [0.3,0.2,1,-0.5,0] ])
-    
-    out = {
-      'shutoff_duration' : 0.0,
-      'shutoff_depth' : 1.0,
-      'temperature_sensitivity' : 0.6,
-      'equipment_ee' : 0.8,
-      'usage_intensity' : 0.9,
-      'vampire_loads' : 0.3,
-    }
-    return out
+    sensitivity = None
+    # the weather is only used once it has been loaded, as the score shouldn't wait on downloads
+    if self._cache.get('tout',None) is not None and self.weatherModel is not None:
+      sensitivity = self.weatherModel.weatherShare(self.tout[np.isfinite(self.tout)])
+    return performanceScores(self.stats,sensitivity)
+
+# summary statistics of a building from its dailyStats: the average over days of the daily values.
+# With N-D dailyStats (i.e. from Portfolio), days are along axis and there is one value per building
+def summaryStats(dailyStats,axis=-1):
+  return {
+    'mean'  : np.ma.mean(dailyStats['mean'],axis=axis), # mean
+    'max'   : np.ma.mean(dailyStats['max'],axis=axis),  # max
+    'min'   : np.ma.mean(dailyStats['min'],axis=axis),  # min
+    'mxmn'  : np.ma.mean(np.ma.masked_invalid(dailyStats['mxmn']),axis=axis), # max/min
+    'range' : np.ma.mean(dailyStats['max'] - dailyStats['min'],axis=axis), # range
+  }
+
+# rows are the scores of performanceScores, columns are the weights of
+# mean, max, min, max/min, range and duration
+SCORE_WEIGHTS = np.array([
+  [0.3,0,0,0,1.0],
+  [0.3,-0.2,0.6,-0.8,0.5],
+  [0.3,0.7,0.1,0.5,0],
+  [0.3,0.7,0.7,0.5,0],
+  [0.3,0.8,0.3,0.5,0],
+  [0.3,0.2,1,-0.5,0] ])
+SCORE_NAMES = ('shutoff_duration','shutoff_depth','temperature_sensitivity','equipment_ee','usage_intensity','vampire_loads')
+
+def performanceScores(stats,sensitivity=None):
+  '''Scores the performance of buildings from their summaryStats via benchmarking...
+     when the data becomes available. Until then most are placeholder values.
+     sensitivity is the weather dependent share of energy use from a change point
+     model (see Building.weatherModel) and is used as the temperature_sensitivity
+     score when known. stats values can be scalars (one building) or arrays (one
+     value per building), and the scores have the same shape.'''
+  shape = np.shape(stats['mean'])
+  out = {
+    'shutoff_duration' : 0.0,
+    'shutoff_depth' : 1.0,
+    'temperature_sensitivity' : 0.6 if sensitivity is None else sensitivity,
+    'equipment_ee' : 0.8,
+    'usage_intensity' : 0.9,
+    'vampire_loads' : 0.3,
+  }
+  if shape == (): return out
+  return dict([(name,np.tile(val,shape)) for (name,val) in out.items()])
+
+# analyzes one chunk of a Portfolio in a worker process. Must be module level to be picklable
+def analyzePortfolioChunk(args):
+  (ids,buildings,obsPerDay) = args
+  return Portfolio(buildings,ids,obsPerDay).analyzeChunk()
+
+class Portfolio(object):
+  '''Batch analysis of many buildings, i.e. all the meters of a utility program.
+     The daily grids of the buildings are stacked into one (building,day,interval)
+     array so gridStats, summaryStats and performanceScores run as vectorized numpy
+     reductions over all of them at once. Buildings have different numbers of days,
+     which are padded with nans, and can have different observation intervals, which
+     are resampled to obsPerDay intervals per day (averaged when the building has
+     a multiple of obsPerDay intervals, repeated when obsPerDay is a multiple of the
+     building's). Buildings that can't be resampled are left out of the results.
+     Large portfolios are analyzed in chunks, optionally across a process pool.'''
+  def __init__(self,buildings,ids=None,obsPerDay=24):
+    self.buildings  = list(buildings)
+    self.ids        = [str(i) for i in (ids if ids is not None else range(len(self.buildings)))]
+    self.obsPerDay  = obsPerDay
+    self.throughput = None # buildings per second of the last analyze
+
+  @staticmethod
+  def fromFiles(sources,obsPerDay=24,zip5=None):
+    '''Portfolio of the data files in sources, identified by file name'''
+    buildings = [Building(parseDataFile(source,useCache=True).getReadingsArray(),zip5,{}) for source in sources]
+    return Portfolio(buildings,[os.path.basename(source) for source in sources],obsPerDay)
+
+  # a building's daily grid with obsPerDay intervals per day, or None if it can't be resampled
+  def resample(self,bldg):
+    wattsD = np.ma.filled(bldg.reshape(wrap='day')[1],np.nan) # not bldg.dailyData, which would stay cached on every building
+    n = bldg.obsPerDay
+    if n == self.obsPerDay: return wattsD
+    if n % self.obsPerDay == 0: # average groups of n/obsPerDay readings, ignoring missing ones
+      groups = wattsD.reshape(len(wattsD),self.obsPerDay,n // self.obsPerDay)
+      counts = np.isfinite(groups).sum(axis=2)
+      with np.errstate(invalid='ignore'):
+        return np.where(np.isfinite(groups),groups,0.0).sum(axis=2) / np.where(counts > 0,counts,np.nan)
+    if self.obsPerDay % n == 0: return np.repeat(wattsD,self.obsPerDay // n,axis=1)
+    return None
+
+  def stack(self,buildings):
+    '''Returns (grid,keep): the (building,day,interval) array of the daily grids of
+       the buildings that could be resampled and a boolean array of which ones those were'''
+    grids = [self.resample(bldg) for bldg in buildings]
+    keep = np.array([grid is not None for grid in grids],dtype=bool)
+    grids = [grid for grid in grids if grid is not None]
+    nDays = max([len(grid) for grid in grids] or [0])
+    stacked = np.empty((len(grids),nDays,self.obsPerDay),dtype=float)
+    stacked.fill(np.nan)
+    for (i,grid) in enumerate(grids): stacked[i,0:len(grid),:] = grid
+    return (stacked,keep)
+
+  def tableDtype(self):
+    return [('id','S64'),('days',np.int32),('obsPerDay',np.int32)] + \
+           [(name,float) for name in ('mean','max','min','mxmn','range')] + \
+           [(name,float) for name in SCORE_NAMES]
+
+  def analyzeChunk(self):
+    '''Analyzes all the buildings in this process. Returns the results table, a numpy
+       structured array with one row per building, its id, summaryStats and performanceScores'''
+    (grid,keep) = self.stack(self.buildings)
+    dailyStats = gridStats(grid,axis=2)      # (building,day)
+    stats  = summaryStats(dailyStats,axis=1) # (building,)
+    scores = performanceScores(stats)
+    table = np.zeros(len(grid),dtype=self.tableDtype())
+    table['id']        = [bldgId for (bldgId,kept) in zip(self.ids,keep) if kept]
+    table['days']      = dailyStats['mean'].count(axis=1)
+    table['obsPerDay'] = [bldg.obsPerDay for (bldg,kept) in zip(self.buildings,keep) if kept]
+    for (name,val) in stats.items():  table[name] = np.ma.filled(val,np.nan)
+    for (name,val) in scores.items(): table[name] = val
+    return table
+
+  def analyze(self,chunkSize=500,processes=1):
+    '''Analyzes the portfolio in chunks of chunkSize buildings, across a pool of
+       processes if processes > 1, and returns the combined results table. See analyzeChunk.
+       Throughput is printed and kept in self.throughput (buildings per second).'''
+    start = time.time()
+    chunks = [(self.ids[i:i + chunkSize],self.buildings[i:i + chunkSize],self.obsPerDay)
+              for i in range(0,len(self.buildings),chunkSize)]
+    if processes > 1 and len(chunks) > 1:
+      pool = multiprocessing.Pool(processes)
+      try: tables = pool.map(analyzePortfolioChunk,chunks)
+      finally:
+        pool.close()
+        pool.join()
+    else: tables = [analyzePortfolioChunk(chunk) for chunk in chunks]
+    table = np.concatenate(tables or [np.zeros(0,dtype=self.tableDtype())])
+    elapsed = max(time.time() - start,1e-9)
+    self.throughput = len(self.buildings) / elapsed
+    print 'Analyzed %d buildings in %.2f s (%.0f buildings/s, %d skipped)' % (len(self.buildings),elapsed,self.throughput,len(self.buildings) - len(table))
+    return table
+
+# bump whenever the rendered plots or report change. Used to key cached renders (see DataCache.RenderCache)
+PLOT_VERSION = 2
+
+def decimate(y,buckets):
+  '''indices of the points of the series y to plot when there are far more points than pixels: the
+     min and max of each of buckets runs of consecutive points (i.e. pixel columns), in order. A line
+     through them looks like one through every point, peaks and troughs included. nans (and masked
+     points) only show up where a whole bucket is missing. All the indices if there are fewer than
+     2 * buckets points.'''
+  vals = np.ma.filled(np.ma.asarray(y,dtype=float),np.nan)
+  n = len(vals)
+  if n <= 2 * buckets: return np.arange(n)
+  size = int(np.ceil(n / float(buckets)))  # points per bucket
+  pad  = np.repeat(np.inf,size * int(np.ceil(n / float(size))) - n) # fills out the last bucket
+  missing = np.isnan(vals)
+  lo = np.append(np.where(missing,np.inf,vals),pad).reshape(-1,size)
+  hi = np.append(np.where(missing,-np.inf,vals),-pad).reshape(-1,size)
+  starts = np.arange(len(lo)) * size
+  return np.union1d(starts + lo.argmin(axis=1),starts + hi.argmax(axis=1)) # sorted and unique
+
+def hashArrays(*arrays):
+  '''sha1 hex digest of the dtypes, shapes and contents of arrays'''
+  h = hashlib.sha1()
+  for arr in arrays:
+    arr = np.ascontiguousarray(arr)
+    h.update('%s%s' % (arr.dtype.str,arr.shape))
+    h.update(arr.data)
+  return h.hexdigest()
+
+# the process wide render cache set up by the render.cache.dir (unset to disable)
+# and render.cache.bytes config keys, created on first use
+RENDER_CACHES = {} # (cache dir,max bytes) -> DataCache.RenderCache
+RENDER_CACHE_LOCK = threading.Lock()
+
+def renderCache():
+  cacheDir = cherrypy.config.get('render.cache.dir',None)
+  if cacheDir is None: return None
+  key = (os.path.abspath(cacheDir),int(cherrypy.config.get('render.cache.bytes',512 * 2**20)))
+  with RENDER_CACHE_LOCK:
+    cache = RENDER_CACHES.get(key,None)
+    if cache is None:
+      cache = DataCache.RenderCache(*key)
+      RENDER_CACHES[key] = cache
+  return cache
+
+# process pool for rendering plots, shared by all PlotMakers and created on first use. Agg rendering
+# is CPU bound and holds the GIL, so plots only render in parallel in separate processes. Servers
+# should create it at startup: forking while other threads render can deadlock the workers
+RENDER_POOL = None
+RENDER_POOL_LOCK = threading.Lock()
+
+def renderPool(processes):
+  global RENDER_POOL
+  with RENDER_POOL_LOCK:
+    if RENDER_POOL is None: RENDER_POOL = multiprocessing.Pool(processes)
+  return RENDER_POOL
+
+def renderPlot(args):
+  '''renders one plot of a PlotMaker in a worker process. args is (building,workDir,plot method name,
+     file name,dpi), with the building pickled compactly (see Building.__getstate__). Returns
+     (file name,seconds,None) or (file name,seconds,error message with the worker's traceback)'''
+  (building,workDir,method,fName,dpi) = args
+  start = time.time()
+  try:
+    pm = PlotMaker(building,workDir,None,cache=False) # the parent caches what the workers render
+    pm.dpi = dpi
+    pm.save(getattr(pm,method)(),fName,dpi=dpi)
+    return (fName,time.time() - start,None)
+  except Exception as e:
+    return (fName,time.time() - start,'%s: %s\n%s' % (fName,e,traceback.format_exc()))
 
 class PlotMaker(object):
+  # (method,file name) of each plot generateFiles renders
+  PLOTS = [
+    ('dailyMaxMin','daily_max_min'),
+    ('heatmap','heatmap'),
+    ('histogram','histogram'),
+    ('duration','load_duration'),
+    ('plot','plot'),
+    ('meanWeek','weekly_mean'),
+    ('loadShape','load_shape'),
+    ('feature','feature'),
+    ('dailyToutKWh','tout_vs_kwh'), # last, as it waits for the building's weather job
+  ]
+  LOCAL_PLOTS = ('tout_vs_kwh',) # always rendered in this process, as they use the building's weather
+  REPORT_FILES = ('custom_report.html','custom_report.pdf') # made together by makeReport, after all the plots
   
-  def __init__(self,building,workDir,wkhtmltopdf,sessionId='unknown session'):
+  def __init__(self,building,workDir,wkhtmltopdf,sessionId='unknown session',processes=1,cache=None,artifacts=None,timeout=None):
     self.building    = building
     self.workDir     = workDir
     self.wkhtmltopdf = wkhtmltopdf
     self.sessionId   = sessionId
+    self.processes   = processes or 1 # > 1 renders plots in a pool of that many processes. See renderPool
+    self.cache       = renderCache() if cache is None else (cache or None) # DataCache.RenderCache for rendered files, the shared one for None, none for False
+    self.artifacts   = artifacts # Jobs.Artifacts told about each file as generateFiles makes it, or None
+    self.timings     = {} # file name -> seconds to render, filled in by generateFiles
+    self.timeout     = timeout # seconds to wait for files other threads or workers make before failing, None waits forever
+    self.dpi         = 200 # resolution of the rendered plots, which dense series are decimated to. See decimate
 
     # Use these for a poor man's transactional generation of files for
     # thread safety. 
@@ -233,6 +624,57 @@ class PlotMaker(object):
     self.lockFile  = os.path.join(self.workDir,'_IMG_LOCK')
     self.errorFile = os.path.join(self.workDir,'_ERROR')
 
+  # names of the files generateFiles makes, for tracking them with Jobs.Artifacts
+  def artifactNames(self,plotName=None):
+    names = ['csv_data.csv'] + ['%s.png' % fName for (method,fName) in self.PLOTS if plotName is None or fName == plotName]
+    if plotName is None: names += list(self.REPORT_FILES)
+    return names
+
+  def plotFor(self,name):
+    '''(method,fName) of the plot saved as name, or None'''
+    for (method,fName) in self.PLOTS:
+      if name == '%s.png' % fName: return (method,fName)
+    return None
+
+  def claim(self,names):
+    '''the names this thread should make: all of them with no artifacts to share the work with,
+       otherwise only what isn't made or being made by another thread already. See Jobs.Artifacts.claim'''
+    if self.artifacts is None: return list(names)
+    return [name for name in names if self.artifacts.claim([name])]
+
+  def waitForArtifacts(self,names):
+    '''waits (up to self.timeout seconds in all) for names being made by other threads, raising the error
+       of any that failed or an error if they aren't done in time. Callers release their claims on errors'''
+    if self.artifacts is None: return
+    deadline = None if self.timeout is None else time.time() + self.timeout
+    for name in names:
+      if not self.artifacts.wait(name,None if deadline is None else max(deadline - time.time(),0)):
+        raise Exception('timed out waiting for %s' % name)
+      error = self.artifacts.errorFor(name)
+      if error is not None: raise Exception(error)
+
+  def makeArtifact(self,name):
+    '''makes name (one of artifactNames()) in this thread, unless it is made or being made already, so
+       a request for one file doesn't wait for the whole report. Concurrent requests for the same file
+       share one build: callers wait on self.artifacts for the result either way'''
+    names = list(self.REPORT_FILES) if name in self.REPORT_FILES else [name]
+    if self.artifacts is None or not self.artifacts.claim(names): return
+    try:
+      if name == 'csv_data.csv': self.saveCSV()
+      elif name in self.REPORT_FILES:
+        pngs = ['%s.png' % fName for (method,fName) in self.PLOTS]
+        for png in pngs: self.makeArtifact(png) # those being made elsewhere are waited for next
+        self.waitForArtifacts(pngs)
+        self.makeReport()
+      else: self.renderPlots([self.plotFor(name)])
+      for made in names: self.markReady(made)
+    except Exception as e:
+      self.artifacts.release(names,'%s\n%s' % (e,traceback.format_exc()))
+
+  def markReady(self,name):
+    if self.artifacts is not None: self.artifacts.markReady(name)
+
+  # polls for the lock file. Waiting on Jobs.Artifacts is preferable where the job was started in this process
   def waitForImages(self):
     while os.path.isfile(self.lockFile):
       #print 'tic'
@@ -244,11 +686,15 @@ class PlotMaker(object):
     with open(self.errorFile,'r') as err: msg = err.read()
     return msg
   
+  # number of decimation buckets for series drawn across ax: one per pixel column at self.dpi
+  def pixelBuckets(self,fig,ax): return max(int(fig.get_figwidth() * ax.get_position().width * self.dpi),1)
+
   def plot(self):
     [dates,watts] = self.building.data
     fig = Figure(facecolor='white',edgecolor='none')
     ax  = fig.add_subplot(111)
-    ax.plot(dates,[w/1000.0 for w in watts])
+    idx = decimate(watts,self.pixelBuckets(fig,ax))
+    ax.plot(dates[idx].astype(object),watts[idx]/1000.0)
     monthFmt = mpld.DateFormatter('%m/%d/%y')
     months   = mpld.MonthLocator()  # every month
     ax.xaxis.set_major_locator(months)
@@ -265,7 +711,9 @@ class PlotMaker(object):
     [dates,watts] = self.building.data
     fig = Figure(facecolor='white',edgecolor='none')
     ax = fig.add_subplot(111)
-    ax.plot(sorted([w/1000.0 for w in watts]))
+    ranked = np.sort(watts)
+    idx = decimate(ranked,self.pixelBuckets(fig,ax))
+    ax.plot(idx,ranked[idx]/1000.0)
     ax.set_title('Load duration of %s data for %s' % ('electricity','uploaded data'))
     ax.set_ylabel('kW')
     ax.set_xlabel('ranked hour of the year')
@@ -279,7 +727,10 @@ class PlotMaker(object):
     dailyMax  = self.building.dailyStats['max']  / 1000
     dailyMin  = self.building.dailyStats['min']  / 1000
     dailyMean = self.building.dailyStats['mean'] / 1000
-    dts = self.building.days
+    buckets = self.pixelBuckets(fig,ax)
+    idx = np.union1d(decimate(dailyMax,buckets),decimate(dailyMin,buckets))
+    (dailyMax,dailyMin,dailyMean) = (dailyMax[idx],dailyMin[idx],dailyMean[idx])
+    dts = np.array(self.building.days,dtype=object)[idx]
     ax.fill_between(dts, dailyMin, dailyMax, facecolor='#e6e6e6', edgecolor='#e6e6e6')
     ax.plot(dts,dailyMax,color='#aa2222',alpha=0.2,label='Daily max')
     ax.plot(dts,dailyMean,color='#000000',label='Daily mean')
@@ -301,10 +752,10 @@ class PlotMaker(object):
     [datesA,wattsA] = self.building.dailyData
     fig = Figure(facecolor='white',edgecolor='none')
     ax = fig.add_subplot(111)
-    # multiple the mean by 24 hrs to get kWh - this is independent of observation interval
-    daySum  = self.building.dailyStats['mean']*24/1000
-    wd = WeatherData('weather')
-    (dates,tout) = wd.matchWeather(self.building.days,self.building.zip5)
+    daySum = self.building.dailyKWh
+    dates  = self.building.days
+    tout   = self.building.tout
+    if tout is None: raise ValueError('No weather data found for zip %s' % self.building.zip5)
     #ax.plot(dts,daySum,'o',color='#000000',alpha=1,label='Daily kWh')
     #ax.set_xlabel('Date')
     ax.set_xlabel('Mean daily temperature (F)')
@@ -313,6 +764,10 @@ class PlotMaker(object):
     wknd = np.where([int(dt.isoweekday() > 5) for dt in dates])[0].tolist()
     print wknd
     ax.plot(np.array(tout)[wknd],np.array(daySum)[wknd],'o',color='#5AAE61',alpha=1,label='Weekend kWh')
+    model = self.building.weatherModel
+    if model is not None:
+      t = np.linspace(np.nanmin(tout),np.nanmax(tout),200)
+      ax.plot(t,model.predict(t),'-',color='#000000',alpha=0.8,label='%s model, CV(RMSE) %0.2f' % (model.kind,model.cvrmse))
     # todo: identify weekends and color differently
     ax.set_title('Daily energy (kWh)')
     ax.set_ylabel('kWh')
@@ -331,7 +786,7 @@ class PlotMaker(object):
     # get a set of dates that can be used for lableing the date axis
     # it doesn't matter which ones, but they need to correctly span the weekdays
     # and have no blanks - and the real data can have blanks...
-    dt0 = datesA[0,0]
+    dt0 = datesA[0,0].astype(object) # to datetime
     dt = datetime.timedelta(days=7.0 / nObs)
     dts = [dt0 + dt * x for x in range(nObs)]
     ax.plot(dts,self.building.weekStats['mean']/1000,'-',color='#000000',alpha=1,label='Average kW')
@@ -359,7 +814,7 @@ class PlotMaker(object):
     [dates,watts] = self.building.data
     fig = Figure(facecolor='white',edgecolor='none')
     ax = fig.add_subplot(111)
-    ax.hist([w/1000.0 for w in watts], 200, normed=1, facecolor='green', alpha=0.75)
+    ax.hist(watts/1000.0, 200, normed=1, facecolor='green', alpha=0.75)
     #ax.plot(dates,[w/1000.0 for w in watts])
     #monthFmt = d.DateFormatter('%m/%d/%y')
     #months   = d.MonthLocator()  # every month
@@ -397,7 +852,7 @@ class PlotMaker(object):
     for l in ax.xaxis.get_majorticklabels(): l.set_rotation(70)
     ax.set_yticks(range(1,m*2+1,30*2))
     ax.format_ydata = mpld.DateFormatter('%m/%d')
-    ax.set_yticklabels([x.strftime('%m/%d/%y') for x in datesA[-1:1:-30,0]])
+    ax.set_yticklabels([x.strftime('%m/%d/%y') for x in datesA[-1:1:-30,0].astype(object)])
     #fig.autofmt_ydate()
     ax.tick_params(axis='both', which='major', labelsize=8)
     ax.set_title('Heat map of %s data for %s' % ('electricity','uploaded data'))
@@ -415,7 +870,7 @@ class PlotMaker(object):
 
     [datesA,wattsA] = self.building.dailyData
     nObs = datesA.shape[1]
-    dt0 = datesA[0,0]
+    dt0 = datesA[0,0].astype(object) # to datetime
     dt = datetime.timedelta(days=1.0 / nObs)
     dts = [dt0 + dt * x for x in range(nObs)]
     wattsA = np.ma.masked_array(wattsA,np.isnan(wattsA)) # mask nans 
@@ -424,7 +879,7 @@ class PlotMaker(object):
     minVal = min(dayMeans)
     maxIdx = dayMeans.argmax()
     minIdx = dayMeans.argmin()
-    DOW = np.array([x.date().weekday() for x in datesA[:,0]]) # 0 = Mon, 6 = Sun
+    DOW = (datesA[:,0].astype('datetime64[D]').astype(np.int64) + 3) % 7 # 0 = Mon, 6 = Sun
     WKND = DOW >  4
     WKDY = DOW <= 4
     meanLoad = wattsA.mean(axis=0)
@@ -462,12 +917,12 @@ class PlotMaker(object):
     ax2 = fig.add_subplot(122) 
 
     ax2.plot(dts,meanLoad/1000,'-',color='#000000',alpha=1,label='Average day: %0.1f kWh' % (sum(meanLoad/1000)))
-    ax2.plot(dts,wattsA[maxIdx,:]/1000,'-',color='#F03B20',alpha=0.7,label='Max day %0.1f kWh (%s)' % (np.sum(wattsA[maxIdx,:]/1000),datesA[maxIdx,0].date()))
+    ax2.plot(dts,wattsA[maxIdx,:]/1000,'-',color='#F03B20',alpha=0.7,label='Max day %0.1f kWh (%s)' % (np.sum(wattsA[maxIdx,:]/1000),datesA[maxIdx,0].astype('datetime64[D]')))
     ax2.fill_between(dts,[0] * len(wattsA[maxIdx,:]),wattsA[maxIdx,:]/1000, facecolor='#F03B20', edgecolor='#F03B20',alpha=0.1 )
     ax2.fill_between(dts,[0] * len(meanLoad),meanLoad/1000,alpha=1, facecolor='#F0F0F0', edgecolor='#F0F0F0' )
     #ax2.plot(dts,wattsA[-1,:]/1000,'-',color='#000000',alpha=1,label='last day: %0.1f kWh (%s)' % (np.sum(wattsA[-1,:]/1000),datesA[-1,0].date()))
     #ax2.fill_between(dts,[0] * len(wattsA[-1,:]),wattsA[-1,:]/1000, facecolor='#e6e6e6', edgecolor='#e6e6e6' )
-    ax2.plot(dts,wattsA[minIdx,:]/1000,'-',color='#0571B0',alpha=0.5,markersize=3,label='Min day: %0.1f kWh (%s)' % (np.sum(wattsA[minIdx,:]/1000),datesA[minIdx,0].date()))   
+    ax2.plot(dts,wattsA[minIdx,:]/1000,'-',color='#0571B0',alpha=0.5,markersize=3,label='Min day: %0.1f kWh (%s)' % (np.sum(wattsA[minIdx,:]/1000),datesA[minIdx,0].astype('datetime64[D]')))   
     ax2.fill_between(dts,[0] * len(wattsA[minIdx,:]),wattsA[minIdx,:]/1000, facecolor='#D1E5F0', edgecolor='#D1E5F0',alpha=1 )
     #ax2.plot(dts,wattsA[-1,:]/1000,'-',color='#525252',alpha=0.4,markersize=2,label='last day: %0.1f kWh (%s)' % (np.sum(wattsA[-1,:]/1000),datesA[-1,0].date()))
     
@@ -509,7 +964,9 @@ class PlotMaker(object):
     for i,attr in enumerate(plots):
       mn = attr[0].mean()
       ax = fig.add_subplot(n,1,i+1) 
-      ax.plot(datesA[(window-1):,0],mlab.movavg(attr[0],window),'-',color='#000000',alpha=1,label=attr[1])
+      avg = mlab.movavg(attr[0],window)
+      idx = decimate(avg,self.pixelBuckets(fig,ax))
+      ax.plot(datesA[(window-1):,0][idx].astype(object),avg[idx],'-',color='#000000',alpha=1,label=attr[1])
       ax.plot(ax.get_xlim(),[mn,mn],'--',color='b')
       ax.text(.5,0.85,attr[2],weight='bold',  # set the title inside the plot
         horizontalalignment='center',
@@ -547,7 +1004,11 @@ class PlotMaker(object):
   def saveCSV(self,workDir=None):
     if workDir is None: workDir = self.workDir
     outFile  = os.path.join(workDir,'csv_data.csv')
-    self.writeReadings(zip(self.building.data[0],self.building.data[1]),outFile)
+    [dates,watts] = self.building.data
+    def write():
+      if os.path.isfile(outFile): os.remove(outFile) # it may be linked to a cached copy
+      self.writeReadings(zip(dates.astype(object),watts),outFile)
+    self.cachedFile(self.renderKey('csv_data.csv'),outFile,write)
 
   def makeReport(self,workDir=None):
     import subprocess
@@ -559,7 +1020,13 @@ class PlotMaker(object):
     inFile  = os.path.join(workDir,'custom_report.html')
     outFile = os.path.join(workDir,'custom_report.pdf')
     with open(inFile,'wb') as f: f.write(reportHTML)
-    subprocess.call([self.wkhtmltopdf,inFile,outFile])
+    def write():
+      if os.path.isfile(outFile): os.remove(outFile) # it may be linked to a cached copy
+      subprocess.call([self.wkhtmltopdf,inFile,outFile])
+    # the html has the attributes, stats and session id. The images it includes are identified by their keys
+    imageKeys = [self.plotKey(fName,self.dpi) for (method,fName) in self.PLOTS]
+    key = hashlib.sha1(repr((PLOT_VERSION,self.wkhtmltopdf,imageKeys)) + reportHTML.encode('utf-8')).hexdigest()
+    self.cachedFile(key,outFile,write)
   
   # TODO: See if we want to use this for anything.
   # This example renders plots to PDF directly, with vector graphics.
@@ -601,43 +1068,118 @@ class PlotMaker(object):
     pdf.close()
     #return(imdata.getvalue())
 
-  def generateFiles(self,plotName=None,supressException=True):
-    plots = [  
-       (self.dailyMaxMin,'daily_max_min'),
-       (self.heatmap,'heatmap'),
-       (self.histogram,'histogram'),
-       (self.duration,'load_duration'),
-       (self.plot,'plot'),
-       (self.meanWeek,'weekly_mean'),
-       (self.loadShape,'load_shape'),
-       (self.feature,'feature'),
-       (self.dailyToutKWh,'tout_vs_kwh'),
-    ]
+  # cache key of a file rendered from the building's readings (and its weather for LOCAL_PLOTS) and parts
+  def renderKey(self,name,*parts):
+    parts = (PLOT_VERSION,matplotlib.__version__,name,parts,self.building.contentHash)
+    if name in self.LOCAL_PLOTS:
+      tout = self.building.tout
+      parts += (None if tout is None else hashArrays(tout),self.building.zip5)
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+  def plotKey(self,fName,dpi): return self.renderKey(fName,dpi)
+
+  def imagePath(self,fName): return os.path.join(self.workDir,fName + '.png')
+
+  # links the cached copy of key to path if there is one. Otherwise runs write() to create
+  # path and caches the result. Returns True for a cache hit
+  def cachedFile(self,key,path,write):
+    if self.cache is not None and self.cache.fetch(key,path): return True
+    write()
+    if self.cache is not None and os.path.isfile(path): self.cache.store(key,path)
+    return False
+
+  # renders plots ((method,file name) list) in this process, recording the time each takes
+  def renderPlots(self,plots,dpi=None):
+    dpi = dpi or self.dpi
+    for (method,fName) in plots:
+      start = time.time()
+      hit = self.cachedFile(self.plotKey(fName,dpi),self.imagePath(fName),lambda: self.save(getattr(self,method)(),fName,dpi=dpi))
+      self.timings[fName] = time.time() - start
+      print '%s %.2fs%s' % (fName,self.timings[fName],' (cached)' if hit else '')
+      self.markReady('%s.png' % fName)
+
+  # renders plots in the process pool, other than LOCAL_PLOTS, which render here in the meantime.
+  # Plots in the render cache are linked in rather than rendered. Each plot is cached and marked
+  # ready as soon as its worker is done
+  def renderPlotsParallel(self,plots,dpi=None):
+    dpi = dpi or self.dpi
+    remote = []
+    for (method,fName) in plots:
+      if fName in self.LOCAL_PLOTS: continue
+      key = self.plotKey(fName,dpi)
+      if self.cache is not None and self.cache.fetch(key,self.imagePath(fName)):
+        self.timings[fName] = 0.0
+        print '%s (cached)' % fName
+        self.markReady('%s.png' % fName)
+      else: remote.append((method,fName,key))
+    keys = dict((fName,key) for (method,fName,key) in remote)
+    def done(result): # called from the pool's result handler thread, so it mustn't raise
+      (fName,seconds,error) = result
+      self.timings[fName] = seconds
+      print '%s %.2fs (worker)' % (fName,seconds)
+      if error is not None:
+        if self.artifacts is not None: self.artifacts.markFailed('%s.png' % fName,error)
+        return
+      if self.cache is not None: self.cache.store(keys[fName],self.imagePath(fName))
+      self.markReady('%s.png' % fName)
+    pool = renderPool(self.processes)
+    deadline = None if self.timeout is None else time.time() + self.timeout
+    results = [pool.apply_async(renderPlot,((self.building,self.workDir,method,fName,dpi),),callback=done) for (method,fName,key) in remote]
+    try: self.renderPlots([(method,fName) for (method,fName) in plots if fName in self.LOCAL_PLOTS],dpi)
+    finally: rendered = [self.workerResult(result,deadline) for result in results] # the workers finish before any error is reported or the lock file removed
+    for (fName,seconds,error) in rendered:
+      if error is not None: raise Exception(error)
+
+  # the (fName,seconds,error) of a renderPlot worker, waiting until deadline (forever if None) so a hung or
+  # killed worker fails the plot rather than blocking the thread that is building the report
+  def workerResult(self,result,deadline):
+    if deadline is None: return result.get()
+    try: return result.get(max(deadline - time.time(),0))
+    except multiprocessing.TimeoutError: raise Exception('timed out waiting for a plot worker')
+
+  # makes all the files (or the csv and the plotName plot), skipping those that other threads
+  # have made or are making on demand (see makeArtifact). The report waits for their plots.
+  # Without report, the REPORT_FILES are left to be made when they are requested
+  def generateFiles(self,plotName=None,supressException=True,report=True):
+    mine  = self.claim([name for name in self.artifactNames(plotName) if name not in self.REPORT_FILES])
+    plots = [self.plotFor(name) for name in mine if name.endswith('.png')]
+    reportClaimed = report and plotName is None and (self.artifacts is None or self.artifacts.claim(self.REPORT_FILES))
+    if reportClaimed: mine += self.REPORT_FILES
+    error = None
     try:
       try: os.remove(self.errorFile)
       except: pass
       with open(self.lockFile,'wb') as lock: os.utime(self.lockFile,None) # create empty file
-      self.saveCSV()
-      for (plotFn,fName) in plots:
-        if plotName is not None and fName != plotName: continue
-        print fName
-        self.save(plotFn(),fName,dpi=200)
-      if plotName is None: 
-        
+      start = time.time()
+      if 'csv_data.csv' in mine:
+        self.saveCSV()
+        self.markReady('csv_data.csv')
+      if self.processes > 1 and len(plots) > 1: self.renderPlotsParallel(plots)
+      else: self.renderPlots(plots)
+      print 'Rendered %d plots in %.2fs' % (len(plots),time.time() - start)
+      if reportClaimed: 
+        self.waitForArtifacts(['%s.png' % fName for (method,fName) in self.PLOTS])
         self.makeReport()
+        for name in self.REPORT_FILES: self.markReady(name)
     except Exception as e: 
+      error = str(e)
+      if self.artifacts is not None: self.artifacts.release(mine,error)
       with open(self.errorFile,'wb') as err:
-        import traceback
         err.write(str(e))
         traceback.print_exc(file=err)
       if not supressException:
         exc = sys.exc_info()
         raise exc[0], exc[1], exc[2]
-    finally: os.remove(self.lockFile)
+    finally: 
+      os.remove(self.lockFile)
+      if self.artifacts is not None: self.artifacts.finish(error)
 
   def save(self,fig,f=None,dpi=100):
     canvas = FigureCanvasPng(fig)
-    canvas.print_figure(os.path.join(self.workDir,f),dpi=dpi)
+    path = os.path.join(self.workDir,f)
+    if os.path.splitext(path)[1] == '': path += '.png'
+    if os.path.isfile(path): os.remove(path) # it may be linked to a cached copy. See DataCache.RenderCache
+    canvas.print_figure(path,dpi=dpi)
 
   def imageData(self,fig):
     canvas=FigureCanvasPng(fig)
@@ -659,7 +1201,7 @@ if __name__ == '__main__':
     plotName = sys.argv[1]
   dataDir = 'c:/dev/fingerprint/file_data/test/'
   dataFile = os.path.join(dataDir,'GB_data.xml')
-  b  = Building(parseDataFile(dataFile).getReadings(),94305,{ })
+  b  = Building(parseDataFile(dataFile,useCache=True).getReadingsArray(),94305,{ })
   # PlotMaker is a custom class that consumes building energy data
   # to generate a set of plots to visualize the data
   # It also uses those figures to generate a PDF report - it uses a 
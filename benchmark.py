@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+'''Timings of the analysis code on the files in sample_data.
+   usage: python benchmark.py [repeats] [portfolio size] [processes]'''
+import os
+import sys
+import glob
+import time
+
+import numpy as np
+
+import analysis
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'sample_data')
+
+# the original Building.gridStats, kept for comparison with analysis.gridStats
+def legacyGridStats(dataGridRaw,axis=0):
+  dataGrid = np.ma.masked_array(dataGridRaw,np.isnan(dataGridRaw))
+  out = {
+    'mean'  : dataGrid.mean(axis=axis),
+    'std'   : dataGrid.std(axis=axis),
+  }
+  dataGrid = dataGrid.filled(dataGrid.mean())
+  out['max'] = np.percentile(dataGrid,95,axis=axis)
+  out['min'] = np.percentile(dataGrid,5,axis=axis)
+  out['mxmn'] = np.ma.masked_invalid( np.divide(out['max'],out['min']) )
+  return(out)
+
+# best of repeats wall clock seconds for fn(*args)
+def timeit(fn,args,repeats):
+  best = None
+  for i in range(repeats):
+    start = time.time()
+    fn(*args)
+    elapsed = time.time() - start
+    if best is None or elapsed < best: best = elapsed
+  return best
+
+# largest difference between the legacy and new stats, ignoring lines the new stats mask
+def maxDiff(old,new):
+  diffs = {}
+  for (name,val) in new.items():
+    d = np.ma.masked_array(np.abs(np.ma.filled(old[name],np.nan) - np.ma.filled(val,np.nan)),np.ma.getmaskarray(val))
+    diffs[name] = 0.0 if d.count() == 0 else float(d.max())
+  return diffs
+
+def benchGridStats(buildings,repeats):
+  print 'gridStats: day and week grids, both axes'
+  print '%-40s %10s %10s %8s  %s' % ('file','legacy ms','new ms','speedup','max abs diff (mean,std,min,max)')
+  totals = [0.0,0.0]
+  for (name,bldg) in buildings:
+    grids = [(bldg.dailyData[1],1),(bldg.dailyData[1],0),(bldg.weeklyData[1],1),(bldg.weeklyData[1],0)]
+    def legacy():
+      for (grid,axis) in grids: legacyGridStats(grid,axis)
+    def fused():
+      analysis.gridStatsAll(bldg.dailyData[1],bldg.weeklyData[1])
+    old = timeit(legacy,(),repeats)
+    new = timeit(fused,(),repeats)
+    totals[0] += old
+    totals[1] += new
+    diff = maxDiff(legacyGridStats(*grids[0]),analysis.gridStats(*grids[0])) # daily stats
+    print '%-40s %10.2f %10.2f %7.1fx  %.3g,%.3g,%.3g,%.3g' % (name[0:40],old * 1000,new * 1000,old / new,
+                                                               diff['mean'],diff['std'],diff['min'],diff['max'])
+  print '%-40s %10.2f %10.2f %7.1fx' % ('total',totals[0] * 1000,totals[1] * 1000,totals[0] / totals[1])
+
+# Portfolio throughput, with the sample buildings repeated to make up a portfolio of size buildings
+def benchPortfolio(buildings,size,processes):
+  bldgs = [bldg for (name,bldg) in buildings]
+  bldgs = (bldgs * (size // len(bldgs) + 1))[0:size]
+  print 'Portfolio of %d buildings' % size
+  for procs in sorted(set([1,processes])):
+    print '%d process(es):' % procs,
+    analysis.Portfolio(bldgs).analyze(chunkSize=500,processes=procs)
+
+if __name__ == '__main__':
+  repeats   = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  size      = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+  processes = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+  buildings = []
+  for source in sorted(glob.glob(os.path.join(SAMPLE_DIR,'*.xml')) + glob.glob(os.path.join(SAMPLE_DIR,'*.csv'))):
+    try: readings = analysis.parseDataFile(source).getReadingsArray()
+    except Exception as e:
+      print 'Skipping %s: %s' % (source,e)
+      continue
+    if readings is None or len(readings[0]) == 0: continue
+    buildings.append((os.path.basename(source),analysis.Building(readings,None,{})))
+  benchGridStats(buildings,repeats)
+  benchPortfolio(buildings,size,processes)
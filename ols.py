@@ -56,24 +56,21 @@ class ols:
             self.x_varnm = ['const'] + list(x_varnm)
         else:
             self.x_varnm = ['const'] + x_varnm
-        print(self.y.shape)
-        print(self.x.shape)
         joined = c_[self.y,self.x]
         deNand = joined[~np.isnan(joined).any(axis=1)]
         self.y = deNand[:,0]
         self.x = deNand[:,1:]
 
-        print self.y
-        print self.x
         # Estimate model using OLS
         self.estimate()
 
     def estimate(self):
 
         # estimating coefficients, and basic stats
+        # coefficients from a least squares solve, which is better conditioned than inverting x'x.
+        # The inverse is still needed for the standard errors
+        self.b = np.linalg.lstsq(self.x,self.y,rcond=-1)[0] # estimate coefficients
         self.inv_xx = inv(dot(self.x.T,self.x))
-        xy = dot(self.x.T,self.y)
-        self.b = dot(self.inv_xx,xy)                    # estimate coefficients
 
         self.nobs = self.y.shape[0]                     # number of observations
         self.ncoef = self.x.shape[1]                    # number of coef.
@@ -172,6 +169,109 @@ class ols:
         print 'BIC criterion        % -5.6f         Kurtosis            % -5.6f' % tuple([bic, kurtosis])
         print '=============================================================================='
 
+class olsBatch:
+    """
+    Doc: Batched OLS. Fits many regressions at once and returns the usual statistics as arrays,
+    with one row per model. Numerically stable: coefficients come from QR factorizations of the
+    design rather than inverting x'x.
+
+    Input:
+        y = (models,obs) array of dependent variables, one model per row. nan marks a missing observation
+        x = (obs,vars) design shared by all the models or (models,obs,vars) designs, one per model.
+            nan rows in x are missing for the models that use them. A constant is added by default
+        const = add a constant (intercept) column to x
+
+    Shared designs are factored once per distinct pattern of missing observations, and all the
+    models with that pattern are solved together as multiple right hand sides, so the design is
+    only copied once per pattern. Per model designs are factored together with a vectorized
+    modified Gram-Schmidt QR; missing observations are zeroed rather than removed.
+
+    Output (arrays, models first):
+        b, se, t, p = coefficients, standard errors, t-statistics and p-values, (models,vars)
+        nobs, df_e  = number of observations used and error degrees of freedom, (models,)
+        sse, R2, R2adj = residual sum of squares / df_e and (adjusted) R-squared, (models,)
+        Models with fewer observations than coefficients have nan statistics.
+
+    Usage:
+        m = olsBatch(y,x)
+        print m.b[:,1], m.p[:,1]
+    """
+
+    def __init__(self,y,x,const=True):
+        y = np.atleast_2d(np.asarray(y,dtype=float))
+        x = np.asarray(x,dtype=float)
+        if x.ndim == 1: x = x[:,np.newaxis]
+        if const: x = np.concatenate([ones(x.shape[:-1] + (1,)),x],axis=-1)
+        self.nmodels = y.shape[0]
+        self.ncoef = x.shape[-1]
+        if x.ndim == 2: valid = np.isfinite(y) & np.isfinite(x).all(axis=1)[np.newaxis,:]
+        else:           valid = np.isfinite(y) & np.isfinite(x).all(axis=2)
+        self.nobs = valid.sum(axis=1)
+        self.df_e = self.nobs - self.ncoef
+        self.df_r = self.ncoef - 1
+        self.b    = np.empty((self.nmodels,self.ncoef)); self.b.fill(np.nan)
+        self.se   = np.empty((self.nmodels,self.ncoef)); self.se.fill(np.nan)
+        self.ssr  = np.empty(self.nmodels); self.ssr.fill(np.nan)   # residual sum of squares
+        self.sst  = np.empty(self.nmodels); self.sst.fill(np.nan)   # total sum of squares about the mean
+        if x.ndim == 2: self.estimateShared(y,x,valid)
+        else:           self.estimateEach(y,x,valid)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            self.sse   = self.ssr / self.df_e
+            self.t     = self.b / self.se
+            self.p     = (1 - stats.t.cdf(abs(self.t),self.df_e[:,np.newaxis])) * 2
+            self.R2    = 1 - self.ssr / self.sst
+            self.R2adj = 1 - (1 - self.R2) * ((self.nobs - 1) / self.df_e)
+
+    def estimateShared(self,y,x,valid):
+        # group models by their pattern of valid observations
+        keys = np.packbits(valid,axis=1)
+        keys = np.ascontiguousarray(keys).view(np.dtype((np.void,keys.shape[1]))).ravel()
+        (patterns,group) = np.unique(keys,return_inverse=True)
+        for g in range(len(patterns)):
+            models = np.where(group == g)[0]
+            rows = valid[models[0]]
+            if rows.sum() <= self.ncoef: continue
+            xg = x[rows]                               # one copy of the design per pattern
+            yg = y[models][:,rows].T                   # (obs,models) right hand sides
+            (q,r) = np.linalg.qr(xg)
+            self.b[models] = solve(r,dot(q.T,yg)).T
+            rinv = solve(r,np.eye(self.ncoef))          # inv(x'x) = rinv rinv'
+            e = yg - dot(xg,self.b[models].T)
+            self.ssr[models] = (e * e).sum(axis=0)
+            self.sst[models] = ((yg - yg.mean(axis=0)) ** 2).sum(axis=0)
+            dfe = rows.sum() - self.ncoef
+            self.se[models] = sqrt(np.outer(self.ssr[models] / dfe,(rinv * rinv).sum(axis=1)))
+
+    def estimateEach(self,y,x,valid):
+        ok = self.nobs > self.ncoef
+        w = valid[ok].astype(float)
+        yw = np.where(valid[ok],y[ok],0.0)
+        q = np.where(valid[ok][:,:,np.newaxis],x[ok],0.0) # (models,obs,vars), missing rows zeroed
+        m = len(q)
+        r = np.zeros((m,self.ncoef,self.ncoef))
+        for j in range(self.ncoef):                     # modified Gram-Schmidt, all models at once
+            v = q[:,:,j]
+            for i in range(j):
+                r[:,i,j] = (q[:,:,i] * v).sum(axis=1)
+                v -= r[:,i,j][:,np.newaxis] * q[:,:,i]
+            r[:,j,j] = sqrt((v * v).sum(axis=1))
+            with np.errstate(divide='ignore',invalid='ignore'):
+                q[:,:,j] = v / r[:,j,j][:,np.newaxis]
+        qty = (q * yw[:,:,np.newaxis]).sum(axis=1)      # (models,vars)
+        b = np.zeros((m,self.ncoef))
+        rinv = np.zeros((m,self.ncoef,self.ncoef))
+        eye = np.eye(self.ncoef)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            for i in reversed(range(self.ncoef)):       # back substitution, all models at once
+                b[:,i] = (qty[:,i] - (r[:,i,i+1:] * b[:,i+1:]).sum(axis=1)) / r[:,i,i]
+                rinv[:,i,:] = (eye[i] - (r[:,i,i+1:,np.newaxis] * rinv[:,i+1:,:]).sum(axis=1)) / r[:,i,i][:,np.newaxis]
+        e = (yw - (q * (qty[:,np.newaxis,:])).sum(axis=2)) * w
+        ymean = yw.sum(axis=1) / self.nobs[ok]
+        self.b[ok]   = b
+        self.ssr[ok] = (e * e).sum(axis=1)
+        self.sst[ok] = (((yw - ymean[:,np.newaxis]) * w) ** 2).sum(axis=1)
+        self.se[ok]  = sqrt((self.ssr[ok] / self.df_e[ok])[:,np.newaxis] * (rinv * rinv).sum(axis=2))
+
 if __name__ == '__main__':
 
 	##########################
@@ -217,3 +317,13 @@ if __name__ == '__main__':
 	    summary = rpy.r.summary(linear_model)
 	    print summary
 
+	# batched fits, checked against the ols class
+	yb = randn(50,100)
+	yb[yb > 2.5] = np.nan # some missing observations
+	mb = olsBatch(yb,data[:,1:])
+	mc = olsBatch(yb,np.tile(data[:,1:],(50,1,1)))
+	diff = 0
+	for i in range(50):
+	    mi = ols(yb[i],data[:,1:])
+	    diff = max(diff,abs(mi.b - mb.b[i]).max(),abs(mi.se - mb.se[i]).max(),abs(mi.R2 - mb.R2[i]),abs(mi.b - mc.b[i]).max(),abs(mi.se - mc.se[i]).max(),abs(mi.R2 - mc.R2[i]))
+	print "Max difference between olsBatch and ols: %g" % diff
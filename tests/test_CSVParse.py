@@ -0,0 +1,56 @@
+# Tests for CSVParse. Run from the repository root with: python -m unittest discover -s tests
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import CSVParse
+
+class ParseReadingsTest(unittest.TestCase):
+  def testSigns(self):
+    (values,errors) = CSVParse.parseReadings(['1','-5','22'])
+    self.assertEqual((values.tolist(),errors),([1,-5,22],[]))
+
+  def testRepeatedSignIsAnError(self):
+    (values,errors) = CSVParse.parseReadings(['1','--5','-','7'],[10,11,12,13])
+    self.assertEqual(values.tolist(),[1,0,0,7])
+    self.assertEqual([line for (line,msg) in errors],[11,12])
+
+class ParseDatesTest(unittest.TestCase):
+  def testISOMinutesMatchStrptime(self):
+    strs = ['2012-02-29 23:59','2013-02-29 00:00','2011-10-29 01:00','2011-13-01 00:00','junk']
+    (seconds,valid) = CSVParse.parseISOMinutes(strs)
+    self.assertEqual(valid.tolist(),[True,False,True,False,False])
+    for i in np.where(valid)[0]: self.assertEqual(seconds[i],CSVParse.parseDate(strs[i],CSVParse.ISO_MINUTE))
+
+  def testSniffAndFallBack(self):
+    strs = ['10/29/2011 00:00','10/29/2011 01:00','2011-10-29 02:00','bad']
+    fmt = CSVParse.sniffDateFormat(strs[0:2])
+    self.assertEqual(fmt,'%m/%d/%Y %H:%M')
+    (seconds,errors) = CSVParse.parseDates(strs,fmt)
+    self.assertEqual((seconds[1] - seconds[0],seconds[2] - seconds[1]),(3600,3600))
+    self.assertEqual([line for (line,msg) in errors],[3])
+
+class CSVDataTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir,'data.csv')
+    rows = ['2011-10-29 %02d:00,%d' % (h,100 + h) for h in range(24)]
+    rows[5] = '2011-10-29 05:00,--5' # skipped
+    with open(self.path,'wb') as f: f.write('date,reading\n' + '\n'.join(rows)) # no final line break
+
+  def tearDown(self): shutil.rmtree(self.dir)
+
+  def testChunksMatchWholeFile(self):
+    data = CSVParse.CSVData(self.path)
+    self.assertEqual(len(data.values),23)
+    self.assertEqual([line for (line,msg) in data.errors],[7])
+    chunks = list(CSVParse.iterChunks(self.path,chunkRows=5))
+    self.assertEqual([len(chunk[0]) for chunk in chunks],[5,4,5,5,4])
+    self.assertTrue(np.array_equal(np.concatenate([chunk[0] for chunk in chunks]),data.times))
+    self.assertTrue(np.array_equal(np.concatenate([chunk[1] for chunk in chunks]),data.values))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,39 @@
+# Tests for ChangePoint. Run from the repository root with: python -m unittest discover -s tests
+import unittest
+
+import numpy as np
+
+import ChangePoint
+
+def simulated(seed,heat=0.8,cool=1.5,noise=1.0,days=365):
+  rs = np.random.RandomState(seed)
+  tout = rs.uniform(20,100,days)
+  kWh  = 20 + heat * np.maximum(55 - tout,0) + cool * np.maximum(tout - 70,0) + rs.normal(0,noise,days)
+  return (tout,kWh)
+
+class FitModelsTest(unittest.TestCase):
+  def testRecoversBalancePoints(self):
+    (tout,kWh) = simulated(1)
+    best = ChangePoint.bestModel(tout,kWh)
+    self.assertEqual((best.kind,best.heatBalance,best.coolBalance),('5P',55.0,70.0))
+    self.assertAlmostEqual(best.heatSlope,0.8,delta=0.05)
+    self.assertAlmostEqual(best.coolSlope,1.5,delta=0.05)
+    self.assertAlmostEqual(best.b0,20,delta=0.5)
+
+  def testBatchedSearchMatchesRefitting(self):
+    (tout,kWh) = simulated(2,cool=0.0)
+    model = ChangePoint.fitModels(tout,kWh)['3PH']
+    sse = []
+    for temp in ChangePoint.candidateTemps(tout): # one ols.ols fit per candidate, the slow way
+      fit = ChangePoint.ChangePointModel('3PH',tout,kWh,heatBalance=temp)
+      if fit.heatSlope > 0: sse.append((np.dot(fit.lm.e,fit.lm.e),temp))
+    self.assertEqual(model.heatBalance,min(sse)[1])
+
+  def testMissingAndTooFewDays(self):
+    (tout,kWh) = simulated(3)
+    kWh[::2] = np.nan
+    self.assertEqual(ChangePoint.bestModel(tout,kWh).kind,'5P')
+    self.assertEqual(ChangePoint.fitModels(tout[0:ChangePoint.MIN_DAYS - 1],kWh[0:ChangePoint.MIN_DAYS - 1]),{})
+
+if __name__ == '__main__':
+  unittest.main()
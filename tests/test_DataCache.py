@@ -0,0 +1,119 @@
+# Tests for DataCache. Run from the repository root with: python -m unittest discover -s tests
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import DataCache
+import analysis
+
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','sample_data')
+
+class LRUCacheTest(unittest.TestCase):
+  def testEvictsLeastRecentlyUsed(self):
+    cache = DataCache.LRUCache(3)
+    for key in 'abc': cache.put(key,key.upper(),1)
+    self.assertEqual(cache.get('a'),'A') # a is now the most recently used
+    cache.put('d','D',1)
+    self.assertEqual(cache.get('b'),None)
+    self.assertEqual([cache.get(key) for key in 'acd'],['A','C','D'])
+    cache.put('huge','X',4) # bigger than the whole cache, so not kept
+    self.assertEqual((cache.get('huge'),len(cache)),(None,3))
+
+class RenderCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.cacheDir = os.path.join(self.dir,'cache')
+
+  def tearDown(self): shutil.rmtree(self.dir)
+
+  def write(self,path,data):
+    with open(path,'wb') as f: f.write(data)
+
+  def testStoreFetchAndEvict(self):
+    cache = DataCache.RenderCache(self.cacheDir,10)
+    src = os.path.join(self.dir,'plot.png')
+    self.write(src,'123456')
+    cache.store('one',src)
+    dest = os.path.join(self.dir,'copy.png')
+    self.assertTrue(cache.fetch('one',dest))
+    with open(dest,'rb') as f: self.assertEqual(f.read(),'123456')
+    self.assertFalse(cache.fetch('missing',dest))
+    cache.store('two',src) # 12 bytes > 10, so one goes
+    self.assertFalse(cache.fetch('one',dest))
+    self.assertFalse(os.path.exists(cache.path('one')))
+    self.assertEqual(DataCache.RenderCache(self.cacheDir,10).entries.keys(),['two']) # the index is rebuilt from the files
+
+  def testKeepsInFlightTempFiles(self):
+    os.makedirs(self.cacheDir)
+    fresh = os.path.join(self.cacheDir,'key.123.456.tmp')
+    stale = os.path.join(self.cacheDir,'old.123.456.tmp')
+    for path in (fresh,stale): self.write(path,'x')
+    old = time.time() - DataCache.STALE_TMP_AGE - 60
+    os.utime(stale,(old,old))
+    cache = DataCache.RenderCache(self.cacheDir,100)
+    self.assertTrue(os.path.exists(fresh)) # may be another instance's store in progress
+    self.assertFalse(os.path.exists(stale))
+    self.assertEqual(len(cache.entries),0)
+
+class SidecarTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.source = os.path.join(self.dir,'data.xml')
+    with open(self.source,'wb') as f: f.write('<xml/>')
+
+  def tearDown(self): shutil.rmtree(self.dir)
+
+  def testRoundTrip(self):
+    key = DataCache.contentKey(self.source,'test 1')
+    self.assertEqual(key,DataCache.contentKey(self.source,'test 1'))
+    self.assertNotEqual(key,DataCache.contentKey(self.source,'test 2'))
+    readings = DataCache.ParsedReadings(np.arange(3,dtype=np.int64) * 3600,np.array([1.0,2.0,3.0]))
+    DataCache.writeSidecar(self.source,key,readings)
+    loaded = DataCache.loadSidecar(self.source,key)
+    self.assertTrue(np.array_equal(loaded.times,readings.times))
+    self.assertTrue(np.array_equal(loaded.values,readings.values))
+
+class ParsedSidecarTest(unittest.TestCase):
+  '''the columnar readings of each parser through analysis.parseDataFile's cache and back'''
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.memory = analysis.dataCache
+    analysis.dataCache = DataCache.LRUCache(2**20)
+
+  def tearDown(self):
+    analysis.dataCache = self.memory
+    shutil.rmtree(self.dir)
+
+  def roundTrip(self,sample):
+    source = os.path.join(self.dir,sample)
+    shutil.copy(os.path.join(SAMPLE_DIR,sample),source)
+    parser = analysis.parseDataFile(source) # no cache
+    (times,values) = parser.getReadingsArray()
+    self.assertEqual(times.dtype,np.int64)
+    first = analysis.parseDataFile(source,useCache=True) # parses, writes the sidecar and keeps it in memory
+    sidecars = [name for name in os.listdir(self.dir) if name.endswith('.npy')]
+    self.assertEqual(len(sidecars),1)
+    analysis.dataCache = DataCache.LRUCache(2**20) # i.e. another process
+    cached = analysis.parseDataFile(source,useCache=True)
+    self.assertTrue(isinstance(cached.times,np.memmap))
+    for parsed in (first,cached):
+      (cTimes,cValues) = parsed.getReadingsArray()
+      self.assertTrue(np.array_equal(cTimes,times))
+      self.assertTrue(np.array_equal(cValues,values))
+      self.assertEqual(cValues.dtype,values.dtype)
+    self.assertEqual(cached.getReadings(),parser.getReadings())
+    with open(source,'ab') as f: f.write('\n') # new contents, new key: parsed again and the old sidecar removed
+    analysis.parseDataFile(source,useCache=True)
+    self.assertEqual(len([name for name in os.listdir(self.dir) if name.endswith('.npy')]),1)
+    self.assertFalse(os.path.exists(os.path.join(self.dir,sidecars[0])))
+
+  def testGreenButton(self): self.roundTrip('GB_data.xml')
+
+  def testCSV(self): self.roundTrip('GB_data.csv')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+# Tests for GBParse. Run from the repository root with: python -m unittest discover -s tests
+import calendar
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import GBParse
+
+def entry(path,content):
+  return '''  <entry>
+    <link href="%s" rel="self"/>
+    <title type="text">%s</title>
+    <content type="xml">%s</content>
+  </entry>
+''' % (path,path.split('/')[-2],content)
+
+def intervalBlock(readings):
+  '''IntervalBlock content for (start,value,cost) readings, cost None for none'''
+  xml = ['<IntervalBlock xmlns="http://naesb.org/espi">']
+  for (start,value,cost) in readings:
+    xml.append('<IntervalReading>%s<timePeriod><duration>3600</duration><start>%d</start></timePeriod><value>%d</value></IntervalReading>' %
+               ('' if cost is None else '<cost>%d</cost>' % cost,start,value))
+  xml.append('</IntervalBlock>')
+  return ''.join(xml)
+
+START = 1299128400 # 2011-03-03 05:00 UTC
+
+# two usage points: the first with its readings split over two IntervalBlocks, one with a cost,
+# and the second with a tz offset
+FEED = '''<?xml version="1.0"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title type="text">Test Feed</title>
+  <updated>2012-04-03T22:55:36.364Z</updated>
+''' + ''.join([
+  entry('/v1/User/1/UsagePoint/1','<UsagePoint xmlns="http://naesb.org/espi"/>'),
+  entry('/v1/User/1/UsagePoint/1/MeterReading/1','<MeterReading xmlns="http://naesb.org/espi"/>'),
+  entry('/v1/ReadingType/1','<ReadingType xmlns="http://naesb.org/espi"><uom>72</uom></ReadingType>'),
+  entry('/v1/User/1/UsagePoint/1/MeterReading/1/IntervalBlock/1',intervalBlock([(START,436,None),(START + 3600,371,1500)])),
+  entry('/v1/User/1/UsagePoint/1/MeterReading/1/IntervalBlock/2',intervalBlock([(START + 7200,391,None)])),
+  entry('/v1/User/1/UsagePoint/2','<UsagePoint xmlns="http://naesb.org/espi"/>'),
+  entry('/v1/LocalTimeParameters/2','<LocalTimeParameters xmlns="http://naesb.org/espi"><tzOffset>3600</tzOffset></LocalTimeParameters>'),
+  entry('/v1/User/1/UsagePoint/2/MeterReading/1','<MeterReading xmlns="http://naesb.org/espi"/>'),
+  entry('/v1/User/1/UsagePoint/2/MeterReading/1/IntervalBlock/1',intervalBlock([(START,10,None)])),
+]) + '</feed>\n'
+
+def localSeconds(epoch):
+  '''naive local wall clock seconds of a unix time, the slow way'''
+  return calendar.timegm(datetime.datetime.fromtimestamp(epoch).timetuple())
+
+class GBParseTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir,'feed.xml')
+    with open(self.path,'wb') as f: f.write(FEED)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testReadings(self):
+    gb = GBParse.getInstance(self.path) # streams
+    self.assertEqual(gb.parsed['feedType'],'Test Feed')
+    self.assertEqual(len(gb.parsed['UsagePoints']),2)
+    (times,values,durations,costs) = gb.getReadingsArray(cols=GBParse.READING_COLS)
+    self.assertEqual(times.tolist(),[localSeconds(START + i * 3600) for i in range(3)])
+    self.assertEqual(values.tolist(),[436,371,391])
+    self.assertEqual(durations.tolist(),[3600] * 3)
+    self.assertEqual(np.isnan(costs).tolist(),[True,False,True])
+    self.assertEqual(costs[1],1500)
+    (times,values) = gb.getReadingsArray(usagePointIdx=1)
+    self.assertEqual((times.tolist(),values.tolist()),([localSeconds(START - 3600)],[10])) # less the tz offset
+    self.assertEqual(gb.getReadingsArray(usagePointIdx=2),None)
+
+  def testStreamMatchesTree(self):
+    for path in (self.path,os.path.join(os.path.dirname(__file__),'..','sample_data','GB_data.xml')):
+      streamed = GBParse.GBData(path,stream=True).parsed
+      tree     = GBParse.GBData(path,stream=False).parsed
+      self.assertEqual(streamed.keys(),tree.keys())
+      for key in ('feedType','updated','published'): self.assertEqual(streamed[key],tree[key])
+      self.assertEqual(len(streamed['UsagePoints']),len(tree['UsagePoints']))
+      for (s,t) in zip(streamed['UsagePoints'],tree['UsagePoints']):
+        self.assertEqual((s['name'],s['tzOffset'],len(s['ReadingBlock'])),(t['name'],t['tzOffset'],len(t['ReadingBlock'])))
+        for (sBlock,tBlock) in zip(s['ReadingBlock'],t['ReadingBlock']):
+          self.assertEqual(sorted(sBlock.keys()),sorted(tBlock.keys()))
+          for (key,val) in sBlock.items():
+            if isinstance(val,np.ndarray): self.assertTrue(np.array_equal(val,tBlock[key]) or np.allclose(val,tBlock[key],equal_nan=True),key)
+            else: self.assertEqual(val,tBlock[key])
+
+if __name__ == '__main__':
+  unittest.main()
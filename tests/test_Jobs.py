@@ -0,0 +1,129 @@
+# Tests for Jobs. Run from the repository root with: python -m unittest discover -s tests
+import time
+import threading
+import unittest
+
+import Jobs
+
+class ArtifactsTest(unittest.TestCase):
+  def setUp(self):
+    self.artifacts = Jobs.Artifacts(['a.png','custom_report.pdf'])
+
+  def waitInThread(self,name):
+    '''starts a thread waiting on name. Returns (thread,result dict) with the wait's return value and errorFor'''
+    result = {}
+    def wait():
+      result['done']  = self.artifacts.wait(name,timeout=5)
+      result['error'] = self.artifacts.errorFor(name)
+      result['ready'] = name in self.artifacts.ready
+    thread = threading.Thread(target=wait)
+    thread.start()
+    return (thread,result)
+
+  def testClaimIsExclusive(self):
+    self.assertTrue(self.artifacts.claim(['a.png']))
+    self.assertFalse(self.artifacts.claim(['a.png']))
+    self.artifacts.markReady('a.png')
+    self.assertFalse(self.artifacts.claim(['a.png']))
+
+  def testClaimedNameOutlivesFinish(self):
+    # request A claims the pdf, the background build finishes without it and request B waits for it
+    self.assertTrue(self.artifacts.claim(['custom_report.pdf']))
+    self.artifacts.markReady('a.png')
+    self.artifacts.finish(None)
+    self.assertTrue(self.artifacts.done())
+    self.assertFalse(self.artifacts.done('custom_report.pdf'))
+    (thread,result) = self.waitInThread('custom_report.pdf')
+    time.sleep(0.1)
+    self.assertTrue(thread.is_alive()) # still waiting on request A
+    self.artifacts.markReady('custom_report.pdf')
+    thread.join(5)
+    self.assertEqual(result,{'done': True,'error': None,'ready': True})
+
+  def testConcurrentClaimsBuildOnce(self):
+    builds = []
+    def request():
+      if self.artifacts.claim(['a.png']):
+        builds.append(threading.current_thread().name)
+        time.sleep(0.05)
+        self.artifacts.markReady('a.png')
+      self.artifacts.wait('a.png',timeout=5)
+    threads = [threading.Thread(target=request) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join(5)
+    self.assertEqual(len(builds),1)
+    self.assertTrue(self.artifacts.done('a.png'))
+
+  def testReleaseFailsWaiters(self):
+    self.assertTrue(self.artifacts.claim(['a.png','custom_report.pdf']))
+    (thread,result) = self.waitInThread('a.png')
+    self.artifacts.markReady('custom_report.pdf')
+    self.artifacts.release(['a.png','custom_report.pdf'],'boom')
+    thread.join(5)
+    self.assertEqual(result,{'done': True,'error': 'boom','ready': False})
+    self.assertEqual(self.artifacts.errorFor('custom_report.pdf'),None)
+
+  def testFinishFailsUnclaimedNames(self):
+    self.artifacts.finish(None)
+    self.assertTrue(self.artifacts.done('a.png'))
+    self.assertEqual(self.artifacts.errorFor('a.png'),'a.png was not produced')
+
+  def testOnDemandNamesOutliveFinish(self):
+    self.artifacts = Jobs.Artifacts(['a.png','custom_report.pdf'],onDemand=['custom_report.pdf'])
+    self.artifacts.scheduled = True
+    self.assertFalse(self.artifacts.expected('custom_report.pdf')) # the background build won't make it
+    self.artifacts.markReady('a.png')
+    self.artifacts.finish(None)
+    self.assertEqual(self.artifacts.status()['pending'],[])
+    self.assertFalse(self.artifacts.done('custom_report.pdf'))
+    self.assertFalse(self.artifacts.expected('custom_report.pdf'))
+    self.assertTrue(self.artifacts.claim(['custom_report.pdf'])) # requested
+    self.assertTrue(self.artifacts.expected('custom_report.pdf'))
+    self.artifacts.markReady('custom_report.pdf')
+    self.assertTrue(self.artifacts.done('custom_report.pdf'))
+
+  def testExpected(self):
+    # with nothing scheduled or claimed, waiting would never end
+    self.assertFalse(self.artifacts.expected('a.png'))
+    self.artifacts.claim(['a.png'])
+    self.assertTrue(self.artifacts.expected('a.png'))
+    self.assertFalse(self.artifacts.expected('unlisted.png'))
+    self.artifacts.scheduled = True
+    self.assertTrue(self.artifacts.expected('unlisted.png'))
+
+  def testWaitTimesOut(self):
+    start = time.time()
+    self.assertFalse(self.artifacts.wait('a.png',timeout=0.1))
+    self.assertTrue(time.time() - start < 2)
+
+  def testStatus(self):
+    self.assertEqual(self.artifacts.status()['state'],'idle')
+    self.artifacts.claim(['a.png'])
+    status = self.artifacts.status()
+    self.assertEqual((status['state'],status['building']),('running',['a.png']))
+    self.artifacts.markReady('a.png')
+    self.artifacts.finish()
+    self.assertEqual(self.artifacts.status()['state'],'done')
+
+class JobQueueTest(unittest.TestCase):
+  def testRunsInOrderAndSurvivesErrors(self):
+    queue = Jobs.JobQueue('test')
+    ran = []
+    def fail(): raise ValueError('expected')
+    queue.put(ran.append,1)
+    queue.put(fail)
+    queue.put(ran.append,2)
+    queue.queue.join()
+    self.assertEqual(ran,[1,2])
+
+class JobTest(unittest.TestCase):
+  def testResultAndError(self):
+    job = Jobs.Job('ok',lambda x: x * 2,21)
+    self.assertTrue(job.wait(5))
+    self.assertEqual((job.result,job.status()),(42,'done'))
+    job = Jobs.Job('bad',int,'x')
+    self.assertTrue(job.wait(5))
+    self.assertEqual(job.status(),'failed')
+
+if __name__ == '__main__':
+  unittest.main()
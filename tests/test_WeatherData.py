@@ -0,0 +1,213 @@
+# Tests for WeatherData. Run from the repository root with: python -m unittest discover -s tests
+# Downloads come from a local http server standing in for NOAA (see weather.base.url).
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+import BaseHTTPServer
+import SocketServer
+import SimpleHTTPServer
+
+import numpy as np
+
+import WeatherData
+from WeatherData import GHCNData
+
+DAILY_HEADERS = 'WBAN,YearMonthDay,Tmax,TmaxFlag,Tmin,TminFlag,Tavg,TavgFlag,Depart,DepartFlag'
+
+def writeMonth(path,year,month,stations):
+  '''writes a QCLCD style zip for year/month with a daily file of stations, a dict of WBAN -> tavg by day'''
+  lines = [DAILY_HEADERS]
+  for (wban,tavgs) in sorted(stations.items()):
+    for (day,tavg) in enumerate(tavgs):
+      lines.append('%s,%d%02d%02d,%s,,%s,,%s, ,,' % (wban,year,month,day + 1,tavg + 5,tavg - 5,tavg))
+  zf = zipfile.ZipFile(path,'w')
+  try:
+    zf.writestr('%d%02ddaily.txt' % (year,month),'\n'.join(lines) + '\n')
+    zf.writestr('%d%02dstation.txt' % (year,month),'WBAN|WMO|CallSign\n')
+  finally: zf.close()
+
+class MirrorHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+  '''serves the files in MirrorHandler.root, counting and slowing down requests so concurrent ones overlap'''
+  root = None
+  requests = []
+  def translate_path(self,path): return os.path.join(self.root,path.lstrip('/'))
+  def do_GET(self):
+    self.requests.append(self.path)
+    time.sleep(0.2)
+    SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+  def log_message(self,*args): pass
+
+class ThreadedServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class WeatherDataTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.mirror = tempfile.mkdtemp()
+    writeMonth(os.path.join(cls.mirror,'QCLCD201201.zip'),2012,1,{'00100':range(30,61),'03011':range(40,71)})
+    writeMonth(os.path.join(cls.mirror,'QCLCD201202.zip'),2012,2,{'00100':range(60,89)})
+    with open(os.path.join(cls.mirror,'QCLCD201203.zip'),'wb') as f: f.write('<html>not a zip</html>')
+    MirrorHandler.root = cls.mirror
+    cls.server = ThreadedServer(('127.0.0.1',0),MirrorHandler)
+    cls.url = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+    thread = threading.Thread(target=cls.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.server.shutdown()
+    cls.server.server_close()
+    shutil.rmtree(cls.mirror)
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    with open(os.path.join(self.dir,'Erle_zipcodes.csv'),'wb') as f:
+      f.write('"zip","city","state","latitude","longitude","timezone","dst"\n"94305","Stanford","CA","37.4","-122.2","-8","1"\n')
+    del MirrorHandler.requests[:]
+    self.wd = WeatherData.WeatherData(self.dir,baseUrl=self.url)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testBaseUrlOverride(self):
+    self.assertEqual(self.wd.weatherUrl(2012,1),self.url + 'QCLCD201201.zip')
+    self.assertEqual(WeatherData.WeatherData(self.dir).weatherUrl(2012,1),WeatherData.QCLCD_BASE_URL + 'QCLCD201201.zip')
+    path = self.wd.confirmedWeatherZip(2012,1)
+    self.assertEqual(path,self.wd.weatherZip(2012,1))
+    self.assertTrue(zipfile.is_zipfile(path))
+    self.assertEqual(MirrorHandler.requests,['/QCLCD201201.zip'])
+    self.wd.confirmedWeatherZip(2012,1) # a complete past month isn't downloaded again
+    self.assertEqual(len(MirrorHandler.requests),1)
+
+  def testInvalidDownloadLeavesNoFile(self):
+    target = os.path.join(self.dir,'QCLCD201203.zip')
+    self.assertRaises(IOError,WeatherData.download,self.url + 'QCLCD201203.zip',target)
+    self.assertRaises(IOError,WeatherData.download,self.url + 'QCLCD209901.zip',target) # 404
+    self.assertEqual(os.listdir(self.dir),['Erle_zipcodes.csv']) # neither the target nor a temp file
+
+  def testFailedRefreshKeepsExistingFile(self):
+    target = self.wd.weatherZip(2012,3)
+    shutil.copy(os.path.join(self.mirror,'QCLCD201201.zip'),target)
+    os.utime(target,(0,0)) # retrieved long before the month was over, so it is refreshed
+    self.assertEqual(self.wd.confirmedWeatherZip(2012,3),target)
+    self.assertTrue(zipfile.is_zipfile(target))
+
+  def testConcurrentPrefetchDownloadsOnce(self):
+    results = []
+    def prefetch(): results.append(self.wd.prefetch(datetime.date(2012,1,1),datetime.date(2012,3,31)))
+    threads = [threading.Thread(target=prefetch) for i in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    self.assertEqual(sorted(set(MirrorHandler.requests)),['/QCLCD201201.zip','/QCLCD201202.zip','/QCLCD201203.zip'])
+    self.assertEqual(MirrorHandler.requests.count('/QCLCD201201.zip'),1)
+    self.assertEqual(MirrorHandler.requests.count('/QCLCD201202.zip'),1)
+    for result in results:
+      self.assertEqual(result[0:2],[self.wd.weatherZip(2012,1),self.wd.weatherZip(2012,2)])
+      self.assertTrue(isinstance(result[2],IOError)) # the invalid month fails without failing the others
+    self.assertEqual(sorted(os.listdir(self.dir)),['Erle_zipcodes.csv','QCLCD201201.zip','QCLCD201202.zip'])
+
+  def testDailyStore(self):
+    (dates,tavg) = self.wd.dailyArray(2012,1,'03011')
+    self.assertEqual((dates[0],dates[-1]),(20120101,20120131))
+    self.assertEqual(tavg.tolist(),range(40,71))
+    (dates,tmax) = self.wd.stationSeries('00100',datetime.date(2012,1,1),datetime.date(2012,2,29),'tmax')
+    self.assertEqual(len(dates),31 + 29)
+    self.assertEqual(tmax.tolist(),range(35,66) + range(65,94))
+    self.assertEqual(len(self.wd.dailyArray(2012,2,'03011')[0]),0)
+
+  def testEmptyStationFile(self):
+    index = WeatherData.StationIndex([])
+    self.assertEqual(len(index),0)
+    self.assertEqual(self.wd.stationIndex(2012,1),None) # the mirror's station files have no stations
+    self.assertEqual(self.wd.weatherMonthArray(94305,2012,1)[0].tolist(),[])
+
+def stationLine(station,lat,lon,state,name):
+  '''a line of the fixed width GHCN station list'''
+  return '%-11s %8.4f %9.4f %6.1f %-2s %-30s GSN     72494\n' % (station,lat,lon,10.0,state,name)
+
+class GHCNDataTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    with open(os.path.join(self.dir,'Erle_zipcodes.csv'),'wb') as f:
+      f.write('"zip","city","state","latitude","longitude","timezone","dst"\n"94305","Stanford","CA","37.4","-122.2","-8","1"\n')
+    with open(os.path.join(self.dir,'ghcnd-US-stations.txt'),'wb') as f:
+      f.write(stationLine('USC00047339',37.4,-122.1,'CA','PALO ALTO')) # closest, but only reports precipitation
+      f.write(stationLine('USW00023234',37.6,-122.4,'CA','SAN FRANCISCO INTL AP'))
+      f.write(stationLine('USW00094728',40.8,-74.0,'NY','NEW YORK CNTRL PK TWR'))
+    rows = ['USC00047339,20120101,PRCP,5,,,7,0700',
+            'USW00023234,20120101,TMAX,150,,,W,2400',
+            'USW00023234,20120101,TMIN,50,,,W,2400',
+            'USW00023234,20120102,TMAX,200,,,W,2400',
+            'USW00023234,20120102,TMIN,-9999,,,W,2400', # missing
+            'USW00023234,20120103,TMAX,400,,G,W,2400',  # failed a quality check
+            'USW00023234,20120103,TMIN,100,,,W,2400',
+            'USW00094728,20120101,TMAX,0,,,W,2400']
+    f = gzip.open(os.path.join(self.dir,'2012.csv.gz'),'wb')
+    try: f.write('\n'.join(rows) + '\n')
+    finally: f.close()
+    self.ghcn = GHCNData(self.dir,baseUrl='http://127.0.0.1:9/') # never used: the year file is already there
+    self.streamed = []
+    stream = self.ghcn.streamYear
+    def countStreams(year,stations):
+      self.streamed.append(sorted(stations))
+      return stream(year,stations)
+    self.ghcn.streamYear = countStreams
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def testReadStations(self):
+    stations = WeatherData.readGHCNStations(self.ghcn.STATION_FILE)
+    self.assertEqual(stations[1],['USW00023234',' 37.6000','-122.4000','10.0','CA','SAN FRANCISCO INTL AP'])
+    self.assertEqual(self.ghcn.stationList(94305,2),['USC00047339','USW00023234'])
+
+  def testStreamYear(self):
+    rows = self.ghcn.streamYear(2012,set(['USW00023234']))
+    self.assertEqual(rows,[['USW00023234','20120101','59.0','41.0','50.0'],
+                           ['USW00023234','20120102','68.0','',''],
+                           ['USW00023234','20120103','','50.0','']])
+
+  def testYearStoreKeepsScans(self):
+    self.assertEqual(self.ghcn.yearStore(2012),None) # nothing searched for yet
+    store = self.ghcn.yearStore(2012,['USC00047339']) # no temperatures
+    self.assertEqual(len(store),0)
+    self.assertEqual(len(self.ghcn.yearStore(2012,['USC00047339'])),0)
+    self.assertEqual(self.streamed,[['USC00047339']]) # the empty result was kept
+    store = self.ghcn.yearStore(2012,['USW00023234','USW00094728'])
+    self.assertEqual(len(store),4)
+    self.ghcn.yearStore(2012,['USW00094728','USC00047339'])
+    self.assertEqual(self.streamed,[['USC00047339'],['USW00023234','USW00094728']])
+    (dates,tmax) = self.ghcn.dailyArray(2012,'USW00094728','tmax')
+    self.assertEqual((dates.tolist(),tmax.tolist()),([20120101],[32.0]))
+
+  def testWeatherSkipsStationsWithoutData(self):
+    (days,tavg) = self.ghcn.weatherRangeArray(94305,datetime.date(2012,1,1),datetime.date(2012,1,2))
+    self.assertEqual(days.astype(object).tolist(),[datetime.date(2012,1,1),datetime.date(2012,1,2)])
+    self.assertEqual(tavg[0],50.0)
+    self.assertTrue(np.isnan(tavg[1]))
+
+class TimesTest(unittest.TestCase):
+  def testWallToStandard(self):
+    (start,end) = WeatherData.dstRange(2012) # 3/11 and 11/4 at 2am
+    times = np.array([start - 1,start + 3600,end - 3601,end,end + 3600])
+    self.assertEqual((WeatherData.wallToStandard(times) - times).tolist(),[0,-3600,-3600,0,0])
+
+  def testInterpolateClampsWithinMaxGap(self):
+    wTimes = np.array([3600,7200,7200 + 4 * 3600],dtype=np.int64)
+    values = np.array([10.0,20.0,40.0])
+    times = np.array([0,1800,5400,9000,7200 + 4 * 3600 + 1800,7200 + 8 * 3600])
+    out = WeatherData.interpolateTimes(times,wTimes,values,maxGap=3 * 3600)
+    self.assertEqual(out[0:3].tolist(),[10.0,10.0,15.0])
+    self.assertTrue(np.isnan(out[3]))   # between observations 4 hours apart
+    self.assertEqual(out[4],40.0)       # held within maxGap of the end
+    self.assertTrue(np.isnan(out[5]))   # too far beyond the end
+
+if __name__ == '__main__':
+  unittest.main()
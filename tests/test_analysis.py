@@ -0,0 +1,115 @@
+# Tests for analysis. Run from the repository root with: python -m unittest discover -s tests
+import datetime
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import cherrypy
+import numpy as np
+
+import analysis
+import Jobs
+
+def hourly(start,end,skip=()):
+  '''wall clock datetimes every hour from start up to end, without those in skip, and their readings (the hour of day)'''
+  times = []
+  t = start
+  while t < end:
+    if t not in skip: times.append(t)
+    t += datetime.timedelta(hours=1)
+  return (times,[t.hour for t in times])
+
+class FoldingTest(unittest.TestCase):
+  def testDstCrossing(self):
+    # spring forward on Sunday 3/11/2012: the 2am hour doesn't exist on the wall clock
+    (times,watts) = hourly(datetime.datetime(2012,3,4),datetime.datetime(2012,3,26),skip=[datetime.datetime(2012,3,11,2)])
+    b = analysis.Building((times,watts),94305,{})
+    self.assertEqual(b.obsPerDay,24)
+    (dates,grid) = b.dailyData
+    self.assertEqual(grid.shape,(21,24)) # the first day is dropped
+    self.assertEqual(dates[6,0].astype(object),datetime.datetime(2012,3,11))
+    self.assertEqual(grid.mask.sum(),1)
+    self.assertTrue(grid.mask[6,2])
+    self.assertEqual(grid[6,3],3) # later hours of the day keep their columns
+    (dates,grid) = b.weeklyData
+    self.assertEqual(grid.shape,(3,168)) # the weeks starting 3/5, 3/12 and 3/19. The partial first week is dropped
+    self.assertEqual(dates[0,0].astype(object),datetime.datetime(2012,3,5))
+    self.assertEqual(grid.mask.sum(),1)
+    self.assertTrue(grid.mask[0,6 * 24 + 2])
+    self.assertEqual(grid[0,6 * 24 + 3],3) # Sunday 3am after the gap is still the Sunday 3am slot
+    self.assertEqual(grid[1,5 * 24 + 13],13) # Saturday 1pm is in the Saturday 1pm slot
+
+  def testDstFallBack(self):
+    # fall back on Sunday 11/4/2012: the 1am hour is read twice on the wall clock
+    (times,watts) = hourly(datetime.datetime(2012,11,1),datetime.datetime(2012,11,8))
+    i = times.index(datetime.datetime(2012,11,4,1))
+    times.insert(i + 1,times[i])
+    watts.insert(i + 1,100)
+    b = analysis.Building((times,watts),94305,{})
+    self.assertEqual(b.obsPerDay,24) # the long day doesn't change the modal readings per day
+    (dates,grid) = b.dailyData
+    self.assertEqual((grid.shape,grid.count()),((6,24),6 * 24))
+    self.assertEqual(grid[2,1],100) # the second reading of the repeated hour
+    self.assertEqual(grid[2,2],2)
+
+  def testMonthlyReadings(self):
+    # a gas meter read on the first of each month
+    times = [datetime.datetime(2011 + (m // 12),m % 12 + 1,1) for m in range(13)]
+    b = analysis.Building((times,[1000.0] * 13),94305,{})
+    self.assertEqual(b.obsPerDay,1)
+    (dates,grid) = b.dailyData
+    self.assertEqual(grid.shape,(365,1)) # every day from 1/2/2011 to 1/1/2012
+    self.assertEqual(grid.count(),12)   # the first reading is dropped with its day
+    self.assertEqual(dates[grid.mask[:,0] == False][:,0].astype(object)[0],datetime.datetime(2011,2,1))
+    (dates,grid) = b.weeklyData
+    self.assertEqual(grid.shape,(52,7)) # the weeks starting 1/3/2011 to 12/26/2011
+    self.assertEqual(grid.count(),12)
+    self.assertEqual(b.dailyStats['mean'].count(),12)
+
+class PlotMakerTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def plotMaker(self,timeout):
+    pm = analysis.PlotMaker(None,self.dir,None,timeout=timeout)
+    pm.artifacts = Jobs.Artifacts(pm.artifactNames())
+    return pm
+
+  def testReportWaitTimesOut(self):
+    pm = self.plotMaker(0.2)
+    pngs = ['%s.png' % fName for (method,fName) in pm.PLOTS]
+    self.assertTrue(pm.artifacts.claim(pngs)) # i.e. by a worker that hangs
+    start = time.time()
+    pm.makeArtifact('custom_report.pdf')
+    self.assertTrue(time.time() - start < 5)
+    for name in pm.REPORT_FILES:
+      self.assertTrue(pm.artifacts.done(name))
+      self.assertTrue('timed out waiting for' in pm.artifacts.errorFor(name))
+    self.assertFalse(pm.artifacts.done(pngs[0])) # still the hung worker's
+
+  def testWorkersSkipTheRenderCache(self):
+    cacheDir = os.path.join(self.dir,'render_cache')
+    cherrypy.config.update({'render.cache.dir': cacheDir})
+    try:
+      self.assertEqual(analysis.PlotMaker(None,self.dir,None,cache=False).cache,None)
+      (times,watts) = hourly(datetime.datetime(2012,3,4),datetime.datetime(2012,3,26))
+      b = analysis.Building((times,watts),94305,{})
+      (fName,seconds,error) = analysis.renderPlot((b,self.dir,'heatmap','heatmap',50))
+      self.assertEqual(error,None)
+      self.assertTrue(os.path.isfile(os.path.join(self.dir,'heatmap.png')))
+      self.assertFalse(os.path.exists(cacheDir)) # a RenderCache creates its directory
+    finally: cherrypy.config.update({'render.cache.dir': None})
+
+  def testWaitForFailedArtifact(self):
+    pm = self.plotMaker(5)
+    pm.artifacts.claim(['heatmap.png'])
+    pm.artifacts.markFailed('heatmap.png','bad data')
+    self.assertRaises(Exception,pm.waitForArtifacts,['heatmap.png'])
+
+if __name__ == '__main__':
+  unittest.main()